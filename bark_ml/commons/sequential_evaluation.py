@@ -0,0 +1,115 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Patrick Hart, Julian Bernhard, Klemens Esterle, and
+# Tobias Kessler
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import math
+from statistics import NormalDist
+
+
+class SequentialEvaluation:
+  """Estimates evaluation metrics episode by episode to stop early.
+
+  Keeps running means and variances of per-episode metrics and reports
+  their confidence intervals, Wilson score intervals for the binary
+  metrics (e.g. success) and normal intervals otherwise. An evaluation
+  can stop once the intervals of all metrics in `interval_widths` are
+  narrower than their width or once a metric is significantly worse than
+  the best one so far.
+
+  The stopping rule is only checked every `check_interval` episodes and
+  the confidence is Bonferroni corrected for the number of checks, so
+  that looking at the intervals repeatedly keeps the error rate below
+  1 - `confidence`.
+  """
+
+  def __init__(self,
+               max_episodes,
+               interval_widths,
+               confidence=0.95,
+               min_episodes=30,
+               check_interval=10,
+               binary_metrics=()):
+    assert min_episodes >= 2
+    self._interval_widths = interval_widths
+    self._min_episodes = min_episodes
+    self._check_interval = check_interval
+    self._binary_metrics = set(binary_metrics)
+    num_checks = max(1, math.ceil(max_episodes / check_interval))
+    self._z = NormalDist().inv_cdf(
+      1. - (1. - confidence) / (2. * num_checks))
+    self._num_episodes = 0
+    self._means = {}
+    self._squared_deviations = {}
+
+  @property
+  def num_episodes(self):
+    return self._num_episodes
+
+  def Update(self, metrics):
+    """Adds the metrics of an episode (Welford's algorithm)."""
+    self._num_episodes += 1
+    for name, value in metrics.items():
+      mean = self._means.get(name, 0.)
+      delta = float(value) - mean
+      mean += delta / self._num_episodes
+      self._squared_deviations[name] = \
+        self._squared_deviations.get(name, 0.) + delta*(float(value) - mean)
+      self._means[name] = mean
+
+  def Mean(self, name):
+    return self._means[name]
+
+  def ConfidenceInterval(self, name):
+    n, mean, z = self._num_episodes, self._means[name], self._z
+    if name in self._binary_metrics:
+      denominator = 1. + z**2/n
+      center = (mean + z**2/(2.*n))/denominator
+      half_width = z*math.sqrt(mean*(1. - mean)/n + z**2/(4.*n**2))/denominator
+    elif n > 1:
+      center = mean
+      half_width = z*math.sqrt(self._squared_deviations[name]/(n - 1)/n)
+    else:
+      return -math.inf, math.inf
+    return center - half_width, center + half_width
+
+  def IsPrecise(self):
+    for name, width in self._interval_widths.items():
+      low, high = self.ConfidenceInterval(name)
+      if high - low >= width:
+        return False
+    return True
+
+  def IsWorse(self, name, best_value, higher_is_better=True):
+    low, high = self.ConfidenceInterval(name)
+    return high < best_value if higher_is_better else low > best_value
+
+  def ShouldStop(self, best_values=None, lower_is_better=()):
+    """Whether the evaluation can stop after the current episode.
+
+    `best_values` maps metric names to the values of the best evaluation
+    so far, by default higher values are better.
+    """
+    if self._num_episodes < self._min_episodes or \
+        self._num_episodes % self._check_interval != 0:
+      return False
+    if self.IsPrecise():
+      return True
+    for name, best_value in (best_values or {}).items():
+      if best_value is not None and \
+          self.IsWorse(name, best_value, name not in lower_is_better):
+        return True
+    return False
+
+  def Summary(self):
+    """Means and confidence intervals of all metrics."""
+    summary = {"num_episodes": self._num_episodes}
+    for name in self._means:
+      low, high = self.ConfidenceInterval(name)
+      summary[name] = self._means[name]
+      summary[f"{name}_ci_low"] = low
+      summary[f"{name}_ci_high"] = high
+    return summary
@@ -0,0 +1,61 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Patrick Hart, Julian Bernhard, Klemens Esterle, and
+# Tobias Kessler
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class ThroughputMonitor:
+  """Accounts the wall time of training phases and counts events.
+
+  A phase timed inside another one (e.g. sampling inside an update) is
+  only accounted to the inner phase, so that the shares of all phases
+  add up to at most one. The summary holds the seconds and share of the
+  elapsed time of every phase and the rate of every counter, e.g.
+  `steps_per_sec`, since the last reset.
+  """
+
+  def __init__(self):
+    self.Reset()
+
+  def Reset(self):
+    self._start = time.perf_counter()
+    self._times = defaultdict(float)
+    self._counts = defaultdict(int)
+    # time of nested phases to subtract from the enclosing phase
+    self._nested = []
+
+  @contextmanager
+  def Time(self, phase):
+    start = time.perf_counter()
+    self._nested.append(0.)
+    try:
+      yield
+    finally:
+      duration = time.perf_counter() - start
+      self._times[phase] += duration - self._nested.pop()
+      if self._nested:
+        self._nested[-1] += duration
+
+  def Count(self, name, count=1):
+    self._counts[name] += count
+
+  def Summary(self, reset=False):
+    elapsed = max(time.perf_counter() - self._start, 1e-9)
+    summary = {"elapsed_sec": elapsed}
+    for name, count in self._counts.items():
+      summary[f"{name}_per_sec"] = count / elapsed
+    for phase, duration in self._times.items():
+      summary[f"time/{phase}"] = duration
+      summary[f"share/{phase}"] = duration / elapsed
+    summary["share/other"] = max(
+      0., 1. - sum(self._times.values()) / elapsed)
+    if reset:
+      self.Reset()
+    return summary
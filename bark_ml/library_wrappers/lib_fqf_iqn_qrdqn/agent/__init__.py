@@ -4,5 +4,8 @@ from .qrdqn_agent import QRDQNAgent
 from .imitation_agent import ImitationAgent, PolicyImitationAgent
 from .carin_agent import CarinAgent
 from .base_agent import BaseAgent, TrainingBenchmark
+from .actor_learner import ActorLearner, SharedWeights
+from .checkpoint_writer import CheckpointWriter
+from .metrics import MetricsLogger
 from .demonstrations import *
 from .util import *
@@ -0,0 +1,206 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Patrick Hart, Julian Bernhard, Klemens Esterle, and
+# Tobias Kessler, Mansoor Nasir
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import copy
+import queue
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+# BARK-ML imports
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.utils import LinearAnneaer
+
+
+class SharedWeights:
+  """Weights of the online network in shared memory.
+
+  The learner publishes its weights by copying them into the shared
+  tensors, the actors load them into their own copy of the network when
+  the version changed. Version 0 means no weights were published yet.
+  """
+  def __init__(self, net, context):
+    self.net = copy.deepcopy(net).cpu()
+    self.net.share_memory()
+    self.version = context.Value('l', 0)
+
+  def publish(self, net):
+    with self.version.get_lock(), torch.no_grad():
+      for shared, value in zip(self.net.state_dict().values(),
+                               net.state_dict().values()):
+        shared.copy_(value)
+      self.version.value += 1
+
+  def pull(self, net, version):
+    # Returns the version of the weights in `net`.
+    if self.version.value == version:
+      return version
+    with self.version.get_lock():
+      net.load_state_dict(self.net.state_dict())
+      return self.version.value
+
+
+def run_actor(actor_id, env_factory, shared_weights, episodes, stop,
+              epsilon_schedule, max_episode_steps, noisy_net, pull_interval,
+              seed):
+  """Collects episodes with the newest published weights.
+
+  Actions are random until the learner published its first weights.
+  Finished episodes are put into the `episodes` queue.
+  """
+  torch.set_num_threads(1)
+  np.random.seed(seed)
+  torch.manual_seed(seed)
+
+  env = env_factory()
+  net = copy.deepcopy(shared_weights.net)
+  start, end, decay_steps = epsilon_schedule
+  epsilon = LinearAnneaer(start, end, int(decay_steps))
+  version = 0
+  steps = 0
+
+  while not stop.is_set():
+    state = env.reset()
+    observations, actions, rewards, dones = [state], [], [], []
+    done = False
+    while (not done) and len(actions) <= max_episode_steps:
+      if steps % pull_interval == 0:
+        version = shared_weights.pull(net, version)
+      epsilon.step()
+      if version == 0 or \
+          (not noisy_net and np.random.rand() < epsilon.get()):
+        action = env.action_space.sample()
+      else:
+        net.sample_noise()
+        with torch.no_grad():
+          states = torch.from_numpy(
+            np.asarray(state, dtype=np.float32)).unsqueeze(0)
+          action = net(states=states).argmax().item()
+
+      state, reward, done, _ = env.step(action)
+      observations.append(state)
+      actions.append(action)
+      rewards.append(reward)
+      dones.append(done)
+      steps += 1
+
+    episode = {"actor": actor_id,
+               "observations": np.asarray(observations, dtype=np.float32),
+               "actions": np.asarray(actions, dtype=np.int64),
+               "rewards": np.asarray(rewards, dtype=np.float32),
+               "dones": np.asarray(dones, dtype=bool)}
+    while not stop.is_set():
+      try:
+        episodes.put(episode, timeout=1.0)
+        break
+      except queue.Full:
+        pass
+
+
+class ActorLearner:
+  """Trains an agent with actor processes collecting its experience.
+
+  Each actor process runs its own runtime created by `env_factory`, acts
+  with a copy of the online network and sends finished episodes to the
+  learner. The learner inserts them into the replay memory, learns at the
+  update interval of the agent and broadcasts its weights through shared
+  memory. `env_factory` has to be picklable, e.g. a module-level function.
+
+  The actors use constant epsilons following Ape-X unless the
+  `ActorEpsilons` param lists a [start, end, decay steps] schedule per
+  actor.
+  """
+  def __init__(self, agent, env_factory, params=None):
+    self.agent = agent
+    self.env_factory = env_factory
+    params = params or agent._params["ML"]["ActorLearner"]
+    self.num_actors = params["NumActors", "", 4]
+    self.actor_epsilons = params["ActorEpsilons", "", None] or \
+      ActorLearner.apex_epsilons(self.num_actors)
+    assert len(self.actor_epsilons) == self.num_actors
+    # in learning steps
+    self.broadcast_interval = params["WeightsBroadcastInterval", "", 100]
+    # in actor steps
+    self.pull_interval = params["WeightsPullInterval", "", 400]
+    self.queue_size = params["EpisodeQueueSize", "", 64]
+    self.seed = params["Seed", "", 0]
+
+  @staticmethod
+  def apex_epsilons(num_actors, epsilon=0.4, alpha=7.):
+    exponents = 1. + alpha * np.arange(num_actors) / max(1, num_actors - 1)
+    return [[float(e), float(e), 1] for e in epsilon**exponents]
+
+  def insert_episode(self, episode):
+    agent = self.agent
+    # NOTE: rows of the same array object let the memory store every
+    # observation only once.
+    observations = list(episode["observations"])
+    num_steps = len(episode["actions"])
+    for step in range(num_steps):
+      agent.store_transition(
+        observations[step], episode["actions"][step],
+        episode["rewards"][step], observations[step + 1],
+        bool(episode["dones"][step]), episode_done=step == num_steps - 1)
+      agent.steps += 1
+      agent.train_step_interval()
+      if agent.steps >= agent.start_steps and \
+          (self._published_learning_steps is None or
+           agent.learning_steps - self._published_learning_steps >=
+           self.broadcast_interval):
+        self.shared_weights.publish(agent.online_net)
+        self._published_learning_steps = agent.learning_steps
+
+    agent.episodes += 1
+    episode_return = float(np.sum(episode["rewards"]))
+    agent.train_return.append(episode_return)
+    if agent.episodes % agent.summary_log_interval == 0:
+      agent.metrics.add_scalar('return/train', agent.train_return.get(),
+                               4 * agent.steps)
+    agent.metrics.log(
+      'Episode: %-4d  actor: %-3d  episode steps: %-4d  return: %-5.1f',
+      agent.episodes, episode["actor"], num_steps, episode_return)
+
+  def run(self):
+    agent = self.agent
+    context = mp.get_context("spawn")
+    self.shared_weights = SharedWeights(agent.online_net, context)
+    self._published_learning_steps = None
+    episodes = context.Queue(maxsize=self.queue_size)
+    stop = context.Event()
+    actors = [context.Process(
+      target=run_actor,
+      args=(actor_id, self.env_factory, self.shared_weights, episodes, stop,
+            self.actor_epsilons[actor_id], agent.max_episode_steps,
+            agent.noisy_net, self.pull_interval, self.seed + actor_id),
+      daemon=True) for actor_id in range(self.num_actors)]
+    for actor in actors:
+      actor.start()
+
+    try:
+      agent.online_net.train()
+      agent.target_net.train()
+      while agent.steps <= agent.num_steps:
+        try:
+          episode = episodes.get(timeout=10.)
+        except queue.Empty:
+          if not any(actor.is_alive() for actor in actors):
+            raise RuntimeError("All actor processes terminated.")
+          continue
+        self.insert_episode(episode)
+    finally:
+      stop.set()
+      # Unblocks actors waiting for a free slot in the queue.
+      while True:
+        try:
+          episodes.get_nowait()
+        except queue.Empty:
+          break
+      for actor in actors:
+        actor.join(timeout=10.)
+        if actor.is_alive():
+          actor.terminate()
+    agent._set_action_externally = True
@@ -0,0 +1,105 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Patrick Hart, Julian Bernhard, Klemens Esterle, and
+# Tobias Kessler, Mansoor Nasir
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import copy
+from concurrent.futures import ProcessPoolExecutor, wait
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+class SnapshotAgent:
+  """Acts like the evaluated agent with the weights of a snapshot."""
+  def __init__(self, net, num_actions, epsilon_eval, random_actions,
+               best_eval_results=None):
+    self.net = net
+    self.num_actions = num_actions
+    self.epsilon_eval = epsilon_eval
+    self.random_actions = random_actions
+    # lets the benchmark stop evaluations worse than the best one
+    self.best_eval_results = best_eval_results
+
+  def is_random(self, eval=False):
+    if self.random_actions:
+      return True
+    return np.random.rand() < self.epsilon_eval
+
+  def explore(self):
+    return np.random.randint(self.num_actions)
+
+  def Act(self, state):
+    states = torch.from_numpy(np.asarray(state, dtype=np.float32)).unsqueeze(0)
+    with torch.no_grad():
+      return self.net(states=states).argmax().item()
+
+
+_worker_env = None
+
+def _init_worker(env_factory):
+  global _worker_env
+  torch.set_num_threads(1)
+  _worker_env = env_factory()
+
+def _run_benchmark(benchmark, snapshot_agent, num_episodes, max_episode_steps):
+  benchmark.reset(_worker_env, num_episodes, max_episode_steps, snapshot_agent)
+  return benchmark.run_episodes(num_episodes)
+
+
+class AsyncEvaluator:
+  """Evaluates snapshots of the online network in worker processes.
+
+  Each worker runs its share of the evaluation episodes with the training
+  benchmark in its own environment created by `env_factory`, which has to
+  be picklable. The shares add up to the agent's `num_eval_episodes`.
+  Training continues while the workers evaluate, finished evaluations are
+  returned by `completed` with their snapshot. Their results are
+  summarized once over the episodes of all workers, see
+  `TrainingBenchmark.run_episodes` and `TrainingBenchmark.summarize`.
+  """
+  def __init__(self, env_factory, num_workers):
+    self.num_workers = num_workers
+    self._executor = ProcessPoolExecutor(
+      max_workers=num_workers, mp_context=mp.get_context("spawn"),
+      initializer=_init_worker, initargs=(env_factory,))
+    self._pending = []
+
+  def submit(self, agent, benchmark, snapshot):
+    net = copy.deepcopy(agent.online_net).cpu()
+    net.load_state_dict(snapshot["online_net"])
+    net.eval()
+    snapshot_agent = SnapshotAgent(
+      net, agent.num_actions, agent.epsilon_eval,
+      random_actions=agent.steps < agent.start_steps,
+      best_eval_results=agent.best_eval_results)
+    # The benchmark is sent without the training environment and agent.
+    benchmark = copy.copy(benchmark)
+    benchmark.reset(None, None, None, None)
+    shares = [len(share) for share in np.array_split(
+      np.arange(agent.num_eval_episodes), self.num_workers) if len(share)]
+    futures = [self._executor.submit(
+      _run_benchmark, benchmark, snapshot_agent, share,
+      agent.max_episode_steps) for share in shares]
+    self._pending.append(
+      (agent.steps, snapshot, benchmark, agent.num_eval_episodes, futures))
+
+  def completed(self, wait_all=False):
+    # Yields (steps, snapshot, eval_results, formatted_result) of finished
+    # evaluations.
+    if wait_all:
+      wait([future for *_, futures in self._pending for future in futures])
+    while self._pending and all(future.done()
+                                for future in self._pending[0][-1]):
+      steps, snapshot, benchmark, num_episodes, futures = self._pending.pop(0)
+      episode_results = [episode_result for future in futures
+                         for episode_result in future.result()]
+      eval_results, formatted_result = benchmark.summarize(
+        episode_results, num_episodes)
+      yield steps, snapshot, eval_results, formatted_result
+
+  def close(self):
+    self._executor.shutdown(wait=True)
@@ -13,13 +13,25 @@ from torch.utils.tensorboard import SummaryWriter
 import torch
 import numpy as np
 import pickle
+import json
+import copy
+import math
 import os
 from abc import abstractmethod
 
 # BARK-ML imports
-from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.utils import RunningMeanStats, LinearAnneaer
-from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.memory import LazyMultiStepMemory, LazyPrioritizedMultiStepMemory
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.utils import RunningMeanStats, LinearAnneaer, \
+  update_params
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.memory import LazyMultiStepMemory, LazyPrioritizedMultiStepMemory, \
+  MemoryMappedMultiStepMemory, MemoryMappedPrioritizedMultiStepMemory, BatchPrefetcher
 from bark_ml.behaviors.discrete_behavior import BehaviorDiscreteMacroActionsML
+from bark_ml.commons.sequential_evaluation import SequentialEvaluation
+from bark_ml.commons.throughput import ThroughputMonitor
+from .actor_learner import ActorLearner
+from .async_evaluator import AsyncEvaluator
+from .checkpoint_writer import CheckpointWriter, atomic_save, \
+  remove_old_checkpoints
+from .metrics import MetricsLogger
 
 # BARK imports
 from bark.core.models.behavior import BehaviorModel
@@ -27,8 +39,21 @@ import logging
 
 def to_pickle(obj, dir, file):
   path = os.path.join(dir, file)
-  with open(path, 'wb') as handle:
+  with open(path + ".tmp", 'wb') as handle:
     pickle.dump(obj, handle, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(path + ".tmp", path)
+
+def to_json(obj, dir, file):
+  path = os.path.join(dir, file)
+  with open(path + ".tmp", 'w') as handle:
+    json.dump(obj, handle)
+  os.replace(path + ".tmp", path)
+
+def from_json(dir, file):
+  path = os.path.join(dir, file)
+  with open(path, 'r') as handle:
+    obj = json.load(handle)
+  return obj
 
 def from_pickle(dir, file):
   path = os.path.join(dir, file)
@@ -37,11 +62,18 @@ def from_pickle(dir, file):
   return obj
 
 class TrainingBenchmark:
-  def __init__(self):
+  def __init__(self, interval_width=None, confidence=0.95, min_episodes=30,
+               check_interval=10):
     self.training_env = None
     self.num_episodes = None
     self.max_episode_steps = None
     self.agent = None
+    # stops early once the confidence interval of the mean return is
+    # narrower than interval_width, see SequentialEvaluation
+    self.interval_width = interval_width
+    self.confidence = confidence
+    self.min_episodes = min_episodes
+    self.check_interval = check_interval
 
   def reset(self, training_env, num_episodes, max_episode_steps, agent):
     self.training_env = training_env
@@ -51,33 +83,69 @@ class TrainingBenchmark:
 
   def run(self):
     # returns dict with evaluated metrics
-    num_episodes = 0
-    total_return = 0.0
-
-    while True:
-      state = self.training_env.reset()
-      episode_steps = 0
-      episode_return = 0.0
-      done = False
-      while (not done) and episode_steps <= self.max_episode_steps:
-        if self.agent.is_random(eval=True):
-          action = self.agent.explore()
-        else:
-          action = self.agent.Act(state)
-
-        next_state, reward, done, _ = self.training_env.step(action)
-        episode_steps += 1
-        episode_return += reward
-        state = next_state
+    max_episodes = self.num_episodes + 1
+    return self.summarize(self.run_episodes(max_episodes), max_episodes)
 
-      num_episodes += 1
-      total_return += episode_return
-
-      if num_episodes > self.num_episodes:
-        break
+  def run_episode(self):
+    # returns dict with the metrics of a single episode
+    state = self.training_env.reset()
+    episode_steps = 0
+    episode_return = 0.0
+    done = False
+    while (not done) and episode_steps <= self.max_episode_steps:
+      if self.agent.is_random(eval=True):
+        action = self.agent.explore()
+      else:
+        action = self.agent.Act(state)
 
-    mean_return = total_return / num_episodes
-    return {"mean_return" : mean_return}, f"Mean return: {mean_return}"
+      next_state, reward, done, _ = self.training_env.step(action)
+      episode_steps += 1
+      episode_return += reward
+      state = next_state
+    return {"mean_return": episode_return}
+
+  def run_episodes(self, max_episodes):
+    # returns the metrics of each episode, the episodes stop early once
+    # the sequential evaluation allows it
+    sequential = self.sequential_evaluation(max_episodes)
+    best_values = None
+    best_eval_results = getattr(self.agent, "best_eval_results", None)
+    if best_eval_results:
+      best_values = {"mean_return": best_eval_results["mean_return"]}
+
+    episode_results = []
+    while len(episode_results) < max_episodes:
+      episode_results.append(self.run_episode())
+      if sequential is not None:
+        sequential.Update(episode_results[-1])
+        if sequential.ShouldStop(best_values):
+          break
+    return episode_results
+
+  def sequential_evaluation(self, max_episodes):
+    if not self.interval_width:
+      return None
+    return SequentialEvaluation(
+      max_episodes, {"mean_return": self.interval_width},
+      confidence=self.confidence, min_episodes=self.min_episodes,
+      check_interval=self.check_interval)
+
+  def summarize(self, episode_results, max_episodes):
+    # returns dict with evaluated metrics of all episodes, also of
+    # episodes run in different processes
+    num_episodes = len(episode_results)
+    mean_return = sum(result["mean_return"]
+                      for result in episode_results) / num_episodes
+    sequential = self.sequential_evaluation(max_episodes)
+    if sequential is None:
+      return {"mean_return" : mean_return}, f"Mean return: {mean_return}"
+    for result in episode_results:
+      sequential.Update(result)
+    eval_results = sequential.Summary()
+    return eval_results, f"Mean return: {mean_return} " + \
+      f"[{eval_results['mean_return_ci_low']}, " + \
+      f"{eval_results['mean_return_ci_high']}] " + \
+      f"({num_episodes} episodes)"
 
   def is_better(self, eval_result1, than_eval_result2):
     return eval_result1["mean_return"] > than_eval_result2["mean_return"]
@@ -105,6 +173,7 @@ class BaseAgent(BehaviorModel):
       self.load_pickable_members(agent_save_dir)
       self.load_other()
       self.init_always()
+      self.load_memory(BaseAgent.memory_directory(agent_save_dir))
       self.load_models(BaseAgent.check_point_directory(agent_save_dir, checkpoint_load))
     else:
       raise ValueError("Unusual param combination for agent initialization.")
@@ -115,6 +184,19 @@ class BaseAgent(BehaviorModel):
 
     logging.info(f"Summary writer directory: {os.path.abspath(BaseAgent.summary_dir(self.agent_save_dir))}")
     self.writer = SummaryWriter(log_dir=BaseAgent.summary_dir(self.agent_save_dir))
+    # the training loops record their metrics and logs only through it
+    self.metrics = MetricsLogger(
+      self.writer,
+      flush_interval=getattr(self, "metrics_flush_interval", 10.),
+      flush_records=getattr(self, "metrics_flush_records", 10000))
+    # wall time of the training phases, see log_throughput
+    self.throughput = ThroughputMonitor()
+    # state of the running update, see update
+    self._update_batch = None
+    self._update_offset = 0
+    self._update_errors = None
+    self._micro_batch = 0
+    self._learning_rates_scaled = False
     self.train_return = RunningMeanStats(self.summary_log_interval)
 
     if not os.path.exists(BaseAgent.summary_dir(self.agent_save_dir)):
@@ -125,6 +207,12 @@ class BaseAgent(BehaviorModel):
     self._set_action_externally = False
     self._training_benchmark.reset(self._env, \
         self.num_eval_episodes, self.max_episode_steps, self)
+    self._prefetcher = None
+    self._inference_net = None
+    self._inference_input = None
+    self._async_evaluator = None
+    self._checkpoint_writer = CheckpointWriter() \
+      if getattr(self, "async_checkpoints", False) else None
 
   def reset_action_observer(self, env):
     self._observer = self._env._observer
@@ -139,6 +227,18 @@ class BaseAgent(BehaviorModel):
     del pickables["_checkpoint_load"]
     del pickables["device"]
     del pickables["writer"]
+    del pickables["metrics"]
+    del pickables["throughput"]
+    del pickables["_update_batch"]
+    del pickables["_update_errors"]
+    del pickables["_learning_rates_scaled"]
+    # the replay memory is checkpointed separately, see save_memory
+    del pickables["memory"]
+    del pickables["_prefetcher"]
+    del pickables["_inference_net"]
+    del pickables["_inference_input"]
+    del pickables["_async_evaluator"]
+    del pickables["_checkpoint_writer"]
 
 
   def save_pickable_members(self, pickable_dir):
@@ -146,10 +246,19 @@ class BaseAgent(BehaviorModel):
       os.makedirs(pickable_dir)
     pickables = dict(self.__dict__)
     self.clean_pickables(pickables)
+    # scalar members, e.g. step counters, go into a small readable manifest
+    manifest = {key: value for key, value in pickables.items()
+                if type(value) in (bool, int, float, str, type(None))}
+    for key in manifest:
+      del pickables[key]
     to_pickle(pickables, pickable_dir, "agent_pickables")
+    to_json(manifest, pickable_dir, "agent_manifest.json")
 
   def load_pickable_members(self, agent_save_dir):
-    pickables = from_pickle(BaseAgent.pickable_directory(agent_save_dir), "agent_pickables")
+    pickable_dir = BaseAgent.pickable_directory(agent_save_dir)
+    pickables = from_pickle(pickable_dir, "agent_pickables")
+    if os.path.exists(os.path.join(pickable_dir, "agent_manifest.json")):
+      pickables.update(from_json(pickable_dir, "agent_manifest.json"))
     try:
       del pickables["_agent_save_dir"]
       del pickables["base_demonstrations_dir"]
@@ -157,36 +266,140 @@ class BaseAgent(BehaviorModel):
       pass
     self.__dict__.update(pickables)
 
+  def save_memory(self, memory_dir):
+    # Only the transitions added since the last save are written, see
+    # LazyMemory.checkpoint.
+    memory = getattr(self, "memory", None)
+    if memory is None:
+      return
+    if self._prefetcher is not None:
+      with self._prefetcher.lock:
+        memory.checkpoint(memory_dir)
+    else:
+      memory.checkpoint(memory_dir)
+
+  def load_memory(self, memory_dir):
+    if getattr(self, "memory_mapped", False) and \
+        os.path.exists(os.path.join(memory_dir, "memory.json")):
+      self.init_memory(reattach=True)
+    elif os.path.exists(os.path.join(memory_dir, "manifest.json")):
+      self.init_memory()
+      self.memory.restore(memory_dir)
+
   def load_other(self):
     pass
 
   def reset_training_variables(self):
+    self.init_memory()
+    self.steps = 0
+    self.learning_steps = 0
+    self.episodes = 0
+    self.best_eval_results = None
+
+  def init_memory(self, reattach=False):
+    self.close_prefetcher()
     # Replay memory which is memory-efficient to store stacked frames.
+    observation_space = self.observer.observation_space
+    state_bounds = (observation_space.low, observation_space.high)
+    # Memory-mapped memories keep their columns in the agent directory.
+    memory_args = (BaseAgent.memory_directory(self.agent_save_dir),) \
+      if self.memory_mapped else ()
+    memory_kwargs = {"reattach": reattach} if self.memory_mapped else {}
     if self.use_per:
       beta_steps = (self.num_steps - self.start_steps) / \
              self.update_interval
-      self.memory = LazyPrioritizedMultiStepMemory(
+      memory_type = MemoryMappedPrioritizedMultiStepMemory \
+        if self.memory_mapped else LazyPrioritizedMultiStepMemory
+      self.memory = memory_type(
+          *memory_args,
           self.memory_size,
           self.observer.observation_space.shape,
           self.device,
           self.gamma,
           self.multi_step,
-          beta_steps=beta_steps)
+          beta_steps=beta_steps,
+          state_dtype=self.memory_state_dtype,
+          state_bounds=state_bounds,
+          **memory_kwargs)
     else:
-      self.memory = LazyMultiStepMemory(
+      memory_type = MemoryMappedMultiStepMemory \
+        if self.memory_mapped else LazyMultiStepMemory
+      self.memory = memory_type(
+          *memory_args,
           self.memory_size,
           self.observer.observation_space.shape,
           self.device,
           self.gamma,
-          self.multi_step)
+          self.multi_step,
+          state_dtype=self.memory_state_dtype,
+          state_bounds=state_bounds,
+          **memory_kwargs)
+
+  def store_transition(self, *args, **kwargs):
+    with self.throughput.Time("store"):
+      if self._prefetcher is not None:
+        self._prefetcher.append(*args, **kwargs)
+      else:
+        self.memory.append(*args, **kwargs)
+
+  def sample_transitions(self):
+    # Returns the sampled batch and the importance sampling weights of PER,
+    # during an update the next micro-batch of the update batch.
+    if self._update_batch is not None:
+      return self.next_micro_batch()
+    with self.throughput.Time("sample"):
+      if self.prefetch_batches:
+        if self._prefetcher is None:
+          self._prefetcher = BatchPrefetcher(
+            self.memory, self.update_sample_size, self.prefetch_depth)
+        batch = self._prefetcher.get()
+      else:
+        batch = self.memory.sample(self.update_sample_size)
+    return batch if self.use_per else (batch, None)
+
+  def next_micro_batch(self):
+    # Slices the next `batch_size` transitions of the update batch.
+    (batch, weights), start = self._update_batch, self._update_offset
+    end = start + self.batch_size
+    self._update_offset = end
+    return tuple(value[start:end] for value in batch), \
+      None if weights is None else weights[start:end]
+
+  def update_priority(self, errors):
+    if self._update_errors is not None:
+      # PER uses the first error of every sampled transition, see
+      # LazyPrioritizedMultiStepMemory.update_priority
+      self._update_errors.append(errors.flatten()[:self.batch_size])
+      return
+    if self._prefetcher is not None:
+      self._prefetcher.update_priority(errors)
+    else:
+      self.memory.update_priority(errors)
 
-    self.steps = 0
-    self.learning_steps = 0
-    self.episodes = 0
-    self.best_eval_results = None
+  def close_prefetcher(self):
+    if getattr(self, "_prefetcher", None) is not None:
+      self._prefetcher.close()
+    self._prefetcher = None
+
+  def set_multi_step(self, multi_step):
+    # the memory computes the n-step returns when sampling and is kept
+    self.close_prefetcher()
+    self.multi_step = multi_step
+    self.memory.multi_step = multi_step
 
   def reset_params(self, params):
     self.num_steps = params["NumSteps", "", 5000000]
+    # Update-to-data ratio: every update takes GradientStepsPerUpdate
+    # gradient steps on effective_batch_size transitions each, i.e. on
+    # LargeBatchFactor * GradientAccumulationSteps accumulated micro-batches
+    # of BatchSize transitions. The learning rates are scaled with the
+    # effective batch size by LearningRateScaling ("linear", "sqrt" or
+    # "none").
+    self.gradient_steps_per_update = params["GradientStepsPerUpdate", "", 1]
+    self.large_batch_factor = params["LargeBatchFactor", "", 1]
+    self.gradient_accumulation_steps = params["GradientAccumulationSteps", "", 1]
+    self.learning_rate_scaling = params["LearningRateScaling", "", "linear"]
+    # the size of the micro-batches passed through the networks
     self.batch_size = params["BatchSize", "", 32]
 
     self.double_q_learning = params["Double_q_learning", "", False]
@@ -199,8 +412,6 @@ class BaseAgent(BehaviorModel):
     self.eval_interval = params["EvalInterval", "", 25000]
     self.num_eval_episodes = params["NumEvalEpisodes", "",
                                                           12500]
-    self.gamma_n = params["Gamma", "", 0.99] ** \
-        params["Multi_step", "", 1]
 
     self.start_steps = params["StartSteps", "", 5000]
     self.epsilon_train = LinearAnneaer(
@@ -214,10 +425,33 @@ class BaseAgent(BehaviorModel):
     self.grad_cliping = params["GradCliping", "", 5.0]
 
     self.memory_size = params["MemorySize", "", 10**6]
+    # float32, float16 or an integer dtype (e.g. int8, uint16) that
+    # quantizes the observations between the observation space bounds
+    self.memory_state_dtype = params["MemoryStateDtype", "", "float32"]
+    # stores the replay memory in memory-mapped files of the agent directory
+    self.memory_mapped = params["MemoryMapped", "", False]
+    # samples the batches in a background thread while acting and learning
+    self.prefetch_batches = params["PrefetchBatches", "", False]
+    self.prefetch_depth = params["PrefetchDepth", "", 2]
     self.gamma = params["Gamma", "", 0.99]
     self.multi_step = params["Multi_step", "", 1]
 
     self.use_cuda = params["Cuda", "", False] 
+    # intra-op threads of the inference mode, 0 keeps the torch default
+    self.inference_threads = params["InferenceThreads", "", 0]
+    # worker processes of the asynchronous evaluation
+    self.num_eval_workers = params["NumEvalWorkers", "", 4]
+    # serializes and writes the checkpoints in a background thread
+    self.async_checkpoints = params["AsyncCheckpoints", "", False]
+    # additionally keeps the checkpoints of the last evaluations as
+    # step_<steps>, 0 disables them
+    self.checkpoints_to_keep = params["CheckpointsToKeep", "", 0]
+    # the metrics are written in the background after this many seconds
+    # or pending records
+    self.metrics_flush_interval = params["MetricsFlushInterval", "", 10.]
+    self.metrics_flush_records = params["MetricsFlushRecords", "", 10000]
+    # in steps, writes the throughput and the time shares of the phases
+    self.throughput_log_interval = params["ThroughputLogInterval", "", 10000]
 
   @property
   def observer(self):
@@ -245,8 +479,17 @@ class BaseAgent(BehaviorModel):
       self.train_episode()
       if self.steps > self.num_steps:
         break
+    if self._async_evaluator is not None:
+      self.collect_evaluations(wait_all=True)
+    self.flush_checkpoints()
+    # stops the flush thread, recording afterwards starts it again
+    self.metrics.close()
     self._set_action_externally = True
 
+  def run_distributed(self, env_factory):
+    # actor processes collect the experience, see ActorLearner
+    ActorLearner(self, env_factory).run()
+
   def is_update(self):
     return self.steps % self.update_interval == 0 \
         and self.steps >= self.start_steps
@@ -269,6 +512,51 @@ class BaseAgent(BehaviorModel):
     action = self.ml_behavior.action_space.sample()
     return action
 
+  def random_rows(self, num_rows, eval=False):
+    # Vectorized is_random, drawn independently for every row.
+    if self.steps < self.start_steps:
+      return np.ones(num_rows, dtype=bool)
+    if eval:
+      return np.random.rand(num_rows) < self.epsilon_eval
+    if self.noisy_net:
+      return np.zeros(num_rows, dtype=bool)
+    return np.random.rand(num_rows) < self.epsilon_train.get()
+
+  def ExploreBatch(self, num_actions):
+    # Uniformly random actions of the discrete action space.
+    return np.random.randint(self.num_actions, size=num_actions)
+
+  def ActBatch(self, states, epsilons=None, eval=False):
+    """Epsilon-greedy actions for a batch of states.
+
+    The greedy actions of all rows are calculated in one forward pass.
+    Each row acts randomly with its own epsilon of `epsilons` or, if not
+    given, as decided by is_random. Takes a (batch, observation) array
+    and returns an array of actions.
+    """
+    states = np.asarray(states, dtype=np.float32)
+    if epsilons is None:
+      random_rows = self.random_rows(len(states), eval=eval)
+    else:
+      random_rows = np.random.rand(len(states)) < epsilons
+    if random_rows.all():
+      return self.ExploreBatch(len(states))
+
+    if self._inference_net is not None:
+      with torch.inference_mode():
+        action_values = self._inference_net(
+          torch.from_numpy(states).to(self.device))
+    else:
+      # NOTE: the noise is sampled once per batch, as for a single action.
+      if self.noisy_net and not eval:
+        self.online_net.sample_noise()
+      with torch.no_grad():
+        action_values = self.online_net(
+          states=torch.from_numpy(states).to(self.device))
+    actions = action_values.argmax(dim=1).cpu().numpy()
+    actions[random_rows] = self.ExploreBatch(np.count_nonzero(random_rows))
+    return actions
+
   @property
   def set_action_externally(self):
     return self._set_action_externally
@@ -287,7 +575,31 @@ class BaseAgent(BehaviorModel):
     actions = self.calculate_actions(state).argmax().item()
     return actions
 
+  def enable_inference_mode(self, num_threads=None):
+    """Acts with a frozen and optimized TorchScript copy of the online net.
+
+    The copy holds the current weights and is dropped when training
+    continues. States are copied into a preallocated input buffer.
+    """
+    num_threads = num_threads or getattr(self, "inference_threads", 0)
+    if num_threads:
+      torch.set_num_threads(num_threads)
+    self.online_net.eval()
+    frozen_net = torch.jit.freeze(torch.jit.script(self.online_net))
+    self._inference_net = torch.jit.optimize_for_inference(frozen_net)
+    self._inference_input = torch.zeros(
+      (1, *self.observer.observation_space.shape), device=self.device)
+
+  def disable_inference_mode(self):
+    self._inference_net = None
+    self._inference_input = None
+
   def calculate_actions(self, state):
+    if self._inference_net is not None:
+      with torch.inference_mode():
+        self._inference_input[0].copy_(
+          torch.from_numpy(np.asarray(state, dtype=np.float32)))
+        return self._inference_net(self._inference_input)
     # Act without randomness.
     state = torch.Tensor(state).unsqueeze(0).to(self.device).float()
     with torch.no_grad():
@@ -315,6 +627,84 @@ class BaseAgent(BehaviorModel):
   def learn(self):
     pass
 
+  @property
+  def micro_batches_per_step(self):
+    return self.large_batch_factor * self.gradient_accumulation_steps
+
+  @property
+  def effective_batch_size(self):
+    # the transitions of one gradient step
+    return self.batch_size * self.micro_batches_per_step
+
+  @property
+  def update_sample_size(self):
+    return self.effective_batch_size * self.gradient_steps_per_update
+
+  def optimizers(self):
+    # the optimizers whose learning rates are scaled, see
+    # scale_learning_rates
+    return [self.optim]
+
+  def update(self):
+    """Takes the gradient steps of an update.
+
+    The transitions of all gradient steps are sampled at once, `learn`
+    then gets its micro-batch from `sample_transitions` and applies its
+    losses with `update_params`. With PER, the priorities are updated
+    after the last gradient step.
+    """
+    self.scale_learning_rates()
+    if self.update_sample_size == self.batch_size:
+      self.learning_steps += 1
+      self.learn()
+      return
+
+    self._update_batch = self.sample_transitions()
+    self._update_offset = 0
+    self._update_errors = [] if self.use_per else None
+    try:
+      for _ in range(self.gradient_steps_per_update):
+        self.learning_steps += 1
+        for micro_batch in range(self.micro_batches_per_step):
+          self._micro_batch = micro_batch
+          self.learn()
+    finally:
+      errors = self._update_errors
+      self._update_batch = None
+      self._update_errors = None
+      self._micro_batch = 0
+    if errors:
+      self.update_priority(torch.cat(errors))
+
+  def update_params(self, optim, loss, networks, retain_graph=False,
+                    grad_cliping=None):
+    # Steps the optimizer after the last accumulated micro-batch.
+    num_micro_batches = self.micro_batches_per_step
+    if num_micro_batches == 1:
+      update_params(optim, loss, networks, retain_graph, grad_cliping)
+      return
+    if self._micro_batch == 0:
+      optim.zero_grad()
+    (loss / num_micro_batches).backward(retain_graph=retain_graph)
+    if self._micro_batch == num_micro_batches - 1:
+      if grad_cliping:
+        for net in networks:
+          torch.nn.utils.clip_grad_norm_(net.parameters(), grad_cliping)
+      optim.step()
+
+  def scale_learning_rates(self):
+    # Scales the learning rates of the optimizers once after their creation.
+    if self._learning_rates_scaled:
+      return
+    self._learning_rates_scaled = True
+    ratio = self.effective_batch_size / self.batch_size
+    factor = {"linear": ratio,
+              "sqrt": math.sqrt(ratio),
+              "none": 1.}[self.learning_rate_scaling]
+    for optim in self.optimizers():
+      for group in optim.param_groups:
+        group["lr"] *= factor
+
   def Clone(self):
     return self
 
@@ -334,15 +724,48 @@ class BaseAgent(BehaviorModel):
   def summary_dir(agent_save_dir):
     return os.path.join(agent_save_dir, "summaries")
 
-  def save_models(self, checkpoint_dir):
-    if not os.path.exists(checkpoint_dir):
-      os.makedirs(checkpoint_dir)
-    torch.save(self.online_net.state_dict(),
-               os.path.join(checkpoint_dir, 'online_net.pth'))
-    torch.save(self.target_net.state_dict(),
-               os.path.join(checkpoint_dir, 'target_net.pth'))
-    online_net_script = torch.jit.script(self.online_net)
-    online_net_script.save(os.path.join(checkpoint_dir, 'online_net_script.pt'))
+  @staticmethod
+  def memory_directory(agent_save_dir):
+    return os.path.join(agent_save_dir, "memory")
+
+  def snapshot_models(self):
+    # Copies of the current weights to evaluate or save later.
+    return {name: {key: value.detach().cpu().clone() for key, value in
+                   getattr(self, name).state_dict().items()}
+            for name in ["online_net", "target_net"] if hasattr(self, name)}
+
+  def save_models(self, checkpoint_dir, snapshot=None):
+    if snapshot is None and self._checkpoint_writer is not None:
+      snapshot = self.snapshot_models()
+    online_net = self.online_net
+    if snapshot is not None:
+      online_net = copy.deepcopy(self.online_net)
+      online_net.load_state_dict(snapshot["online_net"])
+    target_state = snapshot["target_net"] if snapshot is not None \
+      else self.target_net.state_dict()
+
+    def write():
+      os.makedirs(checkpoint_dir, exist_ok=True)
+      atomic_save(lambda path: torch.save(online_net.state_dict(), path),
+                  os.path.join(checkpoint_dir, 'online_net.pth'))
+      atomic_save(lambda path: torch.save(target_state, path),
+                  os.path.join(checkpoint_dir, 'target_net.pth'))
+      atomic_save(lambda path: torch.jit.script(online_net).save(path),
+                  os.path.join(checkpoint_dir, 'online_net_script.pt'))
+    self.write_checkpoint(write)
+
+  def write_checkpoint(self, write):
+    # Runs `write` in the background with AsyncCheckpoints, it must only
+    # use snapshots of the weights.
+    if getattr(self, "_checkpoint_writer", None) is not None:
+      self._checkpoint_writer.submit(write)
+    else:
+      write()
+
+  def flush_checkpoints(self):
+    # Waits until the submitted checkpoints are written.
+    if getattr(self, "_checkpoint_writer", None) is not None:
+      self._checkpoint_writer.flush()
 
   def get_script_filename(self, checkpoint_load=None):
     if not checkpoint_load:
@@ -350,15 +773,19 @@ class BaseAgent(BehaviorModel):
     checkpoint_dir = BaseAgent.check_point_directory(self._agent_save_dir, checkpoint_load)
     return os.path.join(checkpoint_dir, 'online_net_script.pt')
 
-  def save_in_dir(self, agent_save_dir, checkpoint_type):
+  def save_in_dir(self, agent_save_dir, checkpoint_type, snapshot=None):
     self._agent_save_dir = agent_save_dir
-    self.save_models(BaseAgent.check_point_directory(agent_save_dir, checkpoint_type))
+    self.save_models(BaseAgent.check_point_directory(agent_save_dir, checkpoint_type),
+                     snapshot=snapshot)
     self.save_pickable_members(BaseAgent.pickable_directory(agent_save_dir))
+    self.save_memory(BaseAgent.memory_directory(agent_save_dir))
 
-  def save(self, checkpoint_type="last"):
-    self.save_in_dir(self.agent_save_dir, checkpoint_type)
+  def save(self, checkpoint_type="last", snapshot=None):
+    with self.throughput.Time("checkpoint"):
+      self.save_in_dir(self.agent_save_dir, checkpoint_type, snapshot=snapshot)
 
   def load_models(self, checkpoint_dir):
+    self.flush_checkpoints()
     try: 
       self.online_net.load_state_dict(
         torch.load(os.path.join(checkpoint_dir, 'online_net.pth')))
@@ -385,6 +812,8 @@ class BaseAgent(BehaviorModel):
         state = next_state
 
   def train_episode(self):
+    # the frozen inference net would act with outdated weights
+    self.disable_inference_mode()
     self.online_net.train()
     self.target_net.train()
 
@@ -399,20 +828,23 @@ class BaseAgent(BehaviorModel):
       # NOTE: Noises can be sampled only after self.learn(). However, I
       # sample noises before every action, which seems to lead better
       # performances.
-      self.online_net.sample_noise()
-
-      if self.is_random(eval=False):
-        action = self.explore()
-      else:
-        action = self.Act(state)
+      with self.throughput.Time("act"):
+        self.online_net.sample_noise()
+        if self.is_random(eval=False):
+          action = self.explore()
+        else:
+          action = self.Act(state)
 
-      next_state, reward, done, _ = self.env.step(action)
+      with self.throughput.Time("env"):
+        next_state, reward, done, _ = self.env.step(action)
       if self.episodes % self.reward_log_interval == 0:
         # self.env.render()
-        logging.info(f"Reward: {reward:<4}")
+        self.metrics.log("Reward: %-4s", reward)
 
       # To calculate efficiently, I just set priority=max_priority here.
-      self.memory.append(state, action, reward, next_state, done)
+      episode_done = done or episode_steps + 1 > self.max_episode_steps
+      self.store_transition(state, action, reward, next_state, done,
+                            episode_done=episode_done)
 
       self.steps += 1
       episode_steps += 1
@@ -426,49 +858,107 @@ class BaseAgent(BehaviorModel):
 
     # We log evaluation results along with training frames = 4 * steps.
     if self.episodes % self.summary_log_interval == 0:
-      self.writer.add_scalar('return/train', self.train_return.get(),
-                             4 * self.steps)
+      self.metrics.add_scalar('return/train', self.train_return.get(),
+                              4 * self.steps)
 
-    logging.info(f'Episode: {self.episodes:<4}  '
-          f'episode steps: {episode_steps:<4}  '
-          f'return: {episode_return:<5.1f}')
+    self.metrics.log('Episode: %-4d  episode steps: %-4d  return: %-5.1f',
+                     self.episodes, episode_steps, episode_return)
 
   def train_step_interval(self):
     self.epsilon_train.step()
+    self.throughput.Count("steps")
 
     if self.steps % self.target_update_interval == 0:
-      self.update_target()
+      with self.throughput.Time("target_update"):
+        self.update_target()
 
     if self.is_update():
-      self.learn()
+      with self.throughput.Time("update"):
+        self.update()
+      self.throughput.Count("updates")
+
+    if self._async_evaluator is not None:
+      with self.throughput.Time("eval"):
+        self.collect_evaluations()
 
     if self.steps % self.eval_interval == 0:
-      self.evaluate()
+      with self.throughput.Time("eval"):
+        self.evaluate()
       self.save("final")
+      if self.checkpoints_to_keep > 0:
+        self.save_step_checkpoint()
       self.online_net.train()
 
+    if self.steps % self.throughput_log_interval == 0:
+      self.log_throughput()
+
+  def log_throughput(self, step=None):
+    # Writes the throughput since the last call, e.g. throughput/steps_per_sec
+    # and throughput/share/env, `self.throughput.Summary()` returns it as dict.
+    step = 4 * self.steps if step is None else step
+    for name, value in self.throughput.Summary(reset=True).items():
+      self.metrics.add_scalar(f"throughput/{name}", value, step)
+
+  def save_step_checkpoint(self):
+    # Only the newest `checkpoints_to_keep` step checkpoints are kept.
+    checkpoints_dir = BaseAgent.check_point_directory(self.agent_save_dir, "")
+    with self.throughput.Time("checkpoint"):
+      self.save_models(os.path.join(checkpoints_dir, f"step_{self.steps}"))
+      self.write_checkpoint(lambda: remove_old_checkpoints(
+        checkpoints_dir, "step_", self.checkpoints_to_keep))
+
   def raw_evaluation_score(self):
     self.online_net.eval()
     eval_results, _ = self._training_benchmark.run()
     return eval_results
 
 
+  def enable_async_evaluation(self, env_factory, num_workers=None):
+    """Evaluates in worker processes while training continues.
+
+    The workers evaluate snapshots of the online network, each in its
+    own environment created by the picklable `env_factory`.
+    """
+    self.disable_async_evaluation()
+    self._async_evaluator = AsyncEvaluator(
+      env_factory, num_workers or self.num_eval_workers)
+
+  def disable_async_evaluation(self):
+    # Waits for the pending evaluations.
+    if self._async_evaluator is not None:
+      self.collect_evaluations(wait_all=True)
+      self._async_evaluator.close()
+    self._async_evaluator = None
+
+  def collect_evaluations(self, wait_all=False):
+    for steps, snapshot, eval_results, formatted_result in \
+        self._async_evaluator.completed(wait_all=wait_all):
+      self.report_evaluation(eval_results, formatted_result, steps, snapshot)
+
   def evaluate(self):
     if not self._training_benchmark:
       logging.info("No evaluation performed since no training benchmark available.")
       return
+    if self._async_evaluator is not None:
+      self._async_evaluator.submit(self, self._training_benchmark,
+                                   self.snapshot_models())
+      return
     self.online_net.eval()
     
     eval_results, formatted_result = self._training_benchmark.run()
+    self.report_evaluation(eval_results, formatted_result, self.steps)
 
+  def report_evaluation(self, eval_results, formatted_result, steps,
+                        snapshot=None):
+    # Results of asynchronous evaluations arrive with the evaluated snapshot.
     if not self.best_eval_results or \
         self._training_benchmark.is_better(eval_results, self.best_eval_results):
       self.best_eval_results = eval_results
-      self.save("best")
+      self.save("best", snapshot=snapshot)
 
     # We log evaluation results along with training frames = 4 * steps.
     for eval_result_name, eval_result in eval_results.items():
-      self.writer.add_scalar(eval_result_name, eval_result, 4 * self.steps)
+      self.metrics.add_scalar(eval_result_name, eval_result, 4 * steps)
     logging.info('-' * 60)
     logging.info('Evaluation result: {}'.format(formatted_result))
     logging.info('-' * 60)
@@ -0,0 +1,75 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Patrick Hart, Julian Bernhard, Klemens Esterle, and
+# Tobias Kessler, Mansoor Nasir
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import os
+import queue
+import shutil
+import threading
+
+
+def atomic_save(save, path):
+  # The file is either complete or keeps its previous content.
+  save(path + ".tmp")
+  os.replace(path + ".tmp", path)
+
+
+def remove_old_checkpoints(directory, prefix, max_to_keep):
+  """Keeps the `max_to_keep` checkpoints `prefix`<step> with the most steps."""
+  if not os.path.exists(directory):
+    return
+  names = [name for name in os.listdir(directory) if name.startswith(prefix)
+           and name[len(prefix):].isdigit()]
+  names.sort(key=lambda name: int(name[len(prefix):]))
+  for name in names[:max(0, len(names) - max_to_keep)]:
+    shutil.rmtree(os.path.join(directory, name))
+
+
+class CheckpointWriter:
+  """Runs checkpoint writing jobs in a background thread.
+
+  The jobs run in the order they were submitted. They must only use
+  snapshots of the weights, which are taken before submitting, since
+  training continues meanwhile. An error of a job is raised by the next
+  call of `submit` or `flush`.
+  """
+  def __init__(self):
+    self._jobs = queue.Queue()
+    self._error = None
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    while True:
+      job = self._jobs.get()
+      try:
+        if job is None:
+          return
+        job()
+      except Exception as error:
+        self._error = error
+      finally:
+        self._jobs.task_done()
+
+  def _raise_error(self):
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error
+
+  def submit(self, job):
+    self._raise_error()
+    self._jobs.put(job)
+
+  def flush(self):
+    # Waits until all submitted checkpoints are written.
+    self._jobs.join()
+    self._raise_error()
+
+  def close(self):
+    self.flush()
+    self._jobs.put(None)
+    self._thread.join()
@@ -1,3 +1,4 @@
-
 from .demonstration_collector import DemonstrationCollector
-from .demonstration_collector import ActionValuesCollector
\ No newline at end of file
+from .demonstration_collector import ActionValuesCollector
+from .demonstration_dataset import DemonstrationDataset
+from .demonstration_store import DemonstrationStore
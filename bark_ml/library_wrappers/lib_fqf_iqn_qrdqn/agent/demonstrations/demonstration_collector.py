@@ -7,8 +7,13 @@
 # https://opensource.org/licenses/MIT
 
 import logging
+import multiprocessing as mp
 import pickle
 import os
+import shutil
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
 from bark.runtime.commons.parameters import ParameterServer
@@ -21,6 +26,8 @@ from bark.benchmark.benchmark_runner import BenchmarkRunner, BehaviorConfig
 from bark.benchmark.benchmark_runner_mp import BenchmarkRunnerMP
 
 from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent.util import *
+from .demonstration_dataset import DemonstrationDataset
+from .demonstration_store import DemonstrationStore
 
 
 def to_pickle(obj, dir, file):
@@ -34,6 +41,110 @@ def from_pickle(dir, file):
     obj = pickle.load(handle)
   return obj
 
+def _append_shard(collector, data_frame, store_directory, order):
+  store = DemonstrationStore(store_directory, chunk_rows=float("inf"))
+  collector.AppendCollectedRows(store, data_frame)
+  store.Flush(order)
+
+_shard_worker_args = None
+
+def _init_shard_worker(collector, data_frame, store_directory):
+  # Forked workers inherit the collector and the data frame, pickling the
+  # data frame takes longer than converting it.
+  global _shard_worker_args
+  _shard_worker_args = (collector, data_frame, store_directory)
+
+def _append_worker_shard(order, start, stop):
+  collector, data_frame, store_directory = _shard_worker_args
+  _append_shard(collector, data_frame.iloc[start:stop], store_directory, order)
+
+
+class ScenarioClaims:
+  """Claims scenarios for one of the processes collecting into a directory.
+
+  A claim is a file created exclusively that names its process. Claims
+  of processes that no longer run on this host or are older than
+  `timeout` seconds are considered abandoned and can be taken over, so
+  the timeout must exceed the time to collect a shard. Taking over holds
+  an exclusive lock file of the claim and only removes the claim if it
+  is still the one judged abandoned.
+  """
+  def __init__(self, directory, timeout=3600.):
+    self._directory = directory
+    self._timeout = timeout
+    self._owner = f"{socket.gethostname()}:{os.getpid()}"
+    os.makedirs(directory, exist_ok=True)
+
+  def _ReadClaim(self, path):
+    # (owner, modification time) of a claim, None if not claimed
+    try:
+      with open(path) as file:
+        owner = file.read()
+      return owner, os.path.getmtime(path)
+    except FileNotFoundError:
+      return None
+
+  def IsAbandoned(self, claim):
+    owner, mtime = claim
+    if time.time() - mtime >= self._timeout:
+      return True
+    host, _, pid = owner.rpartition(":")
+    if owner == self._owner:
+      # left by an interrupted collection of this process
+      return True
+    if host != socket.gethostname():
+      return False
+    try:
+      os.kill(int(pid), 0)
+    except ProcessLookupError:
+      return True
+    except (PermissionError, ValueError):
+      pass
+    return False
+
+  def _TakeOver(self, path, claim):
+    lock_path = path + ".takeover"
+    try:
+      lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+      # another process is taking over, a crashed one leaves its lock
+      # until the timeout
+      try:
+        if time.time() - os.path.getmtime(lock_path) >= self._timeout:
+          os.remove(lock_path)
+      except FileNotFoundError:
+        pass
+      return False
+    os.close(lock)
+    try:
+      # another process may have taken over since judging the claim
+      if self._ReadClaim(path) != claim:
+        return False
+      os.remove(path)
+      return True
+    finally:
+      os.remove(lock_path)
+
+  def Claim(self, key):
+    path = os.path.join(self._directory, str(key))
+    claim = self._ReadClaim(path)
+    if claim is not None and not (self.IsAbandoned(claim) and
+                                  self._TakeOver(path, claim)):
+      return False
+    try:
+      file = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+      return False
+    os.write(file, self._owner.encode())
+    os.close(file)
+    return True
+
+  def Release(self, key):
+    try:
+      os.remove(os.path.join(self._directory, str(key)))
+    except FileNotFoundError:
+      pass
+
 
 class DemonstrationEvaluator(BaseEvaluator):
   def __init__(self, observer, reward_evaluator):
@@ -105,7 +216,8 @@ class ActionValueEvaluator(BaseEvaluator):
     current_nn_state = self._observer.Observe(observed_world)
     action_values = self.GetActionValues(observed_world)
     policy = self.GetPolicy(observed_world)
-    return current_nn_state, action_values, policy
+    value_functions = self.GetValueFunctions(observed_world)
+    return current_nn_state, action_values, policy, value_functions
 
   def AddMissingActionsValues(self, value_dict, num_actions):
     values = []
@@ -123,6 +235,14 @@ class ActionValueEvaluator(BaseEvaluator):
     policy = behavior.last_policy_sampled[1]
     return self.AddMissingActionsValues(policy, num_actions)
 
+  def GetValueFunctions(self, observed_world):
+    # Names of the value functions in the order of GetActionValues.
+    behavior = observed_world.agents[self._agent_id].behavior_model
+    value_functions = [name for key, name in [("envelope", "Envelope"),
+                                              ("collision", "Collision")]
+                       if key in behavior.last_cost_values]
+    return tuple(value_functions + ["Return"])
+
   def GetActionValues(self, observed_world):
     behavior = observed_world.agents[self._agent_id].behavior_model
     num_actions = len(behavior.ego_behavior.GetMotionPrimitives())
@@ -162,7 +282,7 @@ class ActionValueEvaluator(BaseEvaluator):
 class DemonstrationCollector:
   def __init__(self):
     self._collection_result = None
-    self._demonstrations = None
+    self._store = None
     self._directory = None
     self._observer = None
     self._motion_primitive_behavior = None
@@ -176,7 +296,13 @@ class DemonstrationCollector:
   def CollectDemonstrations(self, num_episodes, directory, motion_primitive_behavior, 
        env=None, observer=None, reward_evaluator=None, benchmark_configs=None,
        use_mp_runner=True, runner_init_params = None,
-      runner_run_params=None):
+      runner_run_params=None, scenarios_per_flush=None, claim_timeout=3600.):
+    """Collects the demonstrations of num_episodes scenarios.
+
+    By default the whole benchmark is run and its result is dumped to
+    `directory`. With `scenarios_per_flush`, the scenarios are run in
+    shards of this size instead, see _StreamDemonstrations.
+    """
 
     if env:
       observer = env._observer
@@ -197,20 +323,73 @@ class DemonstrationCollector:
     runner_init_params_def = self._GetDefaultRunnerInitParams()
     runner_init_params_def.update(runner_init_params or {})
     runner_type = BenchmarkRunnerMP if use_mp_runner else BenchmarkRunner
-    runner = runner_type(evaluators=evaluators,
+    make_runner = lambda configs: runner_type(evaluators=evaluators,
                                   scenario_generation=scenario_generator,
-                                  benchmark_configs = benchmark_configs,
+                                  benchmark_configs = configs,
                                   terminal_when=terminal_when,
                                   behaviors=behaviors,
                                   num_scenarios = num_episodes,
                                   **runner_init_params_def)
+    runner = make_runner(benchmark_configs)
     runner.clear_checkpoint_dir()
     runner_run_params_def = self._GetDefaultRunnerRunParams()
     runner_run_params_def.update(runner_run_params or {})
+    if scenarios_per_flush:
+      return self._StreamDemonstrations(
+        runner.configs_to_run, make_runner, runner_run_params_def, directory,
+        scenarios_per_flush, claim_timeout)
     self._collection_result = runner.run(**runner_run_params_def)
     self.dump(directory)
     return self._collection_result
 
+  def _StreamDemonstrations(self, configs, make_runner, runner_run_params,
+                            directory, scenarios_per_flush, claim_timeout):
+    """Runs the benchmark configs in shards and stores them right away.
+
+    The demonstrations of every scenario of a finished shard are
+    appended to the store with their metadata, including all evaluator
+    results, so memory is bounded by the shard size and scenarios are
+    selected when reading. Configs already in the store are skipped,
+    which resumes an interrupted collection. Processes collecting into
+    the same directory claim the configs of their shards first, so that
+    every config is only run once. Scenarios that raised an exception
+    are not stored and run again on resume. Returns the store.
+    """
+    self.dump(directory)
+    store = self.GetStore()
+    claims = ScenarioClaims(os.path.join(directory, "claims"), claim_timeout)
+    completed = {scenario["config_idx"] for scenario in store.Scenarios()}
+    configs = [config for config in configs if config.config_idx not in completed]
+    logging.info(f"Skipping {len(completed)} collected scenarios, "
+                 f"{len(configs)} remaining.")
+    # the store replaces the checkpoints of the runner
+    runner_run_params = {**runner_run_params, "checkpoint_every": None}
+    for start in range(0, len(configs), scenarios_per_flush):
+      shard = [config for config in configs[start:start + scenarios_per_flush]
+               if claims.Claim(config.config_idx)]
+      # another process may have finished an abandoned claim meanwhile
+      store.Refresh()
+      completed = {scenario["config_idx"] for scenario in store.Scenarios()}
+      shard = [config for config in shard if config.config_idx not in completed]
+      if not shard:
+        continue
+      try:
+        data_frame = make_runner(shard).run(**runner_run_params).get_data_frame()
+      except BaseException:
+        for config in shard:
+          claims.Release(config.config_idx)
+        raise
+      data_frame = data_frame[~(data_frame.Terminal == "exception_raised")]
+      self.AppendCollectedRows(store, data_frame)
+      store.Flush()
+      if store.Exists() and not store.attributes:
+        store.SetAttributes(**self.StoreAttributes(store))
+      stored = set(data_frame.config_idx)
+      for config in shard:
+        if config.config_idx not in stored:
+          claims.Release(config.config_idx)
+    return store
+
   def GetEvaluators(self, observer, reward_evaluator):
     return DemonstrationEvaluator(observer, reward_evaluator)
 
@@ -218,32 +397,48 @@ class DemonstrationCollector:
     return {"demo_evaluator" : lambda x : x[1] == True} # second index in evaluation result is done
 
   def dump(self, directory):
-    self._directory = directory
     if not os.path.exists(directory):
       os.makedirs(directory)
+    store_directory = os.path.join(directory, DemonstrationCollector.demonstration_store_dirname())
+    if self._store is not None and \
+        os.path.abspath(self._store.directory) != os.path.abspath(store_directory):
+      self._store = self._store.CopyTo(store_directory)
+    elif self._store is not None:
+      self._store.Flush()
     to_pickle(self._observer, directory, DemonstrationCollector.observer_filename())
     to_pickle(self._motion_primitive_behavior, directory, DemonstrationCollector.motion_primitive_behavior_filename())
+    collection_result_fullname = os.path.join(directory, DemonstrationCollector.collection_result_filename())
     if self._collection_result:
-      self._collection_result.dump(os.path.join(directory, DemonstrationCollector.collection_result_filename()), dump_histories=False, dump_configs=False)
-    if self._demonstrations:
-      to_pickle(self._demonstrations, directory, DemonstrationCollector.demonstrations_filename())
+      self._collection_result.dump(collection_result_fullname, dump_histories=False, dump_configs=False)
+    elif self._directory and os.path.abspath(self._directory) != os.path.abspath(directory) and \
+        os.path.exists(os.path.join(self._directory, DemonstrationCollector.collection_result_filename())):
+      # not loaded yet
+      shutil.copy(os.path.join(self._directory, DemonstrationCollector.collection_result_filename()),
+                  collection_result_fullname)
+    self._directory = directory
 
   def GetDirectory(self):
     return self._directory
 
+  def GetStore(self):
+    """The demonstration store in the directory of the collector."""
+    if self._store is None:
+      # concurrent collections may store a scenario twice
+      self._store = DemonstrationStore(
+        os.path.join(self._directory, DemonstrationCollector.demonstration_store_dirname()),
+        unique_key="config_idx")
+    return self._store
+
   @staticmethod
   def _load(collector, directory):
+    # The collection result and the demonstrations are only read when used.
     collection_result_fullname = os.path.join(directory, DemonstrationCollector.collection_result_filename())
-    if os.path.exists(collection_result_fullname):
-      collector._collection_result = BenchmarkResult.load(collection_result_fullname)
-    else:
+    if not os.path.exists(collection_result_fullname):
       logging.warning("Collection result not existing.")
-    demonstration_fullname = os.path.join(directory, DemonstrationCollector.demonstrations_filename())
-    if os.path.exists(demonstration_fullname):
-      collector._demonstrations = from_pickle(directory, DemonstrationCollector.demonstrations_filename())
-    else:
-      logging.warning("Demonstrations not existing.")
     collector._directory = directory
+    if not collector.GetStore().Exists() and not os.path.exists(
+        os.path.join(directory, DemonstrationCollector.demonstrations_filename())):
+      logging.warning("Demonstrations not existing.")
     collector._observer = from_pickle(directory, DemonstrationCollector.observer_filename())
     collector._motion_primitive_behavior = from_pickle(directory, DemonstrationCollector.motion_primitive_behavior_filename())
     return collector
@@ -267,8 +462,13 @@ class DemonstrationCollector:
 
   @staticmethod
   def demonstrations_filename():
+    # pickled demonstrations of collections before the demonstration store
     return "demonstrations"
 
+  @staticmethod
+  def demonstration_store_dirname():
+    return "demonstration_store"
+
   @staticmethod
   def observer_filename():
     return "observer"
@@ -277,40 +477,129 @@ class DemonstrationCollector:
   def motion_primitive_behavior_filename():
     return "motion_primitive_behavior"
 
-  def UseCollectedRow(self, row, eval_criteria):
-    demo_eval_result, done, info = row["demo_evaluator"]
-    use_scenario = True
-    for crit, func in eval_criteria.items():
-      use_scenario = use_scenario and func(info[crit])
-    return use_scenario
-
-  def GetDemonstrations(self, row):
-    demo_eval_result, done, info = row["demo_evaluator"]
+  def CriterionValues(self, data_frame, criterion):
+    # The evaluation criteria apply to the info of the demo evaluator.
+    return data_frame["demo_evaluator"].map(lambda evaluation: evaluation[2][criterion])
+
+  def CriteriaMask(self, data_frame, eval_criteria=None, mask_criteria=None):
+    """Mask of the rows fulfilling all criteria.
+
+    `eval_criteria` are applied to every value of their column,
+    `mask_criteria` to the whole column and return a mask of it,
+    e.g. lambda column: column > 0.
+    """
+    mask = np.ones(len(data_frame), dtype=bool)
+    for crit, func in (eval_criteria or {}).items():
+      mask &= self.CriterionValues(data_frame, crit).map(func).to_numpy(dtype=bool)
+    for crit, func in (mask_criteria or {}).items():
+      mask &= np.asarray(func(self.CriterionValues(data_frame, crit)), dtype=bool)
+    return mask
+
+  def GetDemonstrations(self, evaluation):
+    # The experiences of the demo evaluator result of a scenario.
+    demo_eval_result, done, info = evaluation
     return demo_eval_result[1:]
 
-  def ProcessCollectionResult(self, eval_criteria = None):
-    if not self._collection_result:
-      logging.error("Collection results not created yet. Call CollectDemonstrations first.")
+  def DemonstrationColumns(self, demonstrations):
+    # Columns of the demonstration store of the experiences of a scenario.
+    states, actions, rewards, next_states, dones, is_demos = zip(*demonstrations)
+    return {"states": np.array(states, dtype=np.float32),
+            "actions": np.array(actions, dtype=np.int64),
+            "rewards": np.array(rewards, dtype=np.float32),
+            "next_states": np.array(next_states, dtype=np.float32),
+            "dones": np.array(dones, dtype=bool),
+            "is_demos": np.array(is_demos, dtype=bool)}
+
+  def ReadDemonstrations(self, store, where=None):
+    columns = store.Read(where=where)
+    return list(zip(columns["states"], columns["actions"], columns["rewards"],
+                    columns["next_states"], columns["dones"], columns["is_demos"]))
+
+  def ScenariosMetadata(self, data_frame):
+    # The results of all evaluators and the scenario, behavior and config.
+    metadata = data_frame.drop(columns=["demo_evaluator"]).to_dict("records")
+    for scenario_metadata, (_, _, info) in zip(metadata, data_frame["demo_evaluator"]):
+      scenario_metadata.update(info)
+    return metadata
+
+  def StoreAttributes(self, store):
+    return {}
+
+  def AppendCollectedRows(self, store, data_frame):
+    """Appends the scenarios of the rows with their experiences converted
+    to columns at once."""
+    demonstrations = [self.GetDemonstrations(evaluation)
+                      for evaluation in data_frame["demo_evaluator"]]
+    experiences = [experience for scenario_demonstrations in demonstrations
+                   for experience in scenario_demonstrations]
+    columns = self.DemonstrationColumns(experiences) if len(experiences) > 0 else None
+    store.AppendScenarios(columns, self.ScenariosMetadata(data_frame),
+                          [len(scenario_demonstrations)
+                           for scenario_demonstrations in demonstrations])
+
+  def ProcessCollectionResult(self, *args, **kwargs):
+    """Writes the demonstrations of the used scenarios to the store and
+    returns them, see WriteCollectionResult for the arguments."""
+    if not self.WriteCollectionResult(*args, **kwargs):
       return
-
-    data_frame = self._collection_result.get_data_frame()
-    self._demonstrations = []
-    exceptions = data_frame[data_frame.Terminal == "exception_raised"]
-    if (len(exceptions.index) > 0):
-      logging.warning(f"Removing {len(exceptions.index)} with raised exceptions")
-      data_frame = data_frame[~(data_frame.Terminal == "exception_raised")]
-    for index, row in data_frame.iterrows():
-      if not eval_criteria or self.UseCollectedRow(row, eval_criteria):
-        self._demonstrations.extend(self.GetDemonstrations(row))
+    store = self.GetStore()
+    return self.ReadDemonstrations(store) if store.Exists() else []
+
+  def WriteCollectionResult(self, eval_criteria = None, num_workers = 1,
+                            rows_per_shard = 1000, mask_criteria = None):
+    """Writes the demonstrations of the used scenarios to the store.
+
+    The rows fulfilling the criteria, see CriteriaMask, are converted in
+    shards of `rows_per_shard` rows, each written as a chunk.
+    With `num_workers` > 1 the shards are converted in parallel processes.
+    Returns False without a collection result.
+    """
+    collection_result = self.GetCollectionResult()
+    if not collection_result:
+      logging.error("Collection results not created yet. Call CollectDemonstrations first.")
+      return False
+
+    data_frame = collection_result.get_data_frame()
+    store = self.GetStore()
+    store.Clear()
+    mask = ~(data_frame.Terminal == "exception_raised").to_numpy(dtype=bool)
+    if not mask.all():
+      logging.warning(f"Removing {np.count_nonzero(~mask)} with raised exceptions")
+    mask &= self.CriteriaMask(data_frame, eval_criteria, mask_criteria)
+    data_frame = data_frame[mask]
+    starts = list(range(0, len(data_frame), rows_per_shard))
+    if num_workers > 1 and len(starts) > 1:
+      with ProcessPoolExecutor(
+          max_workers=num_workers, mp_context=mp.get_context("fork"),
+          initializer=_init_shard_worker,
+          initargs=(self, data_frame, store.directory)) as executor:
+        list(executor.map(_append_worker_shard, range(len(starts)), starts,
+                          [start + rows_per_shard for start in starts]))
+    else:
+      for order, start in enumerate(starts):
+        _append_shard(self, data_frame.iloc[start:start + rows_per_shard],
+                      store.directory, order)
+    store.Refresh()
+    if store.Exists():
+      store.SetAttributes(**self.StoreAttributes(store))
     self.dump(self._directory)
-    return self._demonstrations
-
-  def GetDemonstrationExperiences(self):
-    if not self._demonstrations:
-      self.ProcessCollectionResult()
-    return self._demonstrations
+    return True
+
+  def GetDemonstrationExperiences(self, *args, **kwargs):
+    """The demonstrations read from the store, e.g. only of the scenarios
+    where(metadata) is true."""
+    store = self.GetStore()
+    if not store.Exists():
+      if os.path.exists(os.path.join(self._directory, DemonstrationCollector.demonstrations_filename())):
+        return from_pickle(self._directory, DemonstrationCollector.demonstrations_filename())
+      return self.ProcessCollectionResult() or []
+    return self.ReadDemonstrations(store, *args, **kwargs)
 
   def GetCollectionResult(self):
+    if self._collection_result is None and self._directory:
+      collection_result_fullname = os.path.join(self._directory, DemonstrationCollector.collection_result_filename())
+      if os.path.exists(collection_result_fullname):
+        self._collection_result = BenchmarkResult.load(collection_result_fullname)
     return self._collection_result
   
 
@@ -319,19 +608,68 @@ class ActionValuesCollector(DemonstrationCollector):
     super(ActionValuesCollector, self).__init__()
     self.terminal_criteria = terminal_criteria
 
-  def UseCollectedRow(self, row, eval_criteria):
-    use_scenario = True
-    for crit, func in eval_criteria.items():
-      use_scenario = use_scenario and func(row[crit])
-    return use_scenario
-
-  def GetDemonstrations(self, row):
-    demos = None
-    try:
-      demos = [[list(tp[0]), list(tp[1]), list(tp[2])] for tp in list(row["demo_evaluator"][1:])]
-    except:
-      demos = [[list(tp[0]), list(tp[1])] for tp in list(row["demo_evaluator"][1:])]
-    return demos
+  def CriterionValues(self, data_frame, criterion):
+    return data_frame[criterion]
+
+  def GetDemonstrations(self, evaluation):
+    # (state, action values, policy, value functions) tuples, converted to
+    # arrays in bulk
+    return evaluation[1:]
+
+  def DemonstrationColumns(self, demonstrations):
+    dataset = DemonstrationDataset.from_demonstrations(demonstrations)
+    return {column: getattr(dataset, column) for column in DemonstrationDataset.columns}
+
+  def ReadDemonstrations(self, store, where=None):
+    """The [state, action values(, policy)] lists of the scenarios
+    where(metadata), see GetDemonstrationDataset for arrays."""
+    dataset = DemonstrationDataset.from_store(store, where)
+    rows = [dataset.states.tolist(), dataset.action_values.tolist()]
+    if dataset.policies.shape[1] > 0:
+      rows.append(dataset.policies.tolist())
+    return [list(demonstration) for demonstration in zip(*rows)]
+
+  def GetDemonstrationDataset(self, where=None, value_functions=None):
+    """The demonstrations of the scenarios where(metadata) as dataset.
+
+    `value_functions` selects the action values of these value functions,
+    e.g. ["Return"], by default all.
+    """
+    store = self.GetStore()
+    if not store.Exists() and not os.path.exists(
+        os.path.join(self._directory, DemonstrationCollector.demonstrations_filename())):
+      self.WriteCollectionResult()
+    if not store.Exists():
+      # pickled demonstrations of collections before the store
+      return DemonstrationDataset.from_demonstrations(
+        self.GetDemonstrationExperiences())
+    return DemonstrationDataset.from_store(store, where, value_functions)
+
+  def ScenariosMetadata(self, data_frame):
+    metadata = data_frame.drop(columns=["demo_evaluator"]).to_dict("records")
+    for scenario_metadata, evaluation in zip(metadata, data_frame["demo_evaluator"]):
+      demonstrations = self.GetDemonstrations(evaluation)
+      # collections before the evaluator named them lack the names
+      if len(demonstrations) > 0 and len(demonstrations[0]) > 3:
+        scenario_metadata["value_functions"] = list(demonstrations[0][3])
+    return metadata
+
+  def StoreAttributes(self, store):
+    # Names of the value functions concatenated in the action values as
+    # recorded by the evaluator.
+    num_actions = len(self.motion_primitive_behavior.GetMotionPrimitives())
+    attributes = {"num_actions": num_actions}
+    value_functions = {tuple(scenario["value_functions"])
+                       for scenario in store.Scenarios()
+                       if "value_functions" in scenario}
+    if len(value_functions) > 1:
+      raise ValueError(
+        f"Scenarios with different value functions {sorted(value_functions)}.")
+    if value_functions:
+      attributes["value_functions"] = list(value_functions.pop())
+      assert len(attributes["value_functions"]) * num_actions == \
+        store.schema["columns"]["action_values"]["shape"][0]
+    return attributes
 
   def GetEvaluators(self, observer, reward_evaluator):
     return ActionValueEvaluator(observer)
@@ -0,0 +1,85 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Julian Bernhard, Klemens Esterle, Patrick Hart and
+# Tobias Kessler
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import math
+import numpy as np
+from torch.utils.data import Dataset
+
+
+class DemonstrationDataset(Dataset):
+  """Demonstrations as contiguous float32 arrays.
+
+  Row i of `states`, `action_values` and `policies` belongs to the i-th
+  demonstration, `policies` has no columns if they were not collected.
+  Indexing with an array of indices returns a batch as a dict of these
+  columns, so that a torch DataLoader can load whole batches with a
+  BatchSampler.
+  """
+  columns = ("states", "action_values", "policies")
+
+  def __init__(self, states, action_values, policies=None):
+    self.states = np.ascontiguousarray(states, dtype=np.float32)
+    self.action_values = np.ascontiguousarray(action_values, dtype=np.float32)
+    if policies is None:
+      policies = np.empty((len(self.states), 0), dtype=np.float32)
+    self.policies = np.ascontiguousarray(policies, dtype=np.float32)
+    assert len(self.states) == len(self.action_values) == len(self.policies)
+
+  @classmethod
+  def from_demonstrations(cls, demonstrations):
+    """Converts [state, action values(, policy)] demonstrations once."""
+    if isinstance(demonstrations, DemonstrationDataset):
+      return demonstrations
+    states = np.array([demo[0] for demo in demonstrations], dtype=np.float32)
+    action_values = np.array([demo[1] for demo in demonstrations],
+                             dtype=np.float32)
+    policies = None
+    if len(demonstrations) > 0 and len(demonstrations[0]) > 2:
+      policies = np.array([demo[2] for demo in demonstrations],
+                          dtype=np.float32)
+    return cls(states, action_values, policies)
+
+  @classmethod
+  def from_store(cls, store, where=None, value_functions=None):
+    """Reads the demonstrations of the scenarios where(metadata) of a store.
+
+    `value_functions` selects the action values of these value functions
+    by the names of the store attributes, by default all.
+    """
+    column_indices = None
+    if value_functions is not None:
+      if "value_functions" not in store.attributes:
+        raise ValueError("The store does not name its value functions.")
+      names = store.attributes["value_functions"]
+      num_actions = store.attributes["num_actions"]
+      column_indices = {"action_values": np.concatenate(
+        [np.arange(num_actions) + names.index(name) * num_actions
+         for name in value_functions])}
+    columns = store.Read(cls.columns, where, column_indices)
+    return cls(columns["states"], columns["action_values"], columns["policies"])
+
+  def __len__(self):
+    return len(self.states)
+
+  def __getitem__(self, indices):
+    return {column: getattr(self, column)[indices] for column in self.columns}
+
+  def subset(self, indices):
+    return DemonstrationDataset(self.states[indices],
+                                self.action_values[indices],
+                                self.policies[indices])
+
+  def split(self, ratio):
+    """Randomly splits into a train and test set of ratio and 1 - ratio."""
+    indices = np.random.permutation(len(self))
+    num_train = math.floor(len(self) * ratio)
+    return self.subset(indices[:num_train]), self.subset(indices[num_train:])
+
+  def sample(self, batch_size):
+    # Uniformly with replacement.
+    return self[np.random.randint(low=0, high=len(self), size=batch_size)]
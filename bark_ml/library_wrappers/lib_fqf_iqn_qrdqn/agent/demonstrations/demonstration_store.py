@@ -0,0 +1,266 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Julian Bernhard, Klemens Esterle, Patrick Hart and
+# Tobias Kessler
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+
+def _to_json_value(value):
+  if isinstance(value, np.generic):
+    return value.item()
+  if value is None or isinstance(value, (bool, int, float, str)):
+    return value
+  if isinstance(value, dict):
+    return {str(key): _to_json_value(item) for key, item in value.items()}
+  if isinstance(value, (list, tuple)):
+    return [_to_json_value(item) for item in value]
+  return str(value)
+
+
+class DemonstrationStore:
+  """Chunked columnar store of demonstrations in a directory.
+
+  Every chunk is a directory holding one .npy file per column and the
+  metadata of its scenarios, whose rows are contiguous in the chunk.
+  Scenarios are buffered and written as a new chunk once `chunk_rows`
+  rows are pending or on `Flush`. A chunk is written to a temporary
+  directory and renamed when complete, so appending never changes the
+  existing chunks and an interrupted write leaves no partial chunk.
+
+  Opening a store only reads the metadata, the columns are memory-mapped
+  when read. `Stream` yields the rows of the selected scenarios chunk by
+  chunk, `Read` concatenates them. With a `unique_key`, scenarios whose
+  metadata repeats the value of this key of an earlier scenario are
+  ignored, e.g. scenarios stored twice by concurrent collections.
+  """
+  schema_filename = "schema.json"
+  scenarios_filename = "scenarios.json"
+  chunk_prefix = "chunk_"
+
+  def __init__(self, directory, chunk_rows=100000, unique_key=None):
+    self._directory = directory
+    self._chunk_rows = chunk_rows
+    self._unique_key = unique_key
+    self._schema = None
+    self._chunks = None
+    self._chunk_scenarios = {}
+    self._pending_columns = []
+    self._pending_scenarios = []
+
+  @property
+  def directory(self):
+    return self._directory
+
+  def Exists(self):
+    return os.path.exists(os.path.join(self._directory, self.schema_filename))
+
+  @property
+  def schema(self):
+    if self._schema is None and self.Exists():
+      with open(os.path.join(self._directory, self.schema_filename)) as file:
+        self._schema = json.load(file)
+    return self._schema
+
+  @property
+  def attributes(self):
+    return self.schema["attributes"] if self.schema else {}
+
+  def Columns(self):
+    return list(self.schema["columns"]) if self.schema else []
+
+  def _WriteSchema(self, columns, attributes):
+    schema = {"columns": columns, "attributes": _to_json_value(attributes)}
+    os.makedirs(self._directory, exist_ok=True)
+    path = os.path.join(self._directory, self.schema_filename)
+    # processes appending to the same store may write it at the same time
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+      json.dump(schema, file)
+    os.replace(tmp_path, path)
+    self._schema = schema
+
+  def SetAttributes(self, **attributes):
+    # Attributes of the whole store, e.g. the names of the value functions.
+    assert self.schema, "Attributes can only be set after the first append."
+    self._WriteSchema(self.schema["columns"], {**self.attributes, **attributes})
+
+  def AppendScenario(self, columns, metadata=None):
+    """Appends the rows of a scenario, all columns have the same length.
+
+    Scenarios without rows are appended with `columns` None to keep
+    their metadata.
+    """
+    num_rows = 0
+    if columns is not None:
+      num_rows = len(next(iter(columns.values())))
+    self.AppendScenarios(columns, [metadata or {}], [num_rows])
+
+  def AppendScenarios(self, columns, metadata, num_rows):
+    """Appends the concatenated rows of consecutive scenarios at once.
+
+    The i-th scenario has `num_rows[i]` rows and the metadata
+    `metadata[i]`, `columns` is None if no scenario has rows.
+    """
+    total_rows = sum(num_rows)
+    assert len(metadata) == len(num_rows)
+    if columns is not None:
+      columns = {name: np.asarray(array) for name, array in columns.items()}
+      lengths = {len(array) for array in columns.values()}
+      assert lengths == {total_rows}, "Columns of different lengths."
+      if self.schema is None:
+        self._WriteSchema({name: {"dtype": array.dtype.str,
+                                  "shape": list(array.shape[1:])}
+                           for name, array in columns.items()}, {})
+      assert set(columns) == set(self.schema["columns"]), \
+        f"Columns {sorted(columns)} do not match {self.Columns()}."
+      self._pending_columns.append(columns)
+    else:
+      assert total_rows == 0, "Rows without columns."
+    self._pending_scenarios.extend(
+      {**_to_json_value(scenario_metadata or {}), "num_rows": int(rows)}
+      for scenario_metadata, rows in zip(metadata, num_rows))
+    if self.NumPendingRows() >= self._chunk_rows:
+      self.Flush()
+
+  def NumPendingRows(self):
+    return sum(scenario["num_rows"] for scenario in self._pending_scenarios)
+
+  def Flush(self, order=None):
+    """Writes the pending scenarios as a new chunk.
+
+    Chunks are read in the order of their `order`, by default the time
+    of the flush.
+    """
+    if not self._pending_scenarios:
+      return
+    # unique among processes appending to the same store
+    order = time.time_ns() if order is None else order
+    name = f"{self.chunk_prefix}{order:020d}_{os.getpid()}"
+    tmp_directory = os.path.join(self._directory, "." + name)
+    os.makedirs(tmp_directory)
+    for column, column_schema in (self.schema or {"columns": {}})["columns"].items():
+      if not self._pending_columns:
+        break
+      array = np.concatenate(
+        [columns[column] for columns in self._pending_columns]).astype(
+          column_schema["dtype"], copy=False)
+      np.save(os.path.join(tmp_directory, column + ".npy"), array)
+    with open(os.path.join(tmp_directory, self.scenarios_filename), "w") as file:
+      json.dump(self._pending_scenarios, file)
+    os.rename(tmp_directory, os.path.join(self._directory, name))
+    self._pending_columns, self._pending_scenarios = [], []
+    self._chunks = None
+
+  def Clear(self):
+    self._pending_columns, self._pending_scenarios = [], []
+    if os.path.exists(self._directory):
+      shutil.rmtree(self._directory)
+    self._schema, self._chunks = None, None
+    self._chunk_scenarios = {}
+
+  def CopyTo(self, directory):
+    self.Flush()
+    if os.path.exists(self._directory):
+      shutil.copytree(self._directory, directory, dirs_exist_ok=True)
+    return DemonstrationStore(directory, self._chunk_rows, self._unique_key)
+
+  def Refresh(self):
+    # Also lists the chunks other processes appended meanwhile.
+    self._schema, self._chunks = None, None
+
+  def Chunks(self):
+    # (chunk directory, scenarios) of the written chunks in their order.
+    if self._chunks is None:
+      self._chunks = []
+      if os.path.exists(self._directory):
+        for name in sorted(os.listdir(self._directory)):
+          if not name.startswith(self.chunk_prefix):
+            continue
+          chunk_directory = os.path.join(self._directory, name)
+          # chunks never change, their scenarios are only read once
+          if name not in self._chunk_scenarios:
+            with open(os.path.join(chunk_directory,
+                                   self.scenarios_filename)) as file:
+              self._chunk_scenarios[name] = json.load(file)
+          self._chunks.append((chunk_directory, self._chunk_scenarios[name]))
+    return self._chunks
+
+  def _SelectedChunks(self, where=None):
+    # (chunk directory, scenarios, whether each scenario is selected)
+    keys = set()
+    for chunk_directory, scenarios in self.Chunks():
+      selected = []
+      for scenario in scenarios:
+        key = scenario.get(self._unique_key) if self._unique_key else None
+        if key is not None and key in keys:
+          selected.append(False)
+          continue
+        keys.add(key)
+        selected.append(where is None or where(scenario))
+      yield chunk_directory, scenarios, selected
+
+  def Scenarios(self, where=None):
+    """Metadata of the scenarios, optionally only those where(metadata)."""
+    return [scenario for _, scenarios, selected in self._SelectedChunks(where)
+            for scenario, is_selected in zip(scenarios, selected) if is_selected]
+
+  def NumRows(self, where=None):
+    return sum(scenario["num_rows"] for scenario in self.Scenarios(where))
+
+  def Stream(self, columns=None, where=None, column_indices=None):
+    """Yields the rows of the scenarios where(metadata) chunk by chunk.
+
+    Yields dicts of the `columns`, by default all. `column_indices` maps
+    columns to the indices of their last axis to read, e.g. the
+    value functions of the action values. Without selection the arrays
+    are memory-mapped, otherwise only the selected rows are read.
+    """
+    columns = columns or self.Columns()
+    column_indices = column_indices or {}
+    for chunk_directory, scenarios, selected in self._SelectedChunks(where):
+      if sum(scenario["num_rows"] for scenario, is_selected
+             in zip(scenarios, selected) if is_selected) == 0:
+        continue
+      rows = slice(None)
+      if not all(selected):
+        ends = np.cumsum([scenario["num_rows"] for scenario in scenarios])
+        rows = np.concatenate(
+          [np.arange(end - scenario["num_rows"], end)
+           for scenario, end, is_selected in zip(scenarios, ends, selected)
+           if is_selected])
+      chunk = {}
+      for column in columns:
+        array = np.load(os.path.join(chunk_directory, column + ".npy"),
+                        mmap_mode="r")[rows]
+        if column in column_indices:
+          array = array[..., column_indices[column]]
+        chunk[column] = array
+      yield chunk
+
+  def Read(self, columns=None, where=None, column_indices=None):
+    """Reads the rows of the selected scenarios into contiguous arrays."""
+    columns = columns or self.Columns()
+    column_indices = column_indices or {}
+    chunks = list(self.Stream(columns, where, column_indices))
+    result = {}
+    for column in columns:
+      if len(chunks) == 1:
+        # stays memory-mapped if all rows are read
+        result[column] = chunks[0][column]
+      elif chunks:
+        result[column] = np.concatenate([chunk[column] for chunk in chunks])
+      else:
+        column_schema = self.schema["columns"][column]
+        shape = list(column_schema["shape"])
+        if column in column_indices:
+          shape[-1] = len(np.arange(shape[-1])[column_indices[column]])
+        result[column] = np.empty([0] + shape, dtype=column_schema["dtype"])
+    return result
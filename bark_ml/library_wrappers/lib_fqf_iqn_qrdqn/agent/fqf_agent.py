@@ -14,8 +14,9 @@ from torch.optim import Adam, RMSprop
 
 from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.model import FQF
 from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.utils \
- import disable_gradients, update_params, \
- calculate_quantile_huber_loss, evaluate_quantile_at_action
+ import disable_gradients, debug_checks, \
+ calculate_quantile_huber_loss, evaluate_quantile_at_action, \
+ calculate_fraction_loss
 from .base_agent import BaseAgent
 
 
@@ -75,6 +76,9 @@ class FQFAgent(BaseAgent):
         lr=self._params["ML"]["FQFAgent"]["QuantileLearningRate", "", 5e-5],
         eps=1e-2 / self.batch_size)
 
+  def optimizers(self):
+    return [self.fraction_optim, self.quantile_optim]
+
   def clean_pickables(self, pickables):
     super(FQFAgent, self).clean_pickables(pickables)
     del pickables["fraction_optim"]
@@ -89,17 +93,11 @@ class FQFAgent(BaseAgent):
         self.online_net.cosine_net.state_dict())
 
   def learn(self):
-    self.learning_steps += 1
     self.online_net.sample_noise()
     self.target_net.sample_noise()
 
-    if self.use_per:
-      (states, actions, rewards, next_states, dones), weights = \
-       self.memory.sample(self.batch_size)
-    else:
-      states, actions, rewards, next_states, dones = \
-       self.memory.sample(self.batch_size)
-      weights = None
+    (states, actions, rewards, next_states, dones, steps), weights = \
+     self.sample_transitions()
 
     # Calculate embeddings of current states.
     state_embeddings = self.online_net.calculate_state_embeddings(states)
@@ -114,7 +112,8 @@ class FQFAgent(BaseAgent):
         self.online_net.calculate_quantiles(tau_hats,
                                             state_embeddings=state_embeddings),
         actions)
-    assert current_sa_quantile_hats.shape == (self.batch_size, self.N, 1)
+    if debug_checks():
+      assert current_sa_quantile_hats.shape == (self.batch_size, self.N, 1)
 
     # NOTE: Detach state_embeddings not to update convolution layers. Also,
     # detach current_sa_quantile_hats because I calculate gradients of taus
@@ -125,89 +124,66 @@ class FQFAgent(BaseAgent):
 
     quantile_loss, mean_q, errors = self.calculate_quantile_loss(
         state_embeddings, tau_hats, current_sa_quantile_hats, actions, rewards,
-        next_states, dones, weights)
+        next_states, dones, steps, weights)
 
     entropy_loss = -self.ent_coef * entropies.mean()
 
-    update_params(self.fraction_optim,
-                  fraction_loss + entropy_loss,
-                  networks=[self.online_net.fraction_net],
-                  retain_graph=True,
-                  grad_cliping=self.grad_cliping)
-    update_params(self.quantile_optim,
-                  quantile_loss,
-                  networks=[
-                      self.online_net.dqn_net, self.online_net.cosine_net,
-                      self.online_net.quantile_net
-                  ],
-                  retain_graph=False,
-                  grad_cliping=self.grad_cliping)
+    self.update_params(self.fraction_optim,
+                       fraction_loss + entropy_loss,
+                       networks=[self.online_net.fraction_net],
+                       retain_graph=True,
+                       grad_cliping=self.grad_cliping)
+    self.update_params(self.quantile_optim,
+                       quantile_loss,
+                       networks=[
+                           self.online_net.dqn_net, self.online_net.cosine_net,
+                           self.online_net.quantile_net
+                       ],
+                       retain_graph=False,
+                       grad_cliping=self.grad_cliping)
 
     if self.use_per:
-      self.memory.update_priority(errors)
+      self.update_priority(errors)
 
     if self.learning_steps % self.summary_log_interval == 0:
-      self.writer.add_scalar('loss/fraction_loss',
-                             fraction_loss.detach().item(), 4 * self.steps)
-      self.writer.add_scalar('loss/quantile_loss',
-                             quantile_loss.detach().item(), 4 * self.steps)
+      self.metrics.add_scalar('loss/fraction_loss',
+                              fraction_loss.detach(), 4 * self.steps)
+      self.metrics.add_scalar('loss/quantile_loss',
+                              quantile_loss.detach(), 4 * self.steps)
       if self.ent_coef > 0.0:
-        self.writer.add_scalar('loss/entropy_loss',
-                               entropy_loss.detach().item(), 4 * self.steps)
+        self.metrics.add_scalar('loss/entropy_loss',
+                                entropy_loss.detach(), 4 * self.steps)
 
-      self.writer.add_scalar('stats/mean_Q', mean_q, 4 * self.steps)
-      self.writer.add_scalar('stats/mean_entropy_of_value_distribution',
-                             entropies.mean().detach().item(), 4 * self.steps)
+      self.metrics.add_scalar('stats/mean_Q', mean_q, 4 * self.steps)
+      self.metrics.add_scalar('stats/mean_entropy_of_value_distribution',
+                              entropies.mean().detach(), 4 * self.steps)
 
   def calculate_fraction_loss(self, state_embeddings, sa_quantile_hats, taus,
                               actions, weights):
-    assert not state_embeddings.requires_grad
-    assert not sa_quantile_hats.requires_grad
-
-    batch_size = state_embeddings.shape[0]
+    if debug_checks():
+      assert not state_embeddings.requires_grad
+      assert not sa_quantile_hats.requires_grad
 
     with torch.no_grad():
       sa_quantiles = evaluate_quantile_at_action(
           self.online_net.calculate_quantiles(
               taus=taus[:, 1:-1], state_embeddings=state_embeddings), actions)
-      assert sa_quantiles.shape == (batch_size, self.N - 1, 1)
+      if debug_checks():
+        assert sa_quantiles.shape == \
+          (state_embeddings.shape[0], self.N - 1, 1)
 
     # NOTE: Proposition 1 in the paper requires F^{-1} is non-decreasing.
     # I relax this requirements and calculate gradients of taus even when
-    # F^{-1} is not non-decreasing.
-
-    values_1 = sa_quantiles - sa_quantile_hats[:, :-1]
-    signs_1 = sa_quantiles > torch.cat(
-        [sa_quantile_hats[:, :1], sa_quantiles[:, :-1]], dim=1)
-    assert values_1.shape == signs_1.shape
-
-    values_2 = sa_quantiles - sa_quantile_hats[:, 1:]
-    signs_2 = sa_quantiles < torch.cat(
-        [sa_quantiles[:, 1:], sa_quantile_hats[:, -1:]], dim=1)
-    assert values_2.shape == signs_2.shape
-
-    gradient_of_taus = (torch.where(signs_1, values_1, -values_1) +
-                        torch.where(signs_2, values_2, -values_2)).view(
-                            batch_size, self.N - 1)
-    assert not gradient_of_taus.requires_grad
-    assert gradient_of_taus.shape == taus[:, 1:-1].shape
-
-    # Gradients of the network parameters and corresponding loss
-    # are calculated using chain rule.
-    if weights is not None:
-      fraction_loss = ((
-          (gradient_of_taus * taus[:, 1:-1]).sum(dim=1, keepdim=True)) *
-                       weights).mean()
-    else:
-      fraction_loss = \
-       (gradient_of_taus * taus[:, 1:-1]).sum(dim=1).mean()
-
-    return fraction_loss
+    # F^{-1} is not non-decreasing. Gradients of the network parameters
+    # and corresponding loss are calculated using chain rule.
+    return calculate_fraction_loss(sa_quantiles, sa_quantile_hats, taus,
+                                   weights)
 
   def calculate_quantile_loss(self, state_embeddings, tau_hats,
                               current_sa_quantile_hats, actions, rewards,
-                              next_states, dones, weights):
-    assert not tau_hats.requires_grad
+                              next_states, dones, steps, weights):
+    if debug_checks():
+      assert not tau_hats.requires_grad
 
     with torch.no_grad():
       # NOTE: Current and target quantiles share the same proposed
@@ -228,7 +204,8 @@ class FQFAgent(BaseAgent):
 
       # Calculate greedy actions.
       next_actions = torch.argmax(next_q, dim=1, keepdim=True)
-      assert next_actions.shape == (self.batch_size, 1)
+      if debug_checks():
+        assert next_actions.shape == (self.batch_size, 1)
 
       # Calculate features of next states.
       if self.double_q_learning:
@@ -240,18 +217,22 @@ class FQFAgent(BaseAgent):
           self.target_net.calculate_quantiles(
               taus=tau_hats, state_embeddings=next_state_embeddings),
           next_actions).transpose(1, 2)
-      assert next_sa_quantile_hats.shape == (self.batch_size, 1, self.N)
+      if debug_checks():
+        assert next_sa_quantile_hats.shape == (self.batch_size, 1, self.N)
 
       # Calculate target quantile values.
       target_sa_quantile_hats = rewards[..., None] + (
-          1.0 - dones[..., None]) * self.gamma_n * next_sa_quantile_hats
-      assert target_sa_quantile_hats.shape == (self.batch_size, 1, self.N)
+          1.0 - dones[..., None]) * self.gamma**steps[..., None] * \
+          next_sa_quantile_hats
+      if debug_checks():
+        assert target_sa_quantile_hats.shape == (self.batch_size, 1, self.N)
 
     td_errors = target_sa_quantile_hats - current_sa_quantile_hats
-    assert td_errors.shape == (self.batch_size, self.N, self.N)
+    if debug_checks():
+      assert td_errors.shape == (self.batch_size, self.N, self.N)
 
     quantile_huber_loss = calculate_quantile_huber_loss(
         td_errors, tau_hats, weights, self.kappa)
 
-    return quantile_huber_loss, next_q.detach().mean().item(), \
+    return quantile_huber_loss, next_q.detach().mean(), \
         td_errors.detach().abs()
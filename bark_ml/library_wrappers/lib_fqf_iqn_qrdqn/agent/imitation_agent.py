@@ -6,26 +6,27 @@
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
 
-from collections import deque
 import numpy as np
 import logging
 import os
-import math
-import random
+import copy
 
 import torch
 from torch import nn
 from torch.optim import Adam, RMSprop, AdamW
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler
 
 from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.model import Imitation, PolicyImitation
-from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent.demonstrations import ActionValuesCollector
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent.demonstrations import ActionValuesCollector, \
+  DemonstrationDataset
 from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.utils \
- import disable_gradients, update_params, \
+ import disable_gradients, update_params, RunningMeanStats, \
  calculate_quantile_huber_loss, evaluate_quantile_at_action
 from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent.loss.loss_function \
   import apply_sigmoid_to_dict, LossMSE, LossBCE, LossPolicyCrossEntropy, \
   LossHuber, LossTukey, LossEpsInsensitiveHuber, LossRelative
 from .base_agent import BaseAgent, TrainingBenchmark
+from .checkpoint_writer import atomic_save
 
 class BenchmarkSupervisedLoss(TrainingBenchmark):
     def __init__(self, demonstrations_test):
@@ -88,7 +89,8 @@ class BenchmarkSplitSupervisedLoss(TrainingBenchmark):
 
     for key in converted_desired_values.keys():
       pair_wise_diff = converted_desired_values[key] - converted_current_values[key]
-      pair_wise_diff_squared = pair_wise_diff**2
+      # without the missing (nan) desired values
+      pair_wise_diff_squared = pair_wise_diff[~torch.isnan(pair_wise_diff)]**2
       error_var, error_mean = torch.var_mean(pair_wise_diff_squared)
       error_var = error_var.item()
       error_mean = error_mean.item()
@@ -133,6 +135,9 @@ class BenchmarkSplitSupervisedLoss(TrainingBenchmark):
 
 
 class ImitationAgent(BaseAgent):
+  # column of the demonstration dataset the network is trained on
+  demonstration_targets = "action_values"
+
   def __init__(self, demonstration_collector = None, base_demonstrations_dir=None, demonstration_collector_dir=None, *args, **kwargs):
     self.demonstration_collector = demonstration_collector
     self.base_demonstrations_dir = base_demonstrations_dir
@@ -156,10 +161,14 @@ class ImitationAgent(BaseAgent):
     self.select_loss_function(self._params)
 
   def define_training_test_data(self):
-    demonstrations = self.demonstration_collector.GetDemonstrationExperiences()
-    random.shuffle(demonstrations)
-    self.demonstrations_train = demonstrations[0:math.floor(len(demonstrations)*self.train_test_ratio)]
-    self.demonstrations_test = demonstrations[math.ceil(len(demonstrations)*self.train_test_ratio):]
+    if hasattr(self.demonstration_collector, "GetDemonstrationDataset"):
+      demonstrations = self.demonstration_collector.GetDemonstrationDataset()
+    else:
+      demonstrations = DemonstrationDataset.from_demonstrations(
+        self.demonstration_collector.GetDemonstrationExperiences())
+    self.demonstrations_train, self.demonstrations_test = \
+      demonstrations.split(self.train_test_ratio)
+    self.close_training_batches()
 
   def reset_params(self, params):
     super(ImitationAgent, self).reset_params(params)
@@ -169,10 +178,14 @@ class ImitationAgent(BaseAgent):
     self.train_test_ratio = params["TrainTestRatio", "", 0.8]
     self.weight_decay = params["WeightDecay", "", 0]
     self.do_logging = params["DoLogging", "", True]
+    # worker processes loading the training batches, 0 samples them in the
+    # training loop, batches are pinned for the transfer to a GPU
+    self.data_loader_workers = params["DataLoaderWorkers", "", 0]
+    self.pin_memory = params["PinMemory", "", True]
 
   def reset_training_variables(self):
     # Replay memory which is memory-efficient to store stacked frames.
-    self.running_loss = deque(maxlen=self.running_loss_length)
+    self.running_loss = RunningMeanStats(self.running_loss_length)
     self.steps = 0
     self.best_eval_results = None
 
@@ -212,27 +225,61 @@ class ImitationAgent(BaseAgent):
     del pickables["_training_benchmark"]
     del pickables["device"]
     del pickables["writer"]
+    del pickables["metrics"]
+    del pickables["throughput"]
     del pickables["_checkpoint_load"]
     del pickables["online_net"]
     del pickables["optim"]
     del pickables["demonstrations_train"]
+    del pickables["_training_batches"]
     del pickables["demonstration_collector"]
+    del pickables["_checkpoint_writer"]
+
+  def batch_to_device(self, batch):
+    # Returns the states and targets of a batch of the demonstration dataset.
+    states, targets = batch["states"], batch[self.demonstration_targets]
+    if isinstance(states, np.ndarray):
+      states, targets = torch.from_numpy(states), torch.from_numpy(targets)
+    return states.to(self.device, non_blocking=True), \
+      targets.to(self.device, non_blocking=True)
+
+  def sample_batch(self, demonstrations, batch_size):
+    demonstrations = DemonstrationDataset.from_demonstrations(demonstrations)
+    return self.batch_to_device(demonstrations.sample(batch_size))
+
+  def training_batches(self):
+    """Endless training batches loaded by DataLoaderWorkers processes."""
+    sampler = BatchSampler(
+      RandomSampler(self.demonstrations_train, replacement=True,
+                    num_samples=self.batch_size * self.eval_interval),
+      self.batch_size, drop_last=True)
+    # batch_size=None passes the index arrays of the sampler to the dataset
+    loader = DataLoader(self.demonstrations_train, sampler=sampler,
+                        batch_size=None,
+                        num_workers=self.data_loader_workers,
+                        pin_memory=self.pin_memory and self.device.type == "cuda",
+                        persistent_workers=True)
+    while True:
+      for batch in loader:
+        yield batch
+
+  def sample_training_batch(self):
+    if self.data_loader_workers <= 0:
+      return self.sample_batch(self.demonstrations_train, self.batch_size)
+    if self._training_batches is None:
+      self._training_batches = self.training_batches()
+    return self.batch_to_device(next(self._training_batches))
+
+  def close_training_batches(self):
+    # closing the generator releases its DataLoader, which shuts down the
+    # persistent worker processes
+    if getattr(self, "_training_batches", None) is not None:
+      self._training_batches.close()
+    self._training_batches = None
 
-  def sample_batch(self, demonstrations_list, batch_size):
-    state_size = len(demonstrations_list[0][0])
-    num_action_values = len(demonstrations_list[0][1])
-    states = np.empty((batch_size, state_size), dtype=np.float)
-    action_values = np.empty((batch_size, num_action_values), dtype=np.float)
-
-    indices = np.random.randint(low=0, high=len(demonstrations_list), size=batch_size)
-    for i, index in enumerate(indices):
-      states[i, ...] = demonstrations_list[index][0]
-      action_values[i, ...] = demonstrations_list[index][1]
-
-    states = torch.FloatTensor(states).to(self.device)
-    action_values = torch.FloatTensor(action_values).to(self.device)
-
-    return states, action_values
+  def run(self):
+    super(ImitationAgent, self).run()
+    self.close_training_batches()
 
   def calculate_loss(self, action_values_current, action_values_desired, logits=False,
                      return_intermediate_losses=False):
@@ -241,13 +288,9 @@ class ImitationAgent(BaseAgent):
     current values to the desired values.
     Some loss functions (e.g., BCE) need logits for a better numerical
     stability while training.
+    Missing actions during demo collections become nan values, the losses
+    mask them so that they do not influence the loss.
     """
-    # if we have missing actions during demo collections these become nan values
-    # they should not influence the loss and are thus set to current nn output
-    for key in action_values_desired.keys():
-      nans_desired = torch.isnan(action_values_desired[key]).nonzero(as_tuple=False)
-      action_values_desired[key][nans_desired] = action_values_current[key][nans_desired].detach().clone()
-
     loss = self.selected_loss(action_values_current, action_values_desired, logits,
                               return_intermediate_losses=return_intermediate_losses)
     return loss
@@ -258,17 +301,25 @@ class ImitationAgent(BaseAgent):
         action_values = self.online_net(state_torch)
     return action_values.tolist()
 
-  def save_models(self, checkpoint_dir):
-    if not os.path.exists(checkpoint_dir):
-      os.makedirs(checkpoint_dir)
-    torch.save(self.online_net.state_dict(),
-               os.path.join(checkpoint_dir, 'online_net.pth'))
-    online_net_script = torch.jit.script(self.online_net)
-    online_net_script.save(os.path.join(checkpoint_dir, 'online_net_script.pt'))
-
-  def save(self, checkpoint_type="last"):
+  def save_models(self, checkpoint_dir, snapshot=None):
+    if snapshot is None and self._checkpoint_writer is not None:
+      snapshot = self.snapshot_models()
+    online_net = self.online_net
+    if snapshot is not None:
+      online_net = copy.deepcopy(self.online_net)
+      online_net.load_state_dict(snapshot["online_net"])
+
+    def write():
+      os.makedirs(checkpoint_dir, exist_ok=True)
+      atomic_save(lambda path: torch.save(online_net.state_dict(), path),
+                  os.path.join(checkpoint_dir, 'online_net.pth'))
+      atomic_save(lambda path: torch.jit.script(online_net).save(path),
+                  os.path.join(checkpoint_dir, 'online_net_script.pt'))
+    self.write_checkpoint(write)
+
+  def save(self, checkpoint_type="last", snapshot=None):
     self.demonstration_collector_dir = self.demonstration_collector.GetDirectory()
-    super(ImitationAgent, self).save(checkpoint_type)
+    super(ImitationAgent, self).save(checkpoint_type, snapshot=snapshot)
 
   def load_other(self):
     if not self.demonstration_collector_dir or (
@@ -286,6 +337,7 @@ class ImitationAgent(BaseAgent):
     return self.online_net.nn_to_value_converter
 
   def load_models(self, checkpoint_dir):
+    self.flush_checkpoints()
     try:
       self.online_net.load_state_dict(
         torch.load(os.path.join(checkpoint_dir, 'online_net.pth')))
@@ -294,48 +346,59 @@ class ImitationAgent(BaseAgent):
         torch.load(os.path.join(checkpoint_dir, 'online_net.pth'), map_location=torch.device('cpu')))
 
   def evaluate_experiences(self, demonstrations):
-    states, action_values_desired = self.sample_batch(demonstrations, len(demonstrations))
+    # Evaluates all demonstrations in their order.
+    demonstrations = DemonstrationDataset.from_demonstrations(demonstrations)
+    states, action_values_desired = self.batch_to_device(
+      demonstrations[np.arange(len(demonstrations))])
     self.online_net.eval()  # Set to evaluation mode
     action_values_current = self.online_net(states)
     self.online_net.train()  # Set back to training mode
-    return  states.detach().numpy(), action_values_desired.detach().numpy(), action_values_current.detach().numpy()
+    return states.detach().cpu().numpy(), action_values_desired.detach().cpu().numpy(), \
+      action_values_current.detach().cpu().numpy()
 
 
   def train_episode(self):
-    states, action_values_desired = self.sample_batch(self.demonstrations_train, self.batch_size)
+    with self.throughput.Time("sample"):
+      states, action_values_desired = self.sample_training_batch()
 
-    self.optim.zero_grad()
-    action_values_current = self.online_net(states)
+    with self.throughput.Time("update"):
+      self.optim.zero_grad()
+      action_values_current = self.online_net(states)
 
-    converted_desired_values = self.convert_values(action_values_desired)
-    converted_current_values = self.convert_values(action_values_current)
+      converted_desired_values = self.convert_values(action_values_desired)
+      converted_current_values = self.convert_values(action_values_current)
 
-    loss = self.calculate_loss(converted_current_values, converted_desired_values, logits=True)
-    loss.backward()
-    self.optim.step()
+      loss = self.calculate_loss(converted_current_values, converted_desired_values, logits=True)
+      loss.backward()
+      self.optim.step()
+    self.throughput.Count("updates")
     self.training_log(loss, converted_current_values, converted_desired_values)
 
   def training_log(self, loss, current_values, desired_values):
-    self.running_loss.append(loss.item())
+    # synchronizes only when logging the running loss
+    self.running_loss.append(loss.detach())
     # We log evaluation results along with training frames = 4 * steps.
     if self.steps % self.summary_log_interval == 0:
         self.online_net.eval()
-        running_loss_avg = sum(self.running_loss)/len(self.running_loss)
+        running_loss_avg = self.running_loss.get()
 
         if self.do_logging:
-          logging.info(f"Training: Loss(i={self.steps}={running_loss_avg})")
+          self.metrics.log("Training: Loss(i=%d=%s)", self.steps, running_loss_avg)
         eval_results, _ = self._training_benchmark.evaluate_loss(
           running_loss_avg, current_values, desired_values, phase="train", logits=True)
 
         for eval_result_name, eval_result in eval_results.items():
-          self.writer.add_scalar(eval_result_name, eval_result, self.steps)
+          self.metrics.add_scalar(eval_result_name, eval_result, self.steps)
 
         self.online_net.train()
     if self.steps % self.eval_interval == 0:
       self.online_net.eval()
-      self.evaluate()
+      with self.throughput.Time("eval"):
+        self.evaluate()
       self.save("final")
       self.online_net.train()
+    if self.steps > 0 and self.steps % self.throughput_log_interval == 0:
+      self.log_throughput(self.steps)
     self.steps += 1
 
   def select_loss_function(self, params):
@@ -388,6 +451,8 @@ class ImitationAgent(BaseAgent):
     }
 
 class PolicyImitationAgent(ImitationAgent):
+  demonstration_targets = "policies"
+
   def __init__(self, *args, **kwargs):
     super(PolicyImitationAgent, self).__init__(*args, **kwargs)
 
@@ -410,22 +475,6 @@ class PolicyImitationAgent(ImitationAgent):
         "Policy": raw_values
     }
 
-  def sample_batch(self, demonstrations_list, batch_size):
-    state_size = len(demonstrations_list[0][0])
-    num_actions = len(demonstrations_list[0][2])
-    states = np.empty((batch_size, state_size), dtype=np.float)
-    policy_values = np.empty((batch_size, num_actions), dtype=np.float)
-
-    indices = np.random.randint(low=0, high=len(demonstrations_list), size=batch_size)
-    for i, index in enumerate(indices):
-      states[i, ...] = demonstrations_list[index][0]
-      policy_values[i, ...] = demonstrations_list[index][2]
-
-    states = torch.FloatTensor(states).to(self.device)
-    policy_values = torch.FloatTensor(policy_values).to(self.device)
-
-    return states, policy_values
-
   def init_network(self):
     # Target network.
     self.online_net = PolicyImitation(num_channels=self.observer.observation_space.shape[0],
@@ -14,7 +14,7 @@ from torch.optim import Adam
 
 from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.model import IQN
 from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.utils \
- import disable_gradients, update_params, \
+ import disable_gradients, debug_checks, \
  calculate_quantile_huber_loss, evaluate_quantile_at_action
 from .base_agent import BaseAgent
 
@@ -57,40 +57,35 @@ class IQNAgent(BaseAgent):
                       eps=1e-2 / self.batch_size)
 
   def learn(self):
-    self.learning_steps += 1
     self.online_net.sample_noise()
     self.target_net.sample_noise()
 
-    if self.use_per:
-      (states, actions, rewards, next_states, dones), weights = \
-       self.memory.sample(self.batch_size)
-    else:
-      states, actions, rewards, next_states, dones = \
-       self.memory.sample(self.batch_size)
-      weights = None
+    (states, actions, rewards, next_states, dones, steps), weights = \
+     self.sample_transitions()
 
     # Calculate features of states.
     state_embeddings = self.online_net.calculate_state_embeddings(states)
 
     quantile_loss, mean_q, errors = self.calculate_loss(
-        state_embeddings, actions, rewards, next_states, dones, weights)
+        state_embeddings, actions, rewards, next_states, dones, steps,
+        weights)
 
-    update_params(self.optim,
-                  quantile_loss,
-                  networks=[self.online_net],
-                  retain_graph=False,
-                  grad_cliping=self.grad_cliping)
+    self.update_params(self.optim,
+                       quantile_loss,
+                       networks=[self.online_net],
+                       retain_graph=False,
+                       grad_cliping=self.grad_cliping)
 
     if self.use_per:
-      self.memory.update_priority(errors)
+      self.update_priority(errors)
 
     if 4 * self.steps % self.summary_log_interval == 0:
-      self.writer.add_scalar('loss/quantile_loss',
-                             quantile_loss.detach().item(), 4 * self.steps)
-      self.writer.add_scalar('stats/mean_Q', mean_q, 4 * self.steps)
+      self.metrics.add_scalar('loss/quantile_loss',
+                              quantile_loss.detach(), 4 * self.steps)
+      self.metrics.add_scalar('stats/mean_Q', mean_q, 4 * self.steps)
 
   def calculate_loss(self, state_embeddings, actions, rewards, next_states,
-                     dones, weights):
+                     dones, steps, weights):
     # Sample fractions.
     taus = torch.rand(self.batch_size,
                       self.N,
@@ -102,7 +97,8 @@ class IQNAgent(BaseAgent):
         self.online_net.calculate_quantiles(taus,
                                             state_embeddings=state_embeddings),
         actions)
-    assert current_sa_quantiles.shape == (self.batch_size, self.N, 1)
+    if debug_checks():
+      assert current_sa_quantiles.shape == (self.batch_size, self.N, 1)
 
     with torch.no_grad():
       # Calculate Q values of next states.
@@ -119,7 +115,8 @@ class IQNAgent(BaseAgent):
 
       # Calculate greedy actions.
       next_actions = torch.argmax(next_q, dim=1, keepdim=True)
-      assert next_actions.shape == (self.batch_size, 1)
+      if debug_checks():
+        assert next_actions.shape == (self.batch_size, 1)
 
       # Calculate features of next states.
       if self.double_q_learning:
@@ -137,18 +134,22 @@ class IQNAgent(BaseAgent):
           self.target_net.calculate_quantiles(
               tau_dashes, state_embeddings=next_state_embeddings),
           next_actions).transpose(1, 2)
-      assert next_sa_quantiles.shape == (self.batch_size, 1, self.N_dash)
+      if debug_checks():
+        assert next_sa_quantiles.shape == (self.batch_size, 1, self.N_dash)
 
       # Calculate target quantile values.
       target_sa_quantiles = rewards[..., None] + (
-          1.0 - dones[..., None]) * self.gamma_n * next_sa_quantiles
-      assert target_sa_quantiles.shape == (self.batch_size, 1, self.N_dash)
+          1.0 - dones[..., None]) * self.gamma**steps[..., None] * \
+          next_sa_quantiles
+      if debug_checks():
+        assert target_sa_quantiles.shape == (self.batch_size, 1, self.N_dash)
 
     td_errors = target_sa_quantiles - current_sa_quantiles
-    assert td_errors.shape == (self.batch_size, self.N, self.N_dash)
+    if debug_checks():
+      assert td_errors.shape == (self.batch_size, self.N, self.N_dash)
 
     quantile_huber_loss = calculate_quantile_huber_loss(
         td_errors, taus, weights, self.kappa)
 
-    return quantile_huber_loss, next_q.detach().mean().item(), \
+    return quantile_huber_loss, next_q.detach().mean(), \
         td_errors.detach().abs()
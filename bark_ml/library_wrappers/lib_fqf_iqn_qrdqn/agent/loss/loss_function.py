@@ -11,6 +11,15 @@ def apply_sigmoid_to_dict(dict_values):
   return sigmoid_values
 
 
+def masked_mean(element_losses, present):
+  """
+  Mean of the element-wise losses over all values of the batch, missing
+  values contribute zero. The scale of each present value thus does not
+  depend on how many values of the batch are missing.
+  """
+  return torch.sum(element_losses * present) / present.numel()
+
+
 class Loss:
   """
   A helper class for calculating loss.
@@ -29,6 +38,9 @@ class Loss:
     If return_intermediate_losses==True, return not only the weighted loss,
     but also a dictionary with a loss for each of the value functions, e.g.:
       {"Return": 0.03, "Envelope": 0.02, "Collision": 0.01}
+
+    Missing (nan) desired values, e.g. of actions missing during the
+    demonstration collection, do not influence the loss.
     """
     if logits:
       # Transform raw output to values between 0 and 1
@@ -50,7 +62,12 @@ class Loss:
       weight = self._weights[value_func] if self._weights is not None else 1
       weights_sum += weight
 
-      loss = criterion(current_values[value_func], desired_values[value_func])
+      # the criteria return element-wise losses, which are masked without
+      # data-dependent indexing
+      present = ~torch.isnan(desired_values[value_func])
+      desired = torch.where(present, desired_values[value_func],
+                            torch.zeros_like(desired_values[value_func]))
+      loss = masked_mean(criterion(current_values[value_func], desired), present)
       losses[value_func] = weight * loss
 
     weighted_loss = sum(losses.values()) / weights_sum
@@ -63,15 +80,15 @@ class Loss:
 
 class LossMSE(Loss):
   def __init__(self, weights=None):
-    criterion = nn.MSELoss()
+    criterion = nn.MSELoss(reduction="none")
     super(LossMSE, self).__init__(criterion, weights)
 
 
 class LossBCE(Loss):
   def __init__(self, weights=None):
-    criterion = nn.BCELoss()
+    criterion = nn.BCELoss(reduction="none")
     super(LossBCE, self).__init__(criterion, weights)
-    self._criterion_logits = nn.BCEWithLogitsLoss()
+    self._criterion_logits = nn.BCEWithLogitsLoss(reduction="none")
 
   def _select_criterion(self, logits, _):
     if logits:
@@ -105,7 +122,7 @@ class LossHuber(Loss):
       loss = torch.where(error < self.delta,
                          error**2,
                          self.delta * (torch.abs(error) - self.delta / 2))
-      return loss.sum() / current_values.data.nelement()
+      return loss
 
     def __call__(self, current_values, desired_values):
       return self.normalizing_factor * self._unnormalized_loss(
@@ -148,7 +165,7 @@ class LossTukey(Loss):
       loss = torch.where(error < self.c,
                          self.c**2 / 6 * (1 - (1 - (error / self.c)**2)**3),
                          const)
-      return loss.sum() / current_values.data.nelement()
+      return loss
 
     def __call__(self, current_values, desired_values):
       return self.normalizing_factor * self._unnormalized_loss(
@@ -181,7 +198,7 @@ class LossEpsInsensitiveHuber(Loss):
       loss = torch.where((abs_error <= self.delta) & (abs_error > self.eps),
                          (abs_error - self.eps)**2,
                          loss)
-      return loss.sum() / current_values.data.nelement()
+      return loss
 
     def __call__(self, current_values, desired_values):
       return self.normalizing_factor * self._unnormalized_loss(
@@ -200,8 +217,7 @@ class LossRelative(Loss):
 
   def _loss(self, current_values, desired_values):
     error = current_values - desired_values
-    loss = torch.abs(error / (desired_values + self.eps))
-    return loss.sum() / current_values.data.nelement()
+    return torch.abs(error / (desired_values + self.eps))
 
 
 class LossPolicyCrossEntropy(Loss):
@@ -210,9 +226,13 @@ class LossPolicyCrossEntropy(Loss):
 
   def __call__(self, current_values, desired_values, logits, return_intermediate_losses=False):
     logsoftmax = nn.LogSoftmax(dim=1)
-    target = desired_values["Policy"]
+    present = ~torch.isnan(desired_values["Policy"])
+    target = torch.where(present, desired_values["Policy"],
+                         torch.zeros_like(desired_values["Policy"]))
     pred = current_values["Policy"]
-    loss = torch.mean(torch.sum(-target*logsoftmax(pred), 1))
+    # like masked_mean, averages over the whole batch with each row being
+    # one value
+    loss = torch.mean(torch.sum(-target*logsoftmax(pred)*present, 1))
     if return_intermediate_losses:  # Added to match the interface of other losses
       return loss, None
     return loss
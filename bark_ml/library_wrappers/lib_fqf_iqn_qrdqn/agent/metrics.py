@@ -0,0 +1,119 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Patrick Hart, Julian Bernhard, Klemens Esterle, and
+# Tobias Kessler, Mansoor Nasir
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import logging
+import threading
+from collections import deque
+import numpy as np
+
+
+class MetricsLogger:
+  """Buffers metrics and log messages and writes them in a background thread.
+
+  Recording only appends to a queue, values may also be tensors, which
+  are converted when written. Every `flush_interval` seconds or once
+  `flush_records` records are pending, the records are aggregated and
+  written to the summary `writer`:
+
+  - scalars as the mean of their values at their last step,
+  - counters as their running total,
+  - histograms with all their values.
+
+  Log messages are formatted with their args only when flushed, all of
+  them are written.
+
+  `close` stops the thread and writes the pending records, recording
+  again starts a new thread.
+  """
+  def __init__(self, writer, flush_interval=10., flush_records=10000):
+    self.writer = writer
+    self.flush_interval = flush_interval
+    self.flush_records = flush_records
+    self._records = deque()
+    self._totals = {}
+    self._flush_lock = threading.Lock()
+    self._wake = threading.Event()
+    self._stop = threading.Event()
+    self._thread = None
+    self._start()
+
+  def add_scalar(self, name, value, step):
+    self._append(("scalar", name, value, step))
+
+  def add_histogram(self, name, value, step):
+    self._append(("histogram", name, value, step))
+
+  def increment(self, name, step, count=1):
+    self._append(("counter", name, count, step))
+
+  def log(self, message, *args):
+    # e.g. log("return: %5.1f", episode_return)
+    self._append(("log", message, args, None))
+
+  def _append(self, record):
+    self._records.append(record)
+    if self._thread is None:
+      self._start()
+    if len(self._records) >= self.flush_records:
+      self._wake.set()
+
+  def _start(self):
+    self._stop.clear()
+    self._wake.clear()
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    while not self._stop.is_set():
+      self._wake.wait(self.flush_interval)
+      self._wake.clear()
+      try:
+        self.flush()
+      except Exception:
+        logging.exception("Could not write the metrics.")
+
+  def flush(self):
+    """Writes the pending records."""
+    with self._flush_lock:
+      # popleft is atomic, records appended meanwhile stay for the next flush
+      records = [self._records.popleft() for _ in range(len(self._records))]
+      scalars, counters, histograms, messages = {}, {}, {}, []
+      for kind, name, value, step in records:
+        if kind == "log":
+          messages.append((name, value))
+        elif kind == "scalar":
+          total, count, _ = scalars.get(name, (0., 0, step))
+          scalars[name] = (total + float(value), count + 1, step)
+        elif kind == "counter":
+          total, _ = counters.get(name, (0, step))
+          counters[name] = (total + value, step)
+        else:
+          if hasattr(value, "cpu"):
+            value = value.detach().cpu()
+          values, _ = histograms.get(name, ([], step))
+          values.append(np.asarray(value, dtype=np.float32).reshape(-1))
+          histograms[name] = (values, step)
+
+      for name, (total, count, step) in scalars.items():
+        self.writer.add_scalar(name, total / count, step)
+      for name, (count, step) in counters.items():
+        self._totals[name] = self._totals.get(name, 0) + count
+        self.writer.add_scalar(name, self._totals[name], step)
+      for name, (values, step) in histograms.items():
+        self.writer.add_histogram(name, np.concatenate(values), step)
+      for message, args in messages:
+        logging.info(message, *args)
+
+  def close(self):
+    """Stops the thread and writes the pending records."""
+    if self._thread is not None:
+      self._stop.set()
+      self._wake.set()
+      self._thread.join()
+      self._thread = None
+    self.flush()
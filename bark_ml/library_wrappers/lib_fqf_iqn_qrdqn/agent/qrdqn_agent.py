@@ -14,7 +14,7 @@ from torch.optim import Adam
 
 from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.model import QRDQN
 from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.utils \
- import disable_gradients, update_params, \
+ import disable_gradients, debug_checks, \
  calculate_quantile_huber_loss, evaluate_quantile_at_action
 from .base_agent import BaseAgent
 
@@ -60,42 +60,37 @@ class QRDQNAgent(BaseAgent):
     self.tau_hats = ((taus[1:] + taus[:-1]) / 2.0).view(1, self.N)
 
   def learn(self):
-    self.learning_steps += 1
     self.online_net.sample_noise()
     self.target_net.sample_noise()
 
-    if self.use_per:
-      (states, actions, rewards, next_states, dones), weights = \
-       self.memory.sample(self.batch_size)
-    else:
-      states, actions, rewards, next_states, dones = \
-       self.memory.sample(self.batch_size)
-      weights = None
+    (states, actions, rewards, next_states, dones, steps), weights = \
+     self.sample_transitions()
 
     quantile_loss, mean_q, errors = self.calculate_loss(
-        states, actions, rewards, next_states, dones, weights)
+        states, actions, rewards, next_states, dones, steps, weights)
 
-    update_params(self.optim,
-                  quantile_loss,
-                  networks=[self.online_net],
-                  retain_graph=False,
-                  grad_cliping=self.grad_cliping)
+    self.update_params(self.optim,
+                       quantile_loss,
+                       networks=[self.online_net],
+                       retain_graph=False,
+                       grad_cliping=self.grad_cliping)
 
     if self.use_per:
-      self.memory.update_priority(errors)
+      self.update_priority(errors)
 
     if 4 * self.steps % self.summary_log_interval == 0:
-      self.writer.add_scalar('loss/quantile_loss',
-                             quantile_loss.detach().item(), 4 * self.steps)
-      self.writer.add_scalar('stats/mean_Q', mean_q, 4 * self.steps)
+      self.metrics.add_scalar('loss/quantile_loss',
+                              quantile_loss.detach(), 4 * self.steps)
+      self.metrics.add_scalar('stats/mean_Q', mean_q, 4 * self.steps)
 
   def calculate_loss(self, states, actions, rewards, next_states, dones,
-                     weights):
+                     steps, weights):
 
     # Calculate quantile values of current states and actions at taus.
     current_sa_quantiles = evaluate_quantile_at_action(
         self.online_net(states=states), actions)
-    assert current_sa_quantiles.shape == (self.batch_size, self.N, 1)
+    if debug_checks():
+      assert current_sa_quantiles.shape == (self.batch_size, self.N, 1)
 
     with torch.no_grad():
       # Calculate Q values of next states.
@@ -109,23 +104,28 @@ class QRDQNAgent(BaseAgent):
 
       # Calculate greedy actions.
       next_actions = torch.argmax(next_q, dim=1, keepdim=True)
-      assert next_actions.shape == (self.batch_size, 1)
+      if debug_checks():
+        assert next_actions.shape == (self.batch_size, 1)
 
       # Calculate quantile values of next states and actions at tau_hats.
       next_sa_quantiles = evaluate_quantile_at_action(
           self.target_net(states=next_states), next_actions).transpose(1, 2)
-      assert next_sa_quantiles.shape == (self.batch_size, 1, self.N)
+      if debug_checks():
+        assert next_sa_quantiles.shape == (self.batch_size, 1, self.N)
 
       # Calculate target quantile values.
       target_sa_quantiles = rewards[..., None] + (
-          1.0 - dones[..., None]) * self.gamma_n * next_sa_quantiles
-      assert target_sa_quantiles.shape == (self.batch_size, 1, self.N)
+          1.0 - dones[..., None]) * self.gamma**steps[..., None] * \
+          next_sa_quantiles
+      if debug_checks():
+        assert target_sa_quantiles.shape == (self.batch_size, 1, self.N)
 
     td_errors = target_sa_quantiles - current_sa_quantiles
-    assert td_errors.shape == (self.batch_size, self.N, self.N)
+    if debug_checks():
+      assert td_errors.shape == (self.batch_size, self.N, self.N)
 
     quantile_huber_loss = calculate_quantile_huber_loss(
         td_errors, self.tau_hats, weights, self.kappa)
 
-    return quantile_huber_loss, next_q.detach().mean().item(), \
+    return quantile_huber_loss, next_q.detach().mean(), \
         td_errors.detach().abs()
@@ -1,2 +1,4 @@
 from .base import LazyMemory, LazyMultiStepMemory  # pylint: disable=unused-import
 from .per import LazyPrioritizedMultiStepMemory  # pylint: disable=unused-import
+from .mmap_memory import MemoryMappedMultiStepMemory, MemoryMappedPrioritizedMultiStepMemory  # pylint: disable=unused-import
+from .prefetcher import BatchPrefetcher  # pylint: disable=unused-import
@@ -1,163 +1,376 @@
 # The code is adapted from opensource implementation - https://github.com/ku2482/fqf-iqn-qrdqn.pytorch
 # MIT License -Copyright (c) 2020 Toshiki Watanabe
 
-from collections import deque
+import json
+import os
 import numpy as np
 import torch
 
-
-class MultiStepBuff:
-  def __init__(self, maxlen=3):
-    super(MultiStepBuff, self).__init__()
-    self.maxlen = int(maxlen)
-    self.reset()
-
-  def append(self, state, action, reward):
-    self.states.append(state)
-    self.actions.append(action)
-    self.rewards.append(reward)
-
-  def get(self, gamma=0.99):
-    assert len(self.rewards) > 0
-    state = self.states.popleft()
-    action = self.actions.popleft()
-    reward = self._nstep_return(gamma)
-    return state, action, reward
-
-  def _nstep_return(self, gamma):
-    r = np.sum([r * (gamma**i) for i, r in enumerate(self.rewards)])
-    self.rewards.popleft()
-    return r
-
-  def reset(self):
-    # Buffer to store n-step transitions.
-    self.states = deque(maxlen=self.maxlen)
-    self.actions = deque(maxlen=self.maxlen)
-    self.rewards = deque(maxlen=self.maxlen)
-
-  def is_empty(self):
-    return len(self.rewards) == 0
-
-  def is_full(self):
-    return len(self.rewards) == self.maxlen
-
-  def __len__(self):
-    return len(self.rewards)
+from .observation_encoder import ObservationEncoder
 
 
 class LazyMemory(dict):
-  state_keys = ['state', 'next_state']
-  np_keys = ['action', 'reward', 'done']
+  """Replay memory that stores every observation only once.
+
+  Each slot of the ring buffer holds one observation together with the
+  transition starting at it. The next state of a transition is the
+  observation stored in the slot `next_index` points to, which is either
+  the slot of the following step or, at the end of an episode, a slot
+  only holding the terminal observation. Slots without a (complete)
+  transition are marked as not `valid` and are never sampled.
+
+  Observations are stored with `state_dtype`. For integer dtypes they are
+  quantized between the `state_bounds` (low, high) of the observation
+  space and decoded again when sampling.
+  """
+  state_keys = ['state']
+  np_keys = ['action', 'reward', 'done', 'next_index', 'valid']
   keys = state_keys + np_keys
 
-  def __init__(self, capacity, state_shape, device):
+  def __init__(self, capacity, state_shape, device, state_dtype="float32",
+               state_bounds=None):
     super(LazyMemory, self).__init__()
     self.capacity = int(capacity)
     self.state_shape = state_shape
     self.device = device
+    self.encoder = ObservationEncoder(state_shape, state_dtype, state_bounds)
     self.reset()
 
   def reset(self):
-    self['state'] = []
-    self['next_state'] = []
-
-    self['action'] = np.empty((self.capacity, 1), dtype=np.int64)
-    self['reward'] = np.empty((self.capacity, 1), dtype=np.float32)
-    self['done'] = np.empty((self.capacity, 1), dtype=np.float32)
+    # Observations are stored in preallocated ring buffers, so appending
+    # and overwriting the oldest transition is O(1).
+    self['state'] = self._allocate('state',
+                                   (self.capacity, *self.state_shape),
+                                   self.encoder.dtype)
+
+    self['action'] = self._allocate('action', (self.capacity, 1), np.int64)
+    self['reward'] = self._allocate('reward', (self.capacity, 1), np.float32)
+    self['done'] = self._allocate('done', (self.capacity, 1), np.float32)
+    self['next_index'] = self._allocate('next_index', (self.capacity,),
+                                        np.int64)
+    self['valid'] = self._allocate('valid', (self.capacity,), bool)
 
     self._n = 0
     self._p = 0
+    self._num_valid = 0
+    # Number of slots written since the reset, i.e. the absolute position
+    # of the write pointer.
+    self._total = 0
+    # Slot of the newest next state of the running episode, which is the
+    # state of the following step.
+    self._pending_index = None
+
+  def _allocate(self, key, shape, dtype):
+    # Zero-initialized column of the memory.
+    return np.zeros(shape, dtype=dtype)
 
   def append(self, state, action, reward, next_state, done, episode_done=None):
-    self._append(state, action, reward, next_state, done)
-
-  def _append(self, state, action, reward, next_state, done):
-    self['state'].append(state)
-    self['next_state'].append(next_state)
-    self['action'][self._p] = action
-    self['reward'][self._p] = reward
-    self['done'][self._p] = done
+    """Adds the transition of a step.
+
+    The steps of an episode have to be appended in order and its last step
+    has to set `episode_done`, which defaults to `done` and also ends an
+    episode at a timeout. The `state` of a step is only stored if its value
+    differs from the `next_state` of the previous step of the episode, so
+    it may be a copy or conversion of that observation.
+    """
+    if episode_done is None:
+      episode_done = done
+    state_index, next_index = self._store_step(state, next_state,
+                                               episode_done)
+    self._append(state_index, action, reward, next_index, done)
+
+  def _store_observation(self, encoded_observation):
+    index = self._p
+    self._invalidate(index)
+    self['state'][index] = encoded_observation
 
     self._n = min(self._n + 1, self.capacity)
     self._p = (self._p + 1) % self.capacity
-
-    self.truncate()
-
-  def truncate(self):
-    while len(self) > self.capacity:
-      del self['state'][0]
-      del self['next_state'][0]
+    self._total += 1
+    return index
+
+  def _store_step(self, state, next_state, episode_done):
+    # NOTE: the state of a step is the next state of the previous step of
+    # the same episode, which is then already stored.
+    encoded_state = self.encoder.encode(state)
+    if self._pending_index is not None and \
+        np.array_equal(encoded_state, self['state'][self._pending_index]):
+      state_index = self._pending_index
+    else:
+      state_index = self._store_observation(encoded_state)
+    next_index = self._store_observation(self.encoder.encode(next_state))
+
+    self._pending_index = None if episode_done else next_index
+    return state_index, next_index
+
+  def _append(self, state_index, action, reward, next_index, done):
+    self['action'][state_index] = action
+    self['reward'][state_index] = reward
+    self['done'][state_index] = done
+    self['next_index'][state_index] = next_index
+    if not self['valid'][state_index]:
+      self['valid'][state_index] = True
+      self._num_valid += 1
+
+  def _invalidate(self, index):
+    if self['valid'][index]:
+      self['valid'][index] = False
+      self._num_valid -= 1
+
+  def _unready_indices(self):
+    # Valid slots that can not be sampled yet.
+    return np.empty(0, dtype=np.int64)
+
+  def _sampleable(self, indices, unready):
+    return self['valid'][indices] & ~np.isin(indices, unready)
+
+  def _resample_invalid(self, indices, draw):
+    # Slots only holding (terminal) observations and transitions that can
+    # not be sampled yet are rejected and redrawn.
+    unready = self._unready_indices()
+    if self._num_valid <= len(unready):
+      raise ValueError("Memory has no transitions that can be sampled yet.")
+    invalid = ~self._sampleable(indices, unready)
+    while invalid.any():
+      indices[invalid] = draw(np.count_nonzero(invalid))
+      invalid = ~self._sampleable(indices, unready)
+    return indices
 
   def sample(self, batch_size):
-    indices = np.random.randint(low=0, high=len(self), size=batch_size)
+    indices = self._resample_invalid(
+        np.random.randint(low=0, high=self._n, size=batch_size),
+        lambda size: np.random.randint(low=0, high=self._n, size=size))
     return self._sample(indices, batch_size)
 
-  def _sample(self, indices, batch_size):
-    bias = -self._p if self._n == self.capacity else 0
-
-    states = np.empty((batch_size, *self.state_shape), dtype=np.uint8)
-    next_states = np.empty((batch_size, *self.state_shape), dtype=np.uint8)
+  def _transitions(self, indices):
+    # Rewards, slots of the next states, dones and the number of steps to
+    # the next states.
+    return self['reward'][indices], self['next_index'][indices], \
+      self['done'][indices], np.ones((len(indices), 1), dtype=np.float32)
 
-    for i, index in enumerate(indices):
-      _index = np.mod(index + bias, self.capacity)
-      states[i, ...] = self['state'][_index]
-      next_states[i, ...] = self['next_state'][_index]
+  def _sample(self, indices, batch_size):
+    indices = np.asarray(indices)
+    rewards, next_indices, dones, steps = self._transitions(indices)
 
-    states = torch.ByteTensor(states).to(self.device).float() / 255.
-    next_states = torch.ByteTensor(next_states).to(self.device).float() / 255.
+    states = self.encoder.decode(self['state'][indices], self.device)
+    next_states = self.encoder.decode(self['state'][next_indices], self.device)
     actions = torch.LongTensor(self['action'][indices]).to(self.device)
-    rewards = torch.FloatTensor(self['reward'][indices]).to(self.device)
-    dones = torch.FloatTensor(self['done'][indices]).to(self.device)
+    rewards = torch.from_numpy(rewards).to(self.device)
+    dones = torch.FloatTensor(dones).to(self.device)
+    steps = torch.from_numpy(steps).to(self.device)
 
-    return states, actions, rewards, next_states, dones
+    return states, actions, rewards, next_states, dones, steps
 
   def __len__(self):
-    return len(self['state'])
+    return self._num_valid
+
+  def _ordered_indices(self):
+    # Indices of the stored slots from the oldest to the newest one.
+    return np.arange(self._p - self._n, self._p) % self.capacity
 
   def get(self):
-    return dict(self)
+    indices = self._ordered_indices()
+    memory = {key: self[key][indices] for key in self.keys}
+    # Next indices refer to the positions in the returned arrays.
+    memory['next_index'] = \
+      (memory['next_index'] - (self._p - self._n)) % self.capacity
+    return memory
 
   def load(self, memory):
-    for key in self.state_keys:
-      self[key].extend(memory[key])
-
     num_data = len(memory['state'])
-    if self._p + num_data <= self.capacity:
-      for key in self.np_keys:
-        self[key][self._p:self._p + num_data] = memory[key]
-    else:
-      mid_index = self.capacity - self._p
-      end_index = num_data - mid_index
-      for key in self.np_keys:
-        self[key][self._p:] = memory[key][:mid_index]
-        self[key][:end_index] = memory[key][mid_index:]
+    # Only the newest slots fit if there are more than the capacity.
+    offset = max(0, num_data - self.capacity)
+    num_data -= offset
+
+    indices = np.arange(self._p, self._p + num_data) % self.capacity
+    for index in indices:
+      self._invalidate(index)
+    for key in self.keys:
+      self[key][indices] = np.asarray(memory[key][offset:]).reshape(
+          self[key][indices].shape)
+    self['next_index'][indices] = \
+      (self['next_index'][indices] - offset + self._p) % self.capacity
+    self._num_valid += int(np.count_nonzero(self['valid'][indices]))
 
     self._n = min(self._n + num_data, self.capacity)
     self._p = (self._p + num_data) % self.capacity
-    self.truncate()
-    assert self._n == len(self)
+    self._total += num_data
+    self._pending_index = None
+
+  def _checkpoint_extra(self):
+    return {}
+
+  def _restore_extra(self, data):
+    pass
+
+  def _write_slots(self, path, start, end, **extra):
+    indices = np.arange(start, end) % self.capacity
+    data = {key: self[key][indices] for key in self.keys
+            if key != 'next_index'}
+    # Next states are stored relative to their slot.
+    data['next_offset'] = (self['next_index'][indices] - indices) % \
+      self.capacity
+    with open(path + ".tmp", 'wb') as f:
+      np.savez(f, **data, **extra)
+    os.replace(path + ".tmp", path)
+
+  def checkpoint(self, directory):
+    """Writes the memory as chunks of its columns to `directory`.
+
+    Only the slots added since the last checkpoint to `directory` are
+    written as a new chunk. The newest slot, whose transition may still
+    change, is rewritten on every checkpoint. The manifest listing the
+    chunks is replaced atomically and chunks that left the ring buffer
+    are deleted afterwards.
+    """
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    manifest_path = os.path.join(directory, "manifest.json")
+    manifest = {"capacity": self.capacity, "total": 0, "final_end": 0,
+                "chunks": []}
+    if os.path.exists(manifest_path):
+      with open(manifest_path, 'r') as f:
+        previous_manifest = json.load(f)
+      # Continue the chunks unless the memory was reset in between.
+      if previous_manifest["capacity"] == self.capacity and \
+         previous_manifest["total"] <= self._total:
+        manifest = previous_manifest
+
+    window_start = self._total - self._n
+    final_end = max(manifest["final_end"], window_start,
+                    self._total - 1)
+    start = max(manifest["final_end"], window_start)
+    chunks = [chunk for chunk in manifest["chunks"] if chunk[1] > window_start]
+    if start < final_end:
+      filename = f"chunk_{start}_{final_end}.npz"
+      self._write_slots(os.path.join(directory, filename), start, final_end)
+      chunks.append([start, final_end, filename])
+    recent = f"recent_{self._total}.npz"
+    self._write_slots(os.path.join(directory, recent), final_end,
+                      self._total, **self._checkpoint_extra())
+
+    manifest = {"capacity": self.capacity, "total": self._total,
+                "final_end": final_end, "chunks": chunks, "recent": recent}
+    with open(manifest_path + ".tmp", 'w') as f:
+      json.dump(manifest, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    used_files = set([chunk[2] for chunk in chunks] + [recent])
+    for filename in os.listdir(directory):
+      if filename.endswith(".npz") and filename not in used_files:
+        os.remove(os.path.join(directory, filename))
+
+  def restore(self, directory):
+    """Restores a memory written by `checkpoint` into the reset memory."""
+    with open(os.path.join(directory, "manifest.json"), 'r') as f:
+      manifest = json.load(f)
+    if manifest["capacity"] != self.capacity:
+      raise ValueError("Memory checkpoint has a different capacity.")
+
+    total = manifest["total"]
+    window_start = max(0, total - self.capacity)
+    parts = manifest["chunks"] + \
+      [[manifest["final_end"], total, manifest["recent"]]]
+    for start, end, filename in parts:
+      begin = max(start, window_start)
+      if begin >= end:
+        continue
+      with np.load(os.path.join(directory, filename)) as data:
+        selection = slice(begin - start, end - start)
+        indices = np.arange(begin, end) % self.capacity
+        for key in self.keys:
+          if key != 'next_index':
+            self[key][indices] = data[key][selection]
+        self['next_index'][indices] = \
+          (indices + data['next_offset'][selection]) % self.capacity
+        if filename == manifest["recent"]:
+          self._restore_extra(data)
+
+    self._total = total
+    self._n = total - window_start
+    self._p = total % self.capacity
+    self._num_valid = int(np.count_nonzero(self['valid']))
+    self._pending_index = None
 
 
 class LazyMultiStepMemory(LazyMemory):
-  def __init__(self, capacity, state_shape, device, gamma=0.99, multi_step=3):
-    super(LazyMultiStepMemory, self).__init__(capacity, state_shape, device)
+  """Replay memory returning n-step transitions.
+
+  The slots hold one-step transitions. The n-step returns are computed
+  when sampling by following the `next_index` chains of the sampled slots
+  for `multi_step` steps, so `multi_step` can be changed without refilling
+  the memory. Transitions whose chain still waits for steps of the running
+  episode are not sampled. Chains ending early at a timeout or a missing
+  step return their number of steps to bootstrap from the last next state.
+  """
+  def __init__(self, capacity, state_shape, device, gamma=0.99, multi_step=3,
+               state_dtype="float32", state_bounds=None):
+    super(LazyMultiStepMemory, self).__init__(capacity, state_shape, device,
+                                              state_dtype, state_bounds)
 
     self.gamma = gamma
-    self.multi_step = int(multi_step)
-    if self.multi_step != 1:
-      self.buff = MultiStepBuff(maxlen=self.multi_step)
-
-  def append(self, state, action, reward, next_state, done):
-    if self.multi_step != 1:
-      self.buff.append(state, action, reward)
-
-      if self.buff.is_full():
-        state, action, reward = self.buff.get(self.gamma)
-        self._append(state, action, reward, next_state, done)
-
-      if done:
-        while not self.buff.is_empty():
-          state, action, reward = self.buff.get(self.gamma)
-          self._append(state, action, reward, next_state, done)
-    else:
-      self._append(state, action, reward, next_state, done)
+    self.multi_step = multi_step
+
+  @property
+  def multi_step(self):
+    return self._multi_step
+
+  @multi_step.setter
+  def multi_step(self, multi_step):
+    self._multi_step = int(multi_step)
+    assert self._multi_step >= 1
+    self._discounts = self.gamma**np.arange(self._multi_step,
+                                            dtype=np.float32)
+
+  def append(self, state, action, reward, next_state, done, episode_done=None):
+    self._append_multi_step(state, action, reward, next_state, done,
+                            episode_done)
+
+  def _append_multi_step(self, state, action, reward, next_state, done,
+                         episode_done, *args):
+    if episode_done is None:
+      episode_done = done
+    state_index, next_index = self._store_step(state, next_state,
+                                               episode_done)
+    self._append(state_index, action, reward, next_index, done, *args)
+
+  def _chains(self, indices):
+    # Slots of the one-step transitions following the transitions of
+    # `indices`, stopping at the end of the episode or the stored steps.
+    chains = np.empty((self.multi_step, len(indices)), dtype=np.int64)
+    chains[0] = indices
+    lengths = np.ones(len(indices), dtype=np.int64)
+    running = self['done'][indices, 0] == 0.
+    for step in range(1, self.multi_step):
+      next_indices = self['next_index'][chains[step - 1]]
+      running &= self['valid'][next_indices]
+      chains[step] = np.where(running, next_indices, chains[step - 1])
+      lengths += running
+      running &= self['done'][chains[step], 0] == 0.
+    return chains, lengths
+
+  def _unready_indices(self):
+    # Only the newest steps of the running episode can lack steps.
+    if self._pending_index is None or self.multi_step == 1:
+      return np.empty(0, dtype=np.int64)
+    indices = (self._pending_index - np.arange(1, self.multi_step)) % \
+      self.capacity
+    indices = indices[self['valid'][indices]]
+    chains, lengths = self._chains(indices)
+    last = chains[lengths - 1, np.arange(len(indices))]
+    unready = (lengths < self.multi_step) & \
+      (self['done'][last, 0] == 0.) & \
+      (self['next_index'][last] == self._pending_index)
+    return indices[unready]
+
+  def _transitions(self, indices):
+    if self.multi_step == 1:
+      return super()._transitions(indices)
+    chains, lengths = self._chains(indices)
+    last = chains[lengths - 1, np.arange(len(indices))]
+    # Discounted sum of the rewards along the chains.
+    within = np.arange(self.multi_step)[:, None] < lengths
+    rewards = np.sum(self['reward'][chains, 0] * within *
+                     self._discounts[:, None], axis=0)
+    return rewards[:, None].astype(np.float32), self['next_index'][last], \
+      self['done'][last], lengths[:, None].astype(np.float32)
@@ -0,0 +1,114 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Patrick Hart, Julian Bernhard, Klemens Esterle, and
+# Tobias Kessler, Mansoor Nasir
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import json
+import os
+import numpy as np
+
+from .base import LazyMultiStepMemory
+from .per import LazyPrioritizedMultiStepMemory
+
+
+def reattach_memory(cls, directory, args, kwargs):
+  return cls(directory, *args, reattach=True, **kwargs)
+
+
+class MemoryMappedStorage:
+  """Stores the columns of a replay memory in memory-mapped files.
+
+  Every column is a `.npy` file in `directory`, so the operating system
+  keeps only the frequently sampled pages in RAM. `flush` persists the
+  write pointers next to the columns; pickling the memory flushes it and
+  stores only its directory and arguments, so unpickling reattaches to
+  the files. Data appended after the last flush may be partially lost.
+  """
+
+  metadata_filename = "memory.json"
+
+  def __init__(self, directory, *args, reattach=False, **kwargs):
+    self.directory = os.path.abspath(directory)
+    self._init_args = args
+    self._init_kwargs = kwargs
+    self._reattach = reattach
+    if not os.path.exists(self.directory):
+      os.makedirs(self.directory)
+    super().__init__(*args, **kwargs)
+    if reattach:
+      with open(os.path.join(self.directory,
+                             self.metadata_filename), 'r') as f:
+        self._restore(json.load(f))
+    self._reattach = False
+
+  def _allocate(self, key, shape, dtype):
+    path = os.path.join(self.directory, f"{key}.npy")
+    if self._reattach:
+      column = np.load(path, mmap_mode="r+")
+      if column.shape != tuple(shape) or column.dtype != np.dtype(dtype):
+        raise ValueError(
+          f"Column {path} does not match the memory configuration.")
+      return column
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype,
+                                     shape=tuple(shape))
+
+  def _metadata(self):
+    return {"n": self._n, "p": self._p, "total": self._total}
+
+  def _restore(self, metadata):
+    self._n = metadata["n"]
+    self._p = metadata["p"]
+    self._total = metadata["total"]
+    self._num_valid = int(np.count_nonzero(self['valid']))
+
+  def flush(self):
+    for key in self.keys:
+      self[key].flush()
+    # Written to a temporary file first, so a crash keeps the old pointers.
+    path = os.path.join(self.directory, self.metadata_filename)
+    with open(path + ".tmp", 'w') as f:
+      json.dump(self._metadata(), f)
+    os.replace(path + ".tmp", path)
+
+  def checkpoint(self, directory):
+    # The columns already live on disk.
+    self.flush()
+
+  def __reduce__(self):
+    self.flush()
+    return (reattach_memory, (self.__class__, self.directory,
+                              self._init_args, self._init_kwargs))
+
+
+class MemoryMappedMultiStepMemory(MemoryMappedStorage, LazyMultiStepMemory):
+  pass
+
+
+class MemoryMappedPrioritizedMultiStepMemory(MemoryMappedStorage,
+                                             LazyPrioritizedMultiStepMemory):
+  def reset(self):
+    super().reset()
+    # Priorities are only written on flush and restore the trees.
+    self['priority'] = self._allocate('priority', (self.capacity,),
+                                      np.float64)
+
+  def _metadata(self):
+    metadata = super()._metadata()
+    metadata["beta"] = self.beta
+    return metadata
+
+  def _restore(self, metadata):
+    super()._restore(metadata)
+    self.beta = metadata["beta"]
+    indices = np.flatnonzero(self['valid'])
+    if len(indices) > 0:
+      self.it_sum[indices] = self['priority'][indices]
+      self.it_min[indices] = self['priority'][indices]
+
+  def flush(self):
+    self['priority'][:] = self.it_sum[np.arange(self.capacity)]
+    self['priority'].flush()
+    super().flush()
@@ -0,0 +1,62 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Patrick Hart, Julian Bernhard, Klemens Esterle, and
+# Tobias Kessler, Mansoor Nasir
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import numpy as np
+import torch
+
+
+class ObservationEncoder:
+  """Converts observations to and from the storage dtype of a memory.
+
+  Floating point dtypes store the observations as they are. Integer
+  dtypes quantize every feature linearly between the bounds of the
+  observation space, i.e. with a per-feature scale and offset.
+  """
+
+  def __init__(self, state_shape, dtype="float32", bounds=None):
+    self.dtype = np.dtype(dtype)
+    self.quantized = np.issubdtype(self.dtype, np.integer)
+    self.scale = None
+    self.offset = None
+
+    if self.quantized:
+      if bounds is None:
+        raise ValueError(
+          f"Storing observations as {self.dtype} requires the bounds "
+          "of the observation space.")
+      low = np.broadcast_to(np.asarray(bounds[0], dtype=np.float64),
+                            state_shape)
+      high = np.broadcast_to(np.asarray(bounds[1], dtype=np.float64),
+                             state_shape)
+      if not (np.all(np.isfinite(low)) and np.all(np.isfinite(high))):
+        raise ValueError(
+          "Quantized observations require finite observation space bounds.")
+
+      info = np.iinfo(self.dtype)
+      scale = (high - low) / (float(info.max) - float(info.min))
+      # Constant features are mapped to their lower bound.
+      scale = np.where(scale > 0., scale, 1.)
+      self.scale = scale.astype(np.float32)
+      self.offset = (low - info.min * scale).astype(np.float32)
+      self._min = info.min
+      self._max = info.max
+
+  def encode(self, observations):
+    if not self.quantized:
+      return np.asarray(observations, dtype=self.dtype)
+    quantized = np.rint(
+      (np.asarray(observations, dtype=np.float32) - self.offset) / self.scale)
+    return np.clip(quantized, self._min, self._max).astype(self.dtype)
+
+  def decode(self, stored, device):
+    # NOTE: converts the whole batch at once after moving it to the device.
+    states = torch.from_numpy(np.ascontiguousarray(stored)).to(device).float()
+    if self.quantized:
+      states = states * torch.from_numpy(self.scale).to(device) + \
+        torch.from_numpy(self.offset).to(device)
+    return states
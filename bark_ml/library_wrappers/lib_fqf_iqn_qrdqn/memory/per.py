@@ -20,8 +20,11 @@ class LazyPrioritizedMultiStepMemory(LazyMultiStepMemory):
                beta_steps=2e5,
                min_pa=0.0,
                max_pa=1.0,
-               eps=0.01):
-    super().__init__(capacity, state_shape, device, gamma, multi_step)
+               eps=0.01,
+               state_dtype="float32",
+               state_bounds=None):
+    super().__init__(capacity, state_shape, device, gamma, multi_step,
+                     state_dtype, state_bounds)
 
     self.alpha = alpha
     self.beta = beta
@@ -40,63 +43,96 @@ class LazyPrioritizedMultiStepMemory(LazyMultiStepMemory):
   def _pa(self, p):
     return np.clip((p + self.eps)**self.alpha, self.min_pa, self.max_pa)
 
-  def append(self, state, action, reward, next_state, done, p=None):
+  def append(self, state, action, reward, next_state, done, p=None,
+             episode_done=None):
     # Calculate priority.
     if p is None:
       pa = self.max_pa
     else:
       pa = self._pa(p)
 
-    if self.multi_step != 1:
-      self.buff.append(state, action, reward)
+    self._append_multi_step(state, action, reward, next_state, done,
+                            episode_done, pa)
 
-      if self.buff.is_full():
-        state, action, reward = self.buff.get(self.gamma)
-        self._append(state, action, reward, next_state, done, pa)
-
-      if done:
-        while not self.buff.is_empty():
-          state, action, reward = self.buff.get(self.gamma)
-          self._append(state, action, reward, next_state, done, pa)
-    else:
-      self._append(state, action, reward, next_state, done, pa)
-
-  def _append(self, state, action, reward, next_state, done, pa):
+  def _append(self, state_index, action, reward, next_index, done, pa):
     # Store priority, which is done efficiently by SegmentTree.
-    self.it_min[self._p] = pa
-    self.it_sum[self._p] = pa
-    super()._append(state, action, reward, next_state, done)
+    self.it_min[state_index] = pa
+    self.it_sum[state_index] = pa
+    super()._append(state_index, action, reward, next_index, done)
+
+  def _invalidate(self, index):
+    # Slots without a transition must never be sampled.
+    if self['valid'][index]:
+      self.it_min[index] = float("inf")
+      self.it_sum[index] = 0.0
+    super()._invalidate(index)
+
+  def load(self, memory):
+    super().load(memory)
+    indices = np.flatnonzero(self['valid'])
+    indices = indices[self.it_sum[indices] == 0.0]
+    if len(indices) > 0:
+      self.it_min[indices] = self.max_pa
+      self.it_sum[indices] = self.max_pa
+
+  def _checkpoint_extra(self):
+    # Priorities change with every update and are rewritten in full.
+    return {"priority": self.it_sum[np.arange(self.capacity)],
+            "beta": np.array(self.beta)}
+
+  def _restore_extra(self, data):
+    self.beta = float(data["beta"])
+    indices = np.arange(self.capacity)
+    self.it_sum[indices] = data["priority"]
+    self.it_min[indices] = np.where(data["priority"] > 0.,
+                                    data["priority"], float("inf"))
 
   def _sample_idxes(self, batch_size):
     total_pa = self.it_sum.sum(0, self._n)
-    rands = np.random.rand(batch_size) * total_pa
-    indices = [self.it_sum.find_prefixsum_idx(r) for r in rands]
+    draw = lambda size: self.it_sum.find_prefixsum_idx(
+        np.random.rand(size) * total_pa)
+    indices = self._resample_invalid(draw(batch_size), draw)
     self.beta = min(1., self.beta + self.beta_diff)
     return indices
 
   def sample(self, batch_size):
     assert self._cached is None, 'Update priorities before sampling.'
 
-    self._cached = self._sample_idxes(batch_size)
-    batch = self._sample(self._cached, batch_size)
-    weights = self._calc_weights(self._cached)
-    return batch, weights
+    batch, self._cached = self.sample_batch(batch_size)
+    return batch
+
+  def sample_batch(self, batch_size):
+    """Samples a batch without waiting for the priorities of the last one.
+
+    Returns the batch with its importance sampling weights and the sampled
+    slots, whose priorities are set by `update_priority(errors, slots)`.
+    Other batches may be sampled and updated in between.
+    """
+    indices = self._sample_idxes(batch_size)
+    batch = self._sample(indices, batch_size)
+    weights = self._calc_weights(indices)
+    return (batch, weights), (indices, self._total)
 
   def _calc_weights(self, indices):
     min_pa = self.it_min.min()
-    weights = [(self.it_sum[i] / min_pa)**-self.beta for i in indices]
-    return torch.FloatTensor(weights).to(self.device).view(-1, 1)
+    weights = (self.it_sum[indices] / min_pa)**-self.beta
+    return torch.from_numpy(weights.astype(np.float32)).to(self.device).view(-1, 1)
 
-  def update_priority(self, errors):
-    assert self._cached is not None
+  def update_priority(self, errors, slots=None):
+    if slots is None:
+      assert self._cached is not None
+      slots, self._cached = self._cached, None
+    indices, total = slots
 
     ps = errors.detach().cpu().abs().numpy().flatten()
-    pas = self._pa(ps)
-
-    for index, pa in zip(self._cached, pas):
-      assert 0 <= index < self._n
-      assert 0 < pa
-      self.it_sum[index] = pa
-      self.it_min[index] = pa
-
-    self._cached = None
+    # NOTE: as before, the i-th error is used for the i-th sampled index.
+    pas = self._pa(ps[:len(indices)])
+
+    assert np.all((0 <= indices) & (indices < self._n))
+    assert np.all(0 < pas)
+    # Slots written since sampling hold other transitions now.
+    num_written = min(self._total - total, self.capacity)
+    written = (self._p - np.arange(1, num_written + 1)) % self.capacity
+    kept = ~np.isin(indices, written)
+    self.it_sum[indices[kept]] = pas[kept]
+    self.it_min[indices[kept]] = pas[kept]
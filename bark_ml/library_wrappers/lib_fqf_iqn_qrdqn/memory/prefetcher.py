@@ -0,0 +1,85 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Patrick Hart, Julian Bernhard, Klemens Esterle, and
+# Tobias Kessler, Mansoor Nasir
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import collections
+import queue
+import threading
+
+
+class BatchPrefetcher:
+  """Samples batches from a replay memory in a background thread.
+
+  The thread samples while the learner computes its update or the agent
+  steps the environment. Appending to and sampling from the memory are
+  serialized with `lock`. Up to `depth` batches are kept ready.
+
+  Prioritized memories are sampled with `sample_batch`, i.e. the ready
+  batches are drawn from the priorities before the updates of the
+  batches handed out earlier. `update_priority` applies the errors to the
+  oldest batch whose priorities are not updated yet.
+
+  Errors raised while sampling are raised by `get`, later calls of `get`
+  sample again.
+  """
+  def __init__(self, memory, batch_size, depth=2):
+    self.memory = memory
+    self.batch_size = batch_size
+    self.lock = threading.Lock()
+    self._prioritized = hasattr(memory, "update_priority")
+    self._batches = queue.Queue()
+    # Sampled slots of the handed out batches of prioritized memories.
+    self._slots = collections.deque()
+    self._permits = threading.Semaphore(depth)
+    self._raised = threading.Event()
+    self._stopped = False
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    while True:
+      self._permits.acquire()
+      if self._stopped:
+        return
+      try:
+        with self.lock:
+          if self._prioritized:
+            batch = self.memory.sample_batch(self.batch_size)
+          else:
+            batch = self.memory.sample(self.batch_size)
+      except Exception as exception:
+        batch = exception
+      self._batches.put(batch)
+      if isinstance(batch, Exception):
+        # Samples again once `get` raised the error.
+        self._raised.wait()
+        self._raised.clear()
+
+  def append(self, *args, **kwargs):
+    with self.lock:
+      self.memory.append(*args, **kwargs)
+
+  def get(self):
+    batch = self._batches.get()
+    self._permits.release()
+    if isinstance(batch, Exception):
+      self._raised.set()
+      raise batch
+    if self._prioritized:
+      batch, slots = batch
+      self._slots.append(slots)
+    return batch
+
+  def update_priority(self, errors):
+    with self.lock:
+      self.memory.update_priority(errors, self._slots.popleft())
+
+  def close(self):
+    self._stopped = True
+    self._permits.release()
+    self._raised.set()
+    self._thread.join()
@@ -2,15 +2,25 @@
 # MIT License -Copyright (c) 2020 Toshiki Watanabe
 
 import operator
+import numpy as np
 
 
 class SegmentTree:
-  def __init__(self, size, op, init_val):
+  """Array-backed segment tree.
+
+  The nodes are stored in a NumPy array with the root at index 1 and the
+  leaves at [size, 2 * size). Setting and getting items accepts single
+  indices as well as arrays of indices; batched updates recompute the
+  touched ancestors level by level.
+  """
+
+  def __init__(self, size, op, ufunc, init_val):
     assert size > 0 and size & (size - 1) == 0
     self._size = size
     self._op = op
+    self._ufunc = ufunc
     self._init_val = init_val
-    self._values = [init_val for _ in range(2 * size)]
+    self._values = np.full(2 * size, init_val, dtype=np.float64)
 
   def _reduce(self, start=0, end=None):
     if end is None:
@@ -18,6 +28,9 @@ class SegmentTree:
     elif end < 0:
       end += self._size
 
+    if start == 0 and end == self._size:
+      return float(self._values[1])
+
     start += self._size
     end += self._size
 
@@ -34,53 +47,78 @@ class SegmentTree:
       start //= 2
       end //= 2
 
-    return res
+    return float(res)
 
   def __setitem__(self, idx, val):
-    assert 0 <= idx < self._size
+    if np.ndim(idx) == 0:
+      assert 0 <= idx < self._size
+
+      # Set value.
+      idx += self._size
+      self._values[idx] = val
 
-    # Set value.
-    idx += self._size
+      # Update its ancestors iteratively.
+      idx = idx >> 1
+      while idx >= 1:
+        left = 2 * idx
+        self._values[idx] = \
+         self._op(self._values[left], self._values[left + 1])
+        idx = idx >> 1
+      return
+
+    idx = np.asarray(idx, dtype=np.int64)
+    assert np.all((0 <= idx) & (idx < self._size))
+
+    # Set values, for duplicate indices the last value is used.
+    idx = idx + self._size
     self._values[idx] = val
 
-    # Update its ancestors iteratively.
-    idx = idx >> 1
-    while idx >= 1:
+    # Update only the touched ancestors, one level at a time.
+    idx = np.unique(idx >> 1)
+    while idx[0] >= 1:
       left = 2 * idx
       self._values[idx] = \
-       self._op(self._values[left], self._values[left + 1])
-      idx = idx >> 1
+       self._ufunc(self._values[left], self._values[left + 1])
+      idx = np.unique(idx >> 1)
 
   def __getitem__(self, idx):
-    assert 0 <= idx < self._size
+    if np.ndim(idx) == 0:
+      assert 0 <= idx < self._size
+      return self._values[idx + self._size]
+    idx = np.asarray(idx, dtype=np.int64)
+    assert np.all((0 <= idx) & (idx < self._size))
     return self._values[idx + self._size]
 
 
 class SumTree(SegmentTree):
   def __init__(self, size):
-    super().__init__(size, operator.add, 0.0)
+    super().__init__(size, operator.add, np.add, 0.0)
 
   def sum(self, start=0, end=None):
     return self._reduce(start, end)
 
   def find_prefixsum_idx(self, prefixsum):
-    assert 0 <= prefixsum <= self.sum() + 1e-5
-    idx = 1
+    """Returns the leaf indices for one or a batch of prefix sums."""
+    prefixsum = np.array(prefixsum, dtype=np.float64)
+    assert np.all((0 <= prefixsum) & (prefixsum <= self.sum() + 1e-5))
+    idx = np.ones(prefixsum.shape, dtype=np.int64)
 
-    # Traverse to the leaf.
-    while idx < self._size:
+    # Traverse all prefix sums to the leaves at once.
+    while idx.flat[0] < self._size:
       left = 2 * idx
-      if self._values[left] > prefixsum:
-        idx = left
-      else:
-        prefixsum -= self._values[left]
-        idx = left + 1
+      left_values = self._values[left]
+      go_left = left_values > prefixsum
+      prefixsum = np.where(go_left, prefixsum, prefixsum - left_values)
+      idx = np.where(go_left, left, left + 1)
+
+    if idx.ndim == 0:
+      return int(idx) - self._size
     return idx - self._size
 
 
 class MinTree(SegmentTree):
   def __init__(self, size):
-    super().__init__(size, min, float("inf"))
+    super().__init__(size, min, np.minimum, float("inf"))
 
   def min(self, start=0, end=None):
     return self._reduce(start, end)
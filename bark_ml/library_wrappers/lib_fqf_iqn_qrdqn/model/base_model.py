@@ -12,7 +12,8 @@ class BaseModel(nn.Module):
     super().__init__()
 
   def sample_noise(self):
-    if self.noisy_net:
+    # NoisyLinear only uses the noise in training mode.
+    if self.noisy_net and self.training:
       for m in self.modules():
         if isinstance(m, NoisyLinear):
           m.sample()
@@ -46,6 +46,17 @@ class IQN(BaseModel):
                                         embedding_dim=self.embedding_dim,
                                         noisy_net=noisy_net)
 
+    # Fixed quantile grid of the inference mode, the midpoints of K equal
+    # fractions, and its cosines, which only depend on the grid.
+    inference_taus = (torch.arange(self.K, dtype=torch.float32) + 0.5) / self.K
+    self.register_buffer("inference_taus",
+                         inference_taus.view(1, self.K),
+                         persistent=False)
+    self.register_buffer(
+        "inference_cosines",
+        self.cosine_net.calculate_cosines(self.inference_taus),
+        persistent=False)
+
   def calculate_state_embeddings(self, states):
     return self.dqn_net(states)
 
@@ -58,7 +69,20 @@ class IQN(BaseModel):
     tau_embeddings = self.cosine_net(taus)
     return self.quantile_net(state_embeddings, tau_embeddings)
 
-  def calculate_q(self, states=None, state_embeddings=None):
+  def calculate_inference_quantiles(self, state_embeddings):
+    # Quantiles at the fixed grid, the tau embeddings are shared by the batch.
+    batch_size = state_embeddings.shape[0]
+    tau_embeddings = self.cosine_net.net(self.inference_cosines).view(
+        1, self.K, self.embedding_dim)
+    return self.quantile_net(state_embeddings,
+                             tau_embeddings.expand(batch_size, -1, -1))
+
+  def calculate_q(self, states=None, state_embeddings=None, fixed_taus=False):
+    """Expected values of the actions.
+
+    Samples K fractions per state or, if `fixed_taus` is set, uses the
+    fixed grid of the inference mode.
+    """
     assert states is not None or state_embeddings is not None
     batch_size = states.shape[0] if states is not None \
      else state_embeddings.shape[0]
@@ -66,15 +90,18 @@ class IQN(BaseModel):
     if state_embeddings is None:
       state_embeddings = self.dqn_net(states)
 
-    # Sample fractions.
-    taus = torch.rand(batch_size,
-                      self.K,
-                      dtype=state_embeddings.dtype,
-                      device=state_embeddings.device)
-
-    # Calculate quantiles.
-    quantiles = self.calculate_quantiles(taus,
-                                         state_embeddings=state_embeddings)
+    if fixed_taus:
+      quantiles = self.calculate_inference_quantiles(state_embeddings)
+    else:
+      # Sample fractions.
+      taus = torch.rand(batch_size,
+                        self.K,
+                        dtype=state_embeddings.dtype,
+                        device=state_embeddings.device)
+
+      # Calculate quantiles.
+      quantiles = self.calculate_quantiles(taus,
+                                           state_embeddings=state_embeddings)
     assert quantiles.shape == (batch_size, self.K, self.num_actions)
 
     # Calculate expectations of value distributions.
@@ -89,15 +116,9 @@ class IQN(BaseModel):
 
     state_embeddings = self.dqn_net(states)
 
-    # Sample fractions. # note. causing bug in torch script.
-    taus = torch.ones(batch_size,
-                      self.K,
-                      dtype=state_embeddings.dtype,
-                      device=state_embeddings.device)
-
-    # Calculate quantiles.
-    tau_embeddings = self.cosine_net(taus)
-    quantiles = self.quantile_net(state_embeddings, tau_embeddings)
+    # Calculate quantiles at the fixed grid, sampling the fractions is
+    # not supported by torch script.
+    quantiles = self.calculate_inference_quantiles(state_embeddings)
     assert quantiles.shape == (batch_size, self.K, self.num_actions)
 
     # Calculate expectations of value distributions.
@@ -106,22 +106,26 @@ class CosineEmbeddingNetwork(nn.Module):
     self.net = nn.Sequential(linear(num_cosines, embedding_dim), nn.ReLU())
     self.num_cosines = num_cosines
     self.embedding_dim = embedding_dim
-
-  def forward(self, taus):
+    # i * \pi (i=1,...,num_cosines), not part of the state dict.
+    self.register_buffer(
+        "i_pi",
+        np.pi * torch.arange(start=1, end=num_cosines + 1,
+                             dtype=torch.float32).view(1, 1, num_cosines),
+        persistent=False)
+
+  def calculate_cosines(self, taus):
     batch_size = taus.shape[0]
     N = taus.shape[1]
 
-    # Calculate i * \pi (i=1,...,N).
-    i_pi = np.pi * torch.arange(start=1,
-                                end=self.num_cosines + 1,
-                                dtype=taus.dtype,
-                                device=taus.device).view(
-                                    1, 1, self.num_cosines)
-
     # Calculate cos(i * \pi * \tau).
-    cosines = torch.cos(taus.view(batch_size, N, 1) * i_pi).view(
+    return torch.cos(taus.view(batch_size, N, 1) * self.i_pi).view(
         batch_size * N, self.num_cosines)
 
+  def forward(self, taus):
+    batch_size = taus.shape[0]
+    N = taus.shape[1]
+    cosines = self.calculate_cosines(taus)
+
     # Calculate embeddings of taus.
     tau_embeddings = self.net(cosines).view(batch_size, N, self.embedding_dim)
 
@@ -0,0 +1,189 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Julian Bernhard, Patrick Hart
+#
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+try:
+    import debug_settings
+except:
+    pass
+
+import unittest
+import queue
+import numpy as np
+import torch
+
+# BARK-ML imports
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent.actor_learner import \
+  ActorLearner, SharedWeights, run_actor
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent.async_evaluator import \
+  AsyncEvaluator
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent.base_agent import \
+  TrainingBenchmark
+
+
+class CountingActionSpace:
+  def sample(self):
+    return np.random.randint(3)
+
+
+class CountingEnv:
+  """Episodes of ten steps observing the step count."""
+  action_space = CountingActionSpace()
+
+  def reset(self):
+    self.step_count = 0
+    return np.zeros(4)
+
+  def step(self, action):
+    self.step_count += 1
+    return np.full(4, self.step_count), float(action == 2), \
+      self.step_count >= 10, {}
+
+
+def make_counting_env():
+  return CountingEnv()
+
+
+class LastActionNet(torch.nn.Module):
+  def __init__(self):
+    super(LastActionNet, self).__init__()
+    self.linear = torch.nn.Linear(4, 3)
+
+  def sample_noise(self):
+    pass
+
+  def forward(self, states):
+    return self.linear(states)
+
+
+class LastActionBenchmark(TrainingBenchmark):
+  """Counts the steps choosing the last action."""
+  def run_episode(self):
+    num_last_actions = 0
+    state = self.training_env.reset()
+    done = False
+    while not done:
+      if self.agent.is_random(eval=True):
+        action = self.agent.explore()
+      else:
+        action = self.agent.Act(state)
+      state, _, done, _ = self.training_env.step(action)
+      num_last_actions += action == 2
+    return {"last_actions": num_last_actions}
+
+  def summarize(self, episode_results, max_episodes):
+    mean = np.mean([result["last_actions"] for result in episode_results])
+    return {"last_actions": mean, "num_episodes": len(episode_results)}, \
+      f"Last actions: {mean}"
+
+
+class EvaluatedAgent:
+  def __init__(self):
+    self.online_net = LastActionNet()
+    self.num_actions = 3
+    self.epsilon_eval = 0.
+    self.steps = 100
+    self.start_steps = 10
+    self.num_eval_episodes = 10
+    self.max_episode_steps = 20
+    self.best_eval_results = None
+
+
+class ActorLearnerTests(unittest.TestCase):
+  def test_actor_uses_published_weights(self):
+    context = torch.multiprocessing.get_context("spawn")
+    net = LastActionNet()
+    shared_weights = SharedWeights(net, context)
+    episodes = context.Queue(maxsize=2)
+    stop = context.Event()
+    actor = context.Process(
+      target=run_actor,
+      args=(0, make_counting_env, shared_weights, episodes, stop,
+            [0., 0., 1], 100, False, 1, 0), daemon=True)
+    actor.start()
+
+    episode = episodes.get(timeout=60)
+    self.assertEqual(episode["observations"].shape, (11, 4))
+    self.assertEqual(episode["actions"].shape, (10,))
+    self.assertTrue(episode["dones"][-1])
+
+    # the greedy action of positive observations is the last one
+    with torch.no_grad():
+      net.linear.weight.fill_(0.)
+      net.linear.weight[2].fill_(1.)
+      net.linear.bias.fill_(0.)
+    shared_weights.publish(net)
+    self.assertEqual(shared_weights.version.value, 1)
+    for _ in range(5):
+      episode = episodes.get(timeout=60)
+    np.testing.assert_array_equal(episode["actions"][1:], 2)
+
+    stop.set()
+    while True:
+      try:
+        episodes.get_nowait()
+      except queue.Empty:
+        break
+    actor.join(timeout=10)
+    self.assertFalse(actor.is_alive())
+
+  def test_apex_epsilons(self):
+    epsilons = ActorLearner.apex_epsilons(4)
+    self.assertEqual(len(epsilons), 4)
+    self.assertAlmostEqual(epsilons[0][0], 0.4)
+    self.assertAlmostEqual(epsilons[-1][0], 0.4**8)
+
+
+class AsyncEvaluatorTests(unittest.TestCase):
+  def test_snapshot_evaluation(self):
+    agent = EvaluatedAgent()
+    with torch.no_grad():
+      agent.online_net.linear.weight.fill_(0.)
+      agent.online_net.linear.weight[2].fill_(1.)
+      agent.online_net.linear.bias.fill_(0.)
+    snapshot = {"online_net": {key: value.clone() for key, value in
+                               agent.online_net.state_dict().items()}}
+    # later changes of the online network are not evaluated
+    with torch.no_grad():
+      agent.online_net.linear.weight.fill_(0.)
+
+    evaluator = AsyncEvaluator(make_counting_env, num_workers=3)
+    evaluator.submit(agent, LastActionBenchmark(), snapshot)
+    evaluations = list(evaluator.completed(wait_all=True))
+    evaluator.close()
+
+    self.assertEqual(len(evaluations), 1)
+    steps, evaluated_snapshot, eval_results, _ = evaluations[0]
+    self.assertEqual(steps, 100)
+    self.assertIs(evaluated_snapshot, snapshot)
+    # all but the first step of every episode choose the last action
+    self.assertAlmostEqual(eval_results["last_actions"], 9.)
+    self.assertEqual(eval_results["num_episodes"], agent.num_eval_episodes)
+
+  def test_stop_worse_than_best(self):
+    agent = EvaluatedAgent()
+    agent.epsilon_eval = 0.5
+    agent.num_eval_episodes = 300
+    agent.best_eval_results = {"mean_return": 100.}
+    benchmark = TrainingBenchmark(interval_width=1e-3, min_episodes=10,
+                                  check_interval=5)
+    evaluator = AsyncEvaluator(make_counting_env, num_workers=3)
+    evaluator.submit(agent, benchmark,
+                     {"online_net": agent.online_net.state_dict()})
+    (_, _, eval_results, _), = evaluator.completed(wait_all=True)
+    evaluator.close()
+
+    # every worker stops after its first check
+    self.assertEqual(eval_results["num_episodes"], 30)
+    self.assertLess(eval_results["mean_return_ci_low"],
+                    eval_results["mean_return"])
+    self.assertLess(eval_results["mean_return"],
+                    eval_results["mean_return_ci_high"])
+    self.assertLess(eval_results["mean_return_ci_high"], 100.)
+
+
+if __name__ == '__main__':
+  unittest.main()
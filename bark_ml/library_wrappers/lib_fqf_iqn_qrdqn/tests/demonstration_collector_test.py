@@ -13,7 +13,11 @@ except:
 
 import unittest
 import numpy as np
+import pandas as pd
 import os
+import shutil
+import socket
+import subprocess
 import gym
 import matplotlib
 import time
@@ -26,12 +30,19 @@ from bark_ml.environments.blueprints import \
   DiscreteHighwayBlueprint, DiscreteMergingBlueprint
 from bark_ml.environments.single_agent_runtime import SingleAgentRuntime
 import bark_ml.environments.gym
-from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent.demonstrations import DemonstrationCollector
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent.demonstrations import DemonstrationCollector, \
+  ActionValuesCollector
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent.demonstrations.demonstration_collector \
+  import ScenarioClaims
 from bark_ml.observers.nearest_state_observer import NearestAgentsObserver
 from bark_ml.behaviors.discrete_behavior import BehaviorDiscreteMacroActionsML
 
 import bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.tests.test_demo_behavior
 
+streamed_dir = "./test_demo_streamed"
+claims_dir = "./test_scenario_claims"
+action_values_dir = "./test_action_values_collected"
+
 class TestEvaluator:
   reach_goal = True
   def __init__(self,
@@ -74,7 +85,45 @@ class TestEvaluator:
     TestEvaluator.reach_goal = not TestEvaluator.reach_goal 
 
 
+class TestCollectionResult:
+  def __init__(self, data_frame):
+    self._data_frame = data_frame
+
+  def get_data_frame(self):
+    return self._data_frame
+
+  def dump(self, *args, **kwargs):
+    pass
+
+
+class TestMotionPrimitiveBehavior:
+  def __init__(self, num_actions):
+    self._num_actions = num_actions
+
+  def GetMotionPrimitives(self):
+    return list(range(self._num_actions))
+
+
+class TestActionValuesCollector(ActionValuesCollector):
+  # the workers converting the rows use the constructed collector
+  def __init__(self, terminal_criteria, num_actions):
+    super(TestActionValuesCollector, self).__init__(terminal_criteria)
+    self.num_actions = num_actions
+
+  def DemonstrationColumns(self, demonstrations):
+    assert len(demonstrations[0][1]) == 2*self.num_actions
+    return super(TestActionValuesCollector, self).DemonstrationColumns(demonstrations)
+
+
 class DemonstrationCollectorTests(unittest.TestCase):
+  def setUp(self):
+    for directory in [streamed_dir, claims_dir, action_values_dir]:
+      shutil.rmtree(directory, ignore_errors=True)
+
+  def tearDown(self):
+    for directory in [streamed_dir, claims_dir, action_values_dir]:
+      shutil.rmtree(directory, ignore_errors=True)
+
   def test_collect_demonstrations(self):
     params = ParameterServer()
     bp = DiscreteHighwayBlueprint(params, num_scenarios=10, random_seed=0)
@@ -95,6 +144,21 @@ class DemonstrationCollectorTests(unittest.TestCase):
     # expected length = 2 scenarios (only every second reaches goal) x 3 steps (4 executed, but first not counted)
     self.assertEqual(len(experiences), 2*3) 
 
+    # shards of single rows converted in parallel give the same experiences
+    experiences_parallel = collector.ProcessCollectionResult(
+      eval_criteria = {"goal_r1" : lambda x : x}, num_workers=2, rows_per_shard=1)
+    self.assertEqual(len(experiences_parallel), 2*3)
+    self.assertEqual(len(collector.GetStore().Chunks()), 2)
+    for experience, experience_parallel in zip(experiences, experiences_parallel):
+      np.testing.assert_array_equal(experience[0], experience_parallel[0])
+
+    # criteria of single values and masks of the whole column
+    for criteria in [{"eval_criteria": {"goal_r1": lambda x: str(x).startswith("True")}},
+                     {"eval_criteria": {"goal_r1": lambda x: not x}},
+                     {"mask_criteria": {"goal_r1": lambda column: column == True}}]:
+      experiences_selected = collector.ProcessCollectionResult(**criteria)
+      self.assertEqual(len(experiences_selected), 2*3)
+
     collector.dump("./final_collections")
 
     loaded_collector = DemonstrationCollector.load("./final_collections")
@@ -102,6 +166,91 @@ class DemonstrationCollectorTests(unittest.TestCase):
     print(experiences_loaded)
     self.assertEqual(len(experiences_loaded), 2*3) 
 
+  def test_collect_demonstrations_streaming(self):
+    params = ParameterServer()
+    bp = DiscreteHighwayBlueprint(params, num_scenarios=10, random_seed=0)
+    env = SingleAgentRuntime(blueprint=bp, render=False)
+    env._observer = NearestAgentsObserver(params)
+    env._action_wrapper = BehaviorDiscreteMacroActionsML(params)
+    env._evaluator = TestEvaluator()
+
+    demo_behavior = bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.\
+            tests.test_demo_behavior.TestDemoBehavior(params)
+    collector = DemonstrationCollector()
+    store = collector.CollectDemonstrations(4, streamed_dir, env=env, motion_primitive_behavior=demo_behavior, \
+           use_mp_runner=False, runner_init_params={"deepcopy" : False}, scenarios_per_flush=2)
+    self.assertEqual(len(store.Scenarios()), 4)
+    self.assertEqual(len(store.Chunks()), 2)
+
+    # resuming skips the collected scenarios
+    store = collector.CollectDemonstrations(4, streamed_dir, env=env, motion_primitive_behavior=demo_behavior, \
+           use_mp_runner=False, runner_init_params={"deepcopy" : False}, scenarios_per_flush=2)
+    self.assertEqual(len(store.Chunks()), 2)
+
+    loaded_collector = DemonstrationCollector.load(streamed_dir)
+    experiences = loaded_collector.GetDemonstrationExperiences(
+      where=lambda scenario: scenario["goal_r1"])
+    self.assertEqual(len(experiences), 2*3)
+
+  def test_action_values_collector(self):
+    num_actions = 4
+    rows = []
+    for idx in range(6):
+      # (state, action values, policy, value functions) of three steps
+      evaluation = [None] + [
+        (list(np.full(5, float(idx))),
+         list(np.arange(2*num_actions) + 10.*idx),
+         list(np.full(num_actions, 1./num_actions)),
+         ("Collision", "Return")) for _ in range(3)]
+      rows.append({"config_idx": idx, "Terminal": "goal_reached",
+                   "goal_reached": idx % 2 == 0, "demo_evaluator": evaluation})
+    collector = TestActionValuesCollector(terminal_criteria=None,
+                                          num_actions=num_actions)
+    collector._collection_result = TestCollectionResult(pd.DataFrame(rows))
+    collector._motion_primitive_behavior = TestMotionPrimitiveBehavior(num_actions)
+    collector.dump(action_values_dir)
+
+    demonstrations = collector.ProcessCollectionResult(
+      eval_criteria={"goal_reached": lambda x: x}, num_workers=2,
+      rows_per_shard=1)
+    # lists of [state, action values, policy] as before the store
+    self.assertIsInstance(demonstrations, list)
+    self.assertEqual(len(demonstrations), 3*3)
+    self.assertEqual(demonstrations[3][0], [2.]*5)
+    self.assertEqual(len(demonstrations[3][1]), 2*num_actions)
+    self.assertEqual(len(demonstrations[3][2]), num_actions)
+
+    # the value functions named by the evaluator select the action values
+    self.assertEqual(collector.GetStore().attributes["value_functions"],
+                     ["Collision", "Return"])
+    dataset = collector.GetDemonstrationDataset(value_functions=["Return"])
+    np.testing.assert_array_equal(dataset.action_values[3],
+                                  np.arange(num_actions, 2*num_actions) + 20.)
+
+  def test_scenario_claims(self):
+    directory = claims_dir
+    first, second = ScenarioClaims(directory), ScenarioClaims(directory)
+    # the second claimer is another running process
+    second._owner = f"{socket.gethostname()}:{os.getppid()}"
+    self.assertTrue(first.Claim(0))
+    self.assertFalse(second.Claim(0))
+
+    # both judge the claim of a finished process abandoned before taking over
+    finished = subprocess.Popen(["true"])
+    finished.wait()
+    with open(os.path.join(directory, "1"), "w") as file:
+      file.write(f"{socket.gethostname()}:{finished.pid}")
+    abandoned = second._ReadClaim(os.path.join(directory, "1"))
+    self.assertTrue(second.IsAbandoned(abandoned))
+    self.assertTrue(first.Claim(1))
+    # the fresh claim of the first claimer is not taken over
+    self.assertFalse(second._TakeOver(os.path.join(directory, "1"), abandoned))
+    self.assertFalse(second.Claim(1))
+    self.assertEqual(sorted(os.listdir(directory)), ["0", "1"])
+
+    first.Release(1)
+    self.assertTrue(second.Claim(1))
+
 
 if __name__ == '__main__':
   unittest.main()
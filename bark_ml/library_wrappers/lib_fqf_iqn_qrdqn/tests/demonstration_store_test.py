@@ -0,0 +1,113 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Julian Bernhard, Patrick Hart
+#
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+try:
+    import debug_settings
+except:
+    pass
+
+import os
+import shutil
+import unittest
+import numpy as np
+
+# BARK-ML imports
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent.demonstrations import \
+  DemonstrationStore, DemonstrationDataset
+
+store_dir = "./test_demonstration_store"
+num_actions = 4
+
+
+def scenario_columns(num_rows, value):
+  return {"states": np.full((num_rows, 5), float(value)),
+          "action_values": np.tile(np.repeat(np.arange(3.), num_actions),
+                                   (num_rows, 1)),
+          "policies": np.full((num_rows, num_actions), 1. / num_actions)}
+
+
+class DemonstrationStoreTests(unittest.TestCase):
+  def setUp(self):
+    shutil.rmtree(store_dir, ignore_errors=True)
+    store = DemonstrationStore(store_dir, chunk_rows=10)
+    for scen_idx in range(10):
+      store.AppendScenario(scenario_columns(3, scen_idx),
+                           {"scen_idx": np.int64(scen_idx),
+                            "goal_reached": scen_idx % 2 == 0})
+    store.Flush()
+    store.SetAttributes(num_actions=num_actions,
+                        value_functions=["Envelope", "Collision", "Return"])
+
+  def tearDown(self):
+    shutil.rmtree(store_dir, ignore_errors=True)
+
+  def test_lazy_read(self):
+    store = DemonstrationStore(store_dir)
+    self.assertEqual(len(store.Chunks()), 3)
+    self.assertEqual(store.NumRows(), 30)
+    self.assertEqual(store.Columns(), ["states", "action_values", "policies"])
+    states = store.Read(["states"])["states"]
+    self.assertEqual(states.dtype, np.float64)
+    np.testing.assert_array_equal(states[:, 0], np.repeat(np.arange(10.), 3))
+    chunk = next(store.Stream(["states"]))
+    self.assertIsInstance(chunk["states"], np.memmap)
+
+  def test_stream_subsets(self):
+    store = DemonstrationStore(store_dir)
+    successful = lambda scenario: scenario["goal_reached"]
+    self.assertEqual([scenario["scen_idx"] for scenario in store.Scenarios(successful)],
+                     [0, 2, 4, 6, 8])
+    states = np.concatenate([chunk["states"] for chunk in store.Stream(
+      ["states"], where=successful)])
+    np.testing.assert_array_equal(states[:, 0], np.repeat([0., 2., 4., 6., 8.], 3))
+
+    dataset = DemonstrationDataset.from_store(
+      store, where=successful, value_functions=["Envelope", "Return"])
+    self.assertEqual(len(dataset), 15)
+    self.assertEqual(dataset.states.dtype, np.float32)
+    np.testing.assert_array_equal(dataset.action_values[0],
+                                  [0.] * num_actions + [2.] * num_actions)
+
+  def test_append(self):
+    store = DemonstrationStore(store_dir)
+    store.AppendScenario(scenario_columns(2, 10), {"scen_idx": 10})
+    self.assertEqual(DemonstrationStore(store_dir).NumRows(), 30)
+    store.Flush()
+    self.assertEqual(DemonstrationStore(store_dir).NumRows(), 32)
+    with self.assertRaises(AssertionError):
+      store.AppendScenario({"states": np.zeros((2, 5))})
+    self.assertFalse(any(name.startswith(".") for name in os.listdir(store_dir)))
+
+  def test_append_scenarios(self):
+    store = DemonstrationStore(store_dir)
+    columns = {name: np.concatenate([array, array]) for name, array in
+               scenario_columns(3, 10).items()}
+    store.AppendScenarios(columns, [{"scen_idx": 10}, {"scen_idx": 11},
+                                    {"scen_idx": 12}], [2, 0, 4])
+    store.Flush(order=0)
+    self.assertEqual(store.Scenarios()[0]["scen_idx"], 10)
+    self.assertEqual(store.NumRows(lambda scenario: scenario["scen_idx"] > 10), 4)
+    self.assertEqual(store.NumRows(), 36)
+    with self.assertRaises(AssertionError):
+      store.AppendScenarios(columns, [{"scen_idx": 13}], [5])
+
+  def test_unique_key(self):
+    store = DemonstrationStore(store_dir, unique_key="scen_idx")
+    # scenarios 2 and 3 stored again by another collection
+    store.AppendScenario(scenario_columns(3, 20), {"scen_idx": 2})
+    store.AppendScenario(scenario_columns(3, 30), {"scen_idx": 3})
+    store.AppendScenario(scenario_columns(3, 10), {"scen_idx": 10})
+    store.Flush()
+    self.assertEqual([scenario["scen_idx"] for scenario in store.Scenarios()],
+                     list(range(11)))
+    states = store.Read(["states"])["states"]
+    np.testing.assert_array_equal(states[:, 0], np.repeat(np.arange(11.), 3))
+    self.assertEqual(DemonstrationStore(store_dir).NumRows(), 39)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,49 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Julian Bernhard, Patrick Hart
+#
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+try:
+    import debug_settings
+except:
+    pass
+
+import unittest
+import torch
+
+# BARK imports
+from bark.runtime.commons.parameters import ParameterServer
+
+# BARK-ML imports
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.model import IQN
+
+num_channels = 16
+num_actions = 8
+
+
+class InferenceQuantilesTests(unittest.TestCase):
+  def setUp(self):
+    torch.manual_seed(0)
+    self.params = ParameterServer()
+    self.params["ML"]["IQNModel"]["EmbeddingDims"] = 64
+    self.params["ML"]["IQNModel"]["HiddenDims"] = 64
+    self.states = torch.rand(256, num_channels)
+
+  def test_iqn_fixed_taus(self):
+    iqn = IQN(num_channels, num_actions, self.params, num_cosines=64,
+              dueling_net=False, noisy_net=False)
+    self.assertEqual(len(iqn.state_dict()), len(
+      [name for name, _ in iqn.named_parameters()]))
+    with torch.no_grad():
+      taus = iqn.inference_taus.expand(len(self.states), -1)
+      expected_q = iqn.calculate_quantiles(taus, states=self.states).mean(dim=1)
+      q = iqn.calculate_q(states=self.states, fixed_taus=True)
+      self.assertTrue(torch.allclose(q, expected_q, atol=1e-6))
+      self.assertTrue(torch.equal(q.argmax(dim=1), expected_q.argmax(dim=1)))
+      self.assertTrue(torch.equal(iqn(self.states), q))
+
+
+if __name__ == '__main__':
+  unittest.main()
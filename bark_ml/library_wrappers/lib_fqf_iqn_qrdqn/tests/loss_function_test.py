@@ -0,0 +1,111 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Julian Bernhard, Patrick Hart
+#
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+try:
+    import debug_settings
+except:
+    pass
+
+import unittest
+import torch
+
+# BARK-ML imports
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent.loss.loss_function \
+  import LossMSE, LossBCE, LossHuber, LossPolicyCrossEntropy
+
+batch_size = 64
+num_actions = 6
+
+
+# only the present values of the current and desired values
+def present_values(current_values, desired_values):
+  present = {key: ~torch.isnan(values) for key, values in desired_values.items()}
+  return {key: values[present[key]] for key, values in current_values.items()}, \
+    {key: values[present[key]] for key, values in desired_values.items()}
+
+
+class LossFunctionTests(unittest.TestCase):
+  def setUp(self):
+    torch.manual_seed(0)
+    keys = ["Envelope", "Collision", "Return"]
+    self.current_values = {key: torch.randn(batch_size, num_actions,
+                                            requires_grad=True) for key in keys}
+    self.desired_values = {}
+    for key in keys:
+      values = torch.rand(batch_size, num_actions)
+      values[torch.rand(batch_size, num_actions) < 0.3] = float("nan")
+      self.desired_values[key] = values
+
+  def test_masked_losses(self):
+    weights = {"Envelope": 1., "Collision": 2., "Return": 0.5}
+    for loss, logits in [(LossMSE(weights), False), (LossMSE(), True),
+                         (LossBCE(weights), True), (LossHuber(), False)]:
+      masked_loss, losses = loss(self.current_values, self.desired_values,
+                                 logits, return_intermediate_losses=True)
+      _, present_losses = loss(
+        *present_values(self.current_values, self.desired_values),
+        logits, return_intermediate_losses=True)
+      self.assertFalse(torch.isnan(masked_loss))
+      # the means over the present values, scaled to the whole batch
+      for key, values in self.desired_values.items():
+        share = torch.sum(~torch.isnan(values)) / values.numel()
+        self.assertTrue(torch.allclose(losses[key],
+                                       present_losses[key] * share))
+      self.assertTrue(torch.allclose(
+        masked_loss, sum(losses.values()) /
+        (sum(weights.values()) if loss._weights else len(losses))))
+    # the desired values are not changed
+    self.assertTrue(all(torch.isnan(values).any()
+                        for values in self.desired_values.values()))
+
+  def test_missing_values_without_gradients(self):
+    for loss, logits in [(LossMSE(), False), (LossMSE(), True),
+                         (LossBCE(), True), (LossHuber(), True)]:
+      for values in self.current_values.values():
+        values.grad = None
+      loss(self.current_values, self.desired_values, logits).backward()
+      for key, values in self.desired_values.items():
+        gradients = self.current_values[key].grad
+        self.assertTrue(torch.all(gradients[torch.isnan(values)] == 0))
+        self.assertTrue(torch.all(gradients[~torch.isnan(values)] != 0))
+
+  def test_gradients_independent_of_missing_values(self):
+    # present values get the same gradients as in a batch without missing
+    # values, the policy loss masks whole rows
+    for loss, key in [(LossMSE(), "Return"), (LossHuber(), "Return"),
+                      (LossPolicyCrossEntropy(), "Policy")]:
+      current_values = {key: self.current_values["Return"]}
+      desired = torch.softmax(torch.rand(batch_size, num_actions), dim=1)
+      missing = torch.rand(batch_size, 1) < 0.3
+      if key != "Policy":
+        missing = torch.rand(batch_size, num_actions) < 0.3
+      gradients = []
+      for desired_values in [desired, desired.masked_fill(missing,
+                                                          float("nan"))]:
+        current_values[key].grad = None
+        loss(current_values, {key: desired_values}, False).backward()
+        gradients.append(current_values[key].grad.clone())
+      present = ~missing.expand(batch_size, num_actions)
+      self.assertTrue(torch.allclose(gradients[0][present],
+                                     gradients[1][present]))
+      self.assertTrue(torch.all(gradients[1][~present] == 0))
+
+  def test_policy_loss(self):
+    current_values = {"Policy": self.current_values["Return"]}
+    desired_values = {"Policy": self.desired_values["Return"]}
+    loss = LossPolicyCrossEntropy()(current_values, desired_values, False)
+    present = ~torch.isnan(desired_values["Policy"])
+    log_policies = torch.log_softmax(current_values["Policy"], dim=1)
+    expected_loss = -torch.sum(desired_values["Policy"][present] *
+                               log_policies[present]) / batch_size
+    self.assertTrue(torch.allclose(loss, expected_loss))
+    loss.backward()
+    self.assertFalse(torch.isnan(current_values["Policy"].grad).any())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,129 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Julian Bernhard, Patrick Hart
+#
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+try:
+    import debug_settings
+except:
+    pass
+
+import sys
+import time
+import unittest
+import torch
+
+# BARK-ML imports
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.utils import \
+  calculate_quantile_huber_loss, evaluate_quantile_at_action, \
+  calculate_fraction_loss
+
+
+# eager implementations the scripted kernels replace
+def eager_quantile_huber_loss(td_errors, taus, weights=None, kappa=1.0):
+  element_wise_huber_loss = torch.where(
+    td_errors.abs() <= kappa, 0.5 * td_errors.pow(2),
+    kappa * (td_errors.abs() - 0.5 * kappa))
+  element_wise_quantile_huber_loss = torch.abs(taus[..., None] - (
+    td_errors.detach() < 0).float()) * element_wise_huber_loss / kappa
+  batch_quantile_huber_loss = element_wise_quantile_huber_loss.sum(dim=1).mean(
+    dim=1, keepdim=True)
+  if weights is not None:
+    return (batch_quantile_huber_loss * weights).mean()
+  return batch_quantile_huber_loss.mean()
+
+def eager_evaluate_quantile_at_action(s_quantiles, actions):
+  batch_size, N = s_quantiles.shape[0], s_quantiles.shape[1]
+  return s_quantiles.gather(
+    dim=2, index=actions[..., None].expand(batch_size, N, 1))
+
+def eager_fraction_loss(sa_quantiles, sa_quantile_hats, taus, weights=None):
+  batch_size = sa_quantiles.shape[0]
+  values_1 = sa_quantiles - sa_quantile_hats[:, :-1]
+  signs_1 = sa_quantiles > torch.cat(
+    [sa_quantile_hats[:, :1], sa_quantiles[:, :-1]], dim=1)
+  values_2 = sa_quantiles - sa_quantile_hats[:, 1:]
+  signs_2 = sa_quantiles < torch.cat(
+    [sa_quantiles[:, 1:], sa_quantile_hats[:, -1:]], dim=1)
+  gradient_of_taus = (torch.where(signs_1, values_1, -values_1) +
+                      torch.where(signs_2, values_2, -values_2)).view(
+                        batch_size, -1)
+  if weights is not None:
+    return ((gradient_of_taus * taus[:, 1:-1]).sum(dim=1, keepdim=True) *
+            weights).mean()
+  return (gradient_of_taus * taus[:, 1:-1]).sum(dim=1).mean()
+
+
+def sample_inputs(batch_size, N=32, num_actions=8):
+  s_quantiles = torch.randn(batch_size, N, num_actions, requires_grad=True)
+  actions = torch.randint(num_actions, (batch_size, 1))
+  targets = torch.randn(batch_size, 1, N)
+  taus = torch.rand(batch_size, N)
+  weights = torch.rand(batch_size, 1)
+  return s_quantiles, actions, targets, taus, weights
+
+
+def quantile_update(quantile_loss, evaluate, s_quantiles, actions, targets,
+                    taus, weights):
+  s_quantiles.grad = None
+  td_errors = targets - evaluate(s_quantiles, actions)
+  loss = quantile_loss(td_errors, taus, weights, 1.0)
+  loss.backward()
+  return loss
+
+
+class LossKernelsTests(unittest.TestCase):
+  def test_quantile_huber_loss(self):
+    inputs = sample_inputs(64)
+    for weights in [None, inputs[-1]]:
+      loss = quantile_update(calculate_quantile_huber_loss,
+                             evaluate_quantile_at_action,
+                             *inputs[:-1], weights)
+      gradient = inputs[0].grad.clone()
+      expected_loss = quantile_update(eager_quantile_huber_loss,
+                                      eager_evaluate_quantile_at_action,
+                                      *inputs[:-1], weights)
+      self.assertTrue(torch.allclose(loss, expected_loss))
+      self.assertTrue(torch.allclose(gradient, inputs[0].grad))
+
+  def test_fraction_loss(self):
+    batch_size, N = 64, 32
+    sa_quantiles = torch.randn(batch_size, N - 1, 1).sort(dim=1)[0]
+    sa_quantile_hats = torch.randn(batch_size, N, 1).sort(dim=1)[0]
+    taus = torch.rand(batch_size, N + 1, requires_grad=True)
+    weights = torch.rand(batch_size, 1)
+    for w in [None, weights]:
+      loss = calculate_fraction_loss(sa_quantiles, sa_quantile_hats, taus, w)
+      gradient, = torch.autograd.grad(loss, taus)
+      expected_loss = eager_fraction_loss(sa_quantiles, sa_quantile_hats, taus, w)
+      expected_gradient, = torch.autograd.grad(expected_loss, taus)
+      self.assertTrue(torch.allclose(loss, expected_loss))
+      self.assertTrue(torch.allclose(gradient, expected_gradient))
+
+
+def benchmark(num_updates=50):
+  # Prints the time of the loss computation and its backward pass,
+  # run with --benchmark.
+  for batch_size in [32, 64, 128, 256, 512]:
+    inputs = sample_inputs(batch_size)
+    durations = []
+    for kernels in [(eager_quantile_huber_loss, eager_evaluate_quantile_at_action),
+                    (calculate_quantile_huber_loss, evaluate_quantile_at_action)]:
+      for _ in range(5):
+        quantile_update(*kernels, *inputs)
+      start = time.perf_counter()
+      for _ in range(num_updates):
+        quantile_update(*kernels, *inputs)
+      durations.append((time.perf_counter() - start) / num_updates)
+    print(f"batch size {batch_size:4}: eager {1e3*durations[0]:.3f} ms, "
+          f"scripted {1e3*durations[1]:.3f} ms, "
+          f"speedup {durations[0]/durations[1]:.2f}x")
+
+
+if __name__ == '__main__':
+  if "--benchmark" in sys.argv:
+    benchmark()
+  else:
+    unittest.main()
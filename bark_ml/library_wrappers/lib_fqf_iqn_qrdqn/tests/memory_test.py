@@ -0,0 +1,305 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Julian Bernhard, Patrick Hart
+#
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+try:
+    import debug_settings
+except:
+    pass
+
+import unittest
+import os
+import pickle
+import tempfile
+import numpy as np
+import torch
+
+# BARK-ML imports
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.memory import \
+  LazyMultiStepMemory, LazyPrioritizedMultiStepMemory, \
+  MemoryMappedPrioritizedMultiStepMemory, BatchPrefetcher
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.memory.segment_tree import \
+  SumTree, MinTree
+
+state_shape = (5,)
+
+
+def fill_memory(memory, num_steps, episode_length=10):
+  state = np.full(state_shape, 0)
+  for step in range(num_steps):
+    next_state = np.full(state_shape, (step + 1) % 256)
+    done = (step + 1) % episode_length == 0
+    memory.append(state, step % 4, 1.0, next_state, done)
+    state = np.full(state_shape, (step + 1) % 256) if done else next_state
+
+
+class MemoryTests(unittest.TestCase):
+  def test_ring_buffer(self):
+    memory = LazyMultiStepMemory(capacity=100, state_shape=state_shape,
+                                 device="cpu", multi_step=1)
+    fill_memory(memory, 250)
+    self.assertEqual(memory._n, 100)
+    # every tenth slot only holds a terminal observation
+    self.assertEqual(len(memory), 90)
+
+    states, actions, rewards, next_states, dones, steps = memory.sample(32)
+    self.assertEqual(tuple(states.shape), (32, *state_shape))
+    self.assertEqual(tuple(next_states.shape), (32, *state_shape))
+    self.assertEqual(tuple(actions.shape), (32, 1))
+    self.assertEqual(tuple(rewards.shape), (32, 1))
+    self.assertEqual(tuple(dones.shape), (32, 1))
+    self.assertTrue(torch.all(steps == 1.))
+
+  def test_shared_observations(self):
+    memory = LazyMultiStepMemory(capacity=1000, state_shape=state_shape,
+                                 device="cpu", multi_step=1)
+    fill_memory(memory, 100, episode_length=10)
+    # one observation per step and one terminal observation per episode
+    self.assertEqual(memory._n, 110)
+    self.assertEqual(len(memory), 100)
+
+    stored = memory.get()
+    terminal = stored["valid"] & (stored["done"][:, 0] == 1.)
+    np.testing.assert_array_equal(
+      stored["state"][stored["next_index"][terminal], 0] % 10, 0)
+
+    # copies and conversions of the previous next state are shared as well
+    memory.reset()
+    next_state = np.zeros(state_shape, dtype=np.float32)
+    for step in range(10):
+      state = torch.from_numpy(next_state.copy()).double().numpy()
+      next_state = np.full(state_shape, step + 1, dtype=np.float32)
+      memory.append(state, 0, 1.0, next_state, step == 9)
+    self.assertEqual(memory._n, 11)
+  def test_multi_step_returns(self):
+    memory = LazyMultiStepMemory(capacity=1000, state_shape=state_shape,
+                                 device="cpu", gamma=0.5, multi_step=3)
+    fill_memory(memory, 20, episode_length=10)
+    indices = np.flatnonzero(memory['valid'])
+    self.assertEqual(len(indices), 20)
+    states = memory['state'][indices, 0]
+    for multi_step in [3, 1, 5]:
+      # the memory is kept when changing the number of steps
+      memory.multi_step = multi_step
+      rewards, next_indices, dones, steps = memory._transitions(indices)
+      next_states = memory['state'][next_indices, 0]
+      # next states are n steps ahead or the terminal observation
+      np.testing.assert_array_equal(
+        next_states, np.minimum(states + multi_step, (states // 10 + 1) * 10))
+      np.testing.assert_array_equal(dones[:, 0], next_states % 10 == 0)
+      np.testing.assert_array_equal(steps[:, 0], next_states - states)
+      np.testing.assert_allclose(
+        rewards[:, 0], 2. - 0.5**(next_states - states - 1))
+
+    # transitions still lacking steps of the running episode are not sampled
+    fill_memory(memory, 5, episode_length=10)
+    memory.multi_step = 3
+    unready = memory._unready_indices()
+    np.testing.assert_array_equal(memory['state'][unready, 0], [4, 3])
+    self.assertFalse(memory._sampleable(unready, unready).any())
+
+  def test_sample_without_sampleable_transitions(self):
+    memory = LazyMultiStepMemory(capacity=1000, state_shape=state_shape,
+                                 device="cpu", multi_step=3)
+    fill_memory(memory, 2, episode_length=10)
+    self.assertEqual(len(memory), 2)
+    # both transitions still lack steps of the running episode
+    with self.assertRaises(ValueError):
+      memory.sample(4)
+    # the end of the episode completes them
+    memory.reset()
+    fill_memory(memory, 2, episode_length=2)
+    self.assertEqual(len(memory.sample(4)[0]), 4)
+
+  def test_multi_step_timeout(self):
+    memory = LazyMultiStepMemory(capacity=1000, state_shape=state_shape,
+                                 device="cpu", gamma=0.5, multi_step=3)
+    # an episode of 5 steps ending at a timeout, i.e. without done
+    state = np.full(state_shape, 0)
+    for step in range(5):
+      next_state = np.full(state_shape, step + 1)
+      memory.append(state, 0, 1.0, next_state, False, episode_done=step == 4)
+      state = next_state
+    indices = np.flatnonzero(memory['valid'])
+    self.assertTrue(memory._sampleable(
+      indices, memory._unready_indices()).all())
+    rewards, next_indices, dones, steps = memory._transitions(indices)
+    states = memory['state'][indices, 0]
+    next_states = memory['state'][next_indices, 0]
+    np.testing.assert_array_equal(next_states, np.minimum(states + 3, 5))
+    np.testing.assert_array_equal(dones[:, 0], 0.)
+    # the chains cut by the timeout bootstrap after their own steps
+    np.testing.assert_array_equal(steps[:, 0], [3, 3, 3, 2, 1])
+    np.testing.assert_allclose(rewards[:, 0], 2. - 0.5**(steps[:, 0] - 1))
+
+  def test_get_and_load(self):
+    memory = LazyMultiStepMemory(capacity=100, state_shape=state_shape,
+                                 device="cpu", multi_step=1)
+    fill_memory(memory, 250)
+    stored = memory.get()
+    self.assertEqual(len(stored["state"]), 100)
+
+    loaded_memory = LazyMultiStepMemory(capacity=100, state_shape=state_shape,
+                                        device="cpu", multi_step=1)
+    loaded_memory.load(stored)
+    self.assertEqual(len(loaded_memory), len(memory))
+    for key, values in loaded_memory.get().items():
+      np.testing.assert_array_equal(values, stored[key])
+
+  def test_observation_dtypes(self):
+    low, high = np.zeros(state_shape), np.full(state_shape, 2.)
+    for dtype, tolerance in [("float32", 1e-7), ("float16", 1e-3),
+                             ("uint16", 1e-4), ("int8", 1e-2)]:
+      memory = LazyMultiStepMemory(capacity=100, state_shape=state_shape,
+                                   device="cpu", multi_step=1,
+                                   state_dtype=dtype, state_bounds=(low, high))
+      state = np.random.uniform(low, high)
+      memory.append(state, 0, 0., np.random.uniform(low, high), True)
+      self.assertEqual(memory["state"].dtype, np.dtype(dtype))
+      states, _, _, _, _, _ = memory.sample(4)
+      np.testing.assert_allclose(
+        states.numpy(), np.tile(state, (4, 1)), atol=tolerance)
+
+  def test_segment_trees(self):
+    priorities = np.random.uniform(0.1, 1., size=64)
+    sum_tree, min_tree = SumTree(64), MinTree(64)
+    sum_tree[np.arange(64)] = priorities
+    min_tree[np.arange(64)] = priorities
+    sum_tree[3] = 2.
+    min_tree[3] = 2.
+    priorities[3] = 2.
+    self.assertAlmostEqual(sum_tree.sum(), priorities.sum())
+    self.assertAlmostEqual(sum_tree.sum(5, 20), priorities[5:20].sum())
+    self.assertAlmostEqual(min_tree.min(), priorities.min())
+
+    prefix_sums = np.random.uniform(0., priorities.sum(), size=32)
+    expected = np.searchsorted(np.cumsum(priorities), prefix_sums, side="right")
+    np.testing.assert_array_equal(
+      sum_tree.find_prefixsum_idx(prefix_sums), expected)
+    self.assertEqual(sum_tree.find_prefixsum_idx(prefix_sums[0]), expected[0])
+
+  def test_prioritized_memory(self):
+    memory = LazyPrioritizedMultiStepMemory(capacity=128,
+                                            state_shape=state_shape,
+                                            device="cpu", multi_step=3)
+    fill_memory(memory, 300)
+    (states, _, _, _, _, _), weights = memory.sample(32)
+    self.assertEqual(tuple(states.shape), (32, *state_shape))
+    self.assertEqual(tuple(weights.shape), (32, 1))
+
+    indices, _ = memory._cached
+    memory.update_priority(torch.linspace(0., 1., 32))
+    self.assertIsNone(memory._cached)
+    np.testing.assert_array_less(0., memory.it_sum[indices])
+
+    # slots written after sampling keep the priority of their transition
+    _, slots = memory.sample_batch(32)
+    fill_memory(memory, 64)
+    memory.update_priority(torch.full((32,), 0.1), slots)
+    written = (memory._p - np.arange(1, memory._total - slots[1] + 1)) % \
+      memory.capacity
+    overwritten = np.intersect1d(slots[0], written[memory['valid'][written]])
+    kept = np.setdiff1d(slots[0], written)
+    self.assertGreater(len(overwritten), 0)
+    np.testing.assert_allclose(memory.it_sum[overwritten], memory.max_pa)
+    np.testing.assert_allclose(memory.it_sum[kept], memory._pa(0.1))
+
+  def test_memory_mapped_memory(self):
+    with tempfile.TemporaryDirectory() as directory:
+      memory = MemoryMappedPrioritizedMultiStepMemory(
+        directory, 128, state_shape, "cpu", multi_step=1)
+      fill_memory(memory, 300)
+      memory.sample(32)
+      memory.update_priority(torch.linspace(0., 1., 32))
+
+      # pickling only stores the directory, unpickling reattaches
+      pickled = pickle.dumps(memory)
+      self.assertLess(len(pickled), 2000)
+      reattached_memory = pickle.loads(pickled)
+      self.assertEqual(len(reattached_memory), len(memory))
+      self.assertAlmostEqual(reattached_memory.it_sum.sum(),
+                             memory.it_sum.sum())
+      for key, values in reattached_memory.get().items():
+        np.testing.assert_array_equal(values, memory.get()[key])
+
+  def test_checkpoint_and_restore(self):
+    with tempfile.TemporaryDirectory() as directory:
+      memory = LazyPrioritizedMultiStepMemory(
+        capacity=128, state_shape=state_shape, device="cpu", multi_step=3)
+      fill_memory(memory, 100)
+      memory.checkpoint(directory)
+      chunks = [f for f in os.listdir(directory) if f.startswith("chunk_")]
+      self.assertEqual(len(chunks), 1)
+
+      # only the newly added slots are written as a new chunk and chunks
+      # which left the ring buffer are removed
+      fill_memory(memory, 20)
+      memory.checkpoint(directory)
+      chunks = [f for f in os.listdir(directory) if f.startswith("chunk_")]
+      self.assertEqual(len(chunks), 2)
+      fill_memory(memory, 200)
+      memory.sample(32)
+      memory.update_priority(torch.linspace(0., 1., 32))
+      memory.checkpoint(directory)
+      chunks = [f for f in os.listdir(directory) if f.startswith("chunk_")]
+      self.assertEqual(len(chunks), 1)
+
+      restored_memory = LazyPrioritizedMultiStepMemory(
+        capacity=128, state_shape=state_shape, device="cpu", multi_step=3)
+      restored_memory.restore(directory)
+      self.assertEqual(len(restored_memory), len(memory))
+      self.assertEqual(restored_memory._p, memory._p)
+      self.assertAlmostEqual(restored_memory.it_sum.sum(),
+                             memory.it_sum.sum())
+      for key, values in restored_memory.get().items():
+        np.testing.assert_array_equal(values, memory.get()[key])
+
+  def test_batch_prefetcher(self):
+    memory = LazyMultiStepMemory(capacity=128, state_shape=state_shape,
+                                 device="cpu", multi_step=3)
+    fill_memory(memory, 50)
+    prefetcher = BatchPrefetcher(memory, 16, depth=2)
+    for _ in range(5):
+      states, _, _, _, _, _ = prefetcher.get()
+      self.assertEqual(tuple(states.shape), (16, *state_shape))
+      prefetcher.append(np.zeros(state_shape), 0, 1.0, np.ones(state_shape),
+                        True)
+    prefetcher.close()
+
+  def test_prioritized_batch_prefetcher(self):
+    memory = LazyPrioritizedMultiStepMemory(
+      capacity=128, state_shape=state_shape, device="cpu", multi_step=3)
+    fill_memory(memory, 50)
+    prefetcher = BatchPrefetcher(memory, 16, depth=2)
+    for _ in range(5):
+      (states, _, _, _, _, _), weights = prefetcher.get()
+      self.assertEqual(tuple(weights.shape), (16, 1))
+      # the next batch does not wait for the priorities of this batch
+      (_, _, _, _, _, _), _ = prefetcher.get()
+      (first_indices, _), (second_indices, _) = prefetcher._slots
+      prefetcher.update_priority(torch.full((16,), 0.1))
+      np.testing.assert_allclose(memory.it_sum[first_indices],
+                                 memory._pa(0.1))
+      prefetcher.update_priority(torch.full((16,), 0.3))
+      np.testing.assert_allclose(memory.it_sum[second_indices],
+                                 memory._pa(0.3))
+    prefetcher.close()
+
+  def test_prefetcher_errors(self):
+    memory = LazyMultiStepMemory(capacity=128, state_shape=state_shape,
+                                 device="cpu", multi_step=3)
+    prefetcher = BatchPrefetcher(memory, 16)
+    # the empty memory can not be sampled, but the thread keeps running
+    with self.assertRaises(ValueError):
+      prefetcher.get()
+    fill_memory(memory, 50)
+    states, _, _, _, _, _ = prefetcher.get()
+    self.assertEqual(tuple(states.shape), (16, *state_shape))
+    prefetcher.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
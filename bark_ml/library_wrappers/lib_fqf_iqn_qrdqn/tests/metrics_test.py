@@ -0,0 +1,97 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Julian Bernhard, Patrick Hart
+#
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+try:
+    import debug_settings
+except:
+    pass
+
+import unittest
+import numpy as np
+import torch
+
+# BARK-ML imports
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent.metrics import MetricsLogger
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.utils import RunningMeanStats
+
+
+class RecordingWriter:
+  def __init__(self):
+    self.scalars = []
+    self.histograms = []
+
+  def add_scalar(self, name, value, step):
+    self.scalars.append((name, value, step))
+
+  def add_histogram(self, name, values, step):
+    self.histograms.append((name, values, step))
+
+
+class MetricsLoggerTests(unittest.TestCase):
+  def test_aggregation(self):
+    writer = RecordingWriter()
+    metrics = MetricsLogger(writer, flush_interval=3600.)
+    metrics.add_scalar("loss", torch.tensor(1.), 10)
+    metrics.add_scalar("loss", 3., 20)
+    metrics.increment("episodes", 20)
+    metrics.add_histogram("reward", np.array([1., 2.]), 10)
+    metrics.add_histogram("reward", torch.tensor([3.]), 20)
+    with self.assertLogs(level="INFO") as logs:
+      for episode in range(4):
+        metrics.log("Episode: %d", episode)
+      metrics.flush()
+    self.assertEqual(logs.output,
+                     [f"INFO:root:Episode: {episode}" for episode in range(4)])
+    self.assertIn(("loss", 2., 20), writer.scalars)
+    self.assertIn(("episodes", 1, 20), writer.scalars)
+    name, values, step = writer.histograms[0]
+    self.assertEqual((name, step), ("reward", 20))
+    np.testing.assert_array_equal(values, [1., 2., 3.])
+
+    # counters keep their total across flushes
+    metrics.increment("episodes", 30, count=2)
+    metrics.close()
+    self.assertEqual(writer.scalars[-1], ("episodes", 3, 30))
+
+  def test_flush_on_records(self):
+    writer = RecordingWriter()
+    metrics = MetricsLogger(writer, flush_interval=3600., flush_records=5)
+    for step in range(5):
+      metrics.add_scalar("loss", step, step)
+    metrics.close()
+    self.assertEqual(writer.scalars, [("loss", 2., 4)])
+
+  def test_close(self):
+    writer = RecordingWriter()
+    metrics = MetricsLogger(writer, flush_interval=3600.)
+    thread = metrics._thread
+    metrics.close()
+    self.assertFalse(thread.is_alive())
+    # closing twice is fine, recording again restarts the thread
+    metrics.close()
+    metrics.add_scalar("loss", 1., 10)
+    self.assertTrue(metrics._thread.is_alive())
+    metrics.close()
+    self.assertEqual(writer.scalars, [("loss", 1., 10)])
+
+  def test_running_mean(self):
+    stats = RunningMeanStats(n=3)
+    self.assertTrue(np.isnan(stats.get()))
+    for x in range(10):
+      stats.append(float(x))
+      self.assertAlmostEqual(stats.get(), np.mean(stats.stats))
+
+    tensor_stats = RunningMeanStats(n=3)
+    for x in range(10):
+      tensor_stats.append(torch.tensor(float(x)))
+      self.assertTrue(torch.is_tensor(tensor_stats._sum))
+      self.assertAlmostEqual(tensor_stats.get(),
+                             np.mean(range(max(0, x - 2), x + 1)), places=5)
+
+
+if __name__ == '__main__':
+  unittest.main()
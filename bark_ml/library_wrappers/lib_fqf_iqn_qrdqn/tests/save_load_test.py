@@ -11,9 +11,11 @@ except:
     pass
 
 
+import os
 import unittest
 from gym import spaces
 import numpy as np
+import torch
 
 # BARK imports
 from bark.runtime.commons.parameters import ParameterServer
@@ -62,6 +64,79 @@ class BaseAgentTests(unittest.TestCase):
     self.assertEqual(loaded_agent.ml_behavior.action_space.n, fqf_agent.ml_behavior.action_space.n)
     self.assertEqual(loaded_agent.ent_coef, fqf_agent.ent_coef)
 
+  def test_act_batch(self):
+    params = ParameterServer()
+    fqf_agent = FQFAgent(env = DummyEnv(), agent_save_dir="./save_dir", params=params)
+    fqf_agent.online_net.eval()
+
+    states = np.random.rand(16, observation_length)
+    actions = fqf_agent.ActBatch(states, epsilons=np.zeros(16))
+    self.assertEqual(actions.shape, (16,))
+    for state, action in zip(states, actions):
+      self.assertEqual(fqf_agent.Act(state), action)
+
+    random_actions = fqf_agent.ExploreBatch(100)
+    self.assertTrue(np.all((random_actions >= 0) & (random_actions < num_actions)))
+    # the agent acts randomly before the start steps
+    self.assertEqual(fqf_agent.ActBatch(states).shape, (16,))
+
+  def test_inference_mode(self):
+    params = ParameterServer()
+    fqf_agent = FQFAgent(env = DummyEnv(), agent_save_dir="./save_dir", params=params)
+    fqf_agent.online_net.eval()
+    states = np.random.rand(16, observation_length)
+    actions = [fqf_agent.Act(state) for state in states]
+
+    fqf_agent.enable_inference_mode(num_threads=1)
+    self.assertEqual([fqf_agent.Act(state) for state in states], actions)
+    fqf_agent.disable_inference_mode()
+
+  def test_async_checkpoints(self):
+    params = ParameterServer()
+    params["ML"]["BaseAgent"]["AsyncCheckpoints"] = True
+    params["ML"]["BaseAgent"]["CheckpointsToKeep"] = 2
+    fqf_agent = FQFAgent(env = DummyEnv(), agent_save_dir="./save_dir_async", params=params)
+    saved_weights = fqf_agent.snapshot_models()["online_net"]
+    fqf_agent.save(checkpoint_type="best")
+    # changes after saving do not reach the checkpoint
+    with torch.no_grad():
+      for parameter in fqf_agent.online_net.parameters():
+        parameter.add_(1.)
+    for steps in [100, 200, 300]:
+      fqf_agent.steps = steps
+      fqf_agent.save_step_checkpoint()
+    fqf_agent.flush_checkpoints()
+
+    checkpoints_dir = FQFAgent.check_point_directory("./save_dir_async", "")
+    self.assertEqual(sorted(name for name in os.listdir(checkpoints_dir)
+                            if name.startswith("step_")),
+                     ["step_200", "step_300"])
+    loaded_agent = FQFAgent(env = DummyEnv(), agent_save_dir="./save_dir_async", checkpoint_load="best")
+    for key, value in loaded_agent.online_net.state_dict().items():
+      self.assertTrue(torch.equal(value, saved_weights[key]))
+
+  def test_gradient_accumulation(self):
+    params = ParameterServer()
+    params["ML"]["BaseAgent"]["GradientAccumulationSteps"] = 4
+    fqf_agent = FQFAgent(env = DummyEnv(), agent_save_dir="./save_dir", params=params)
+    states, targets = torch.rand(32, observation_length), torch.rand(32, 1)
+    nets = [torch.nn.Linear(observation_length, 1) for _ in range(2)]
+    nets[1].load_state_dict(nets[0].state_dict())
+    optims = [torch.optim.SGD(net.parameters(), lr=0.1) for net in nets]
+
+    loss = torch.nn.functional.mse_loss(nets[0](states), targets)
+    optims[0].zero_grad()
+    loss.backward()
+    optims[0].step()
+    # the same gradient step from four micro-batches
+    for micro_batch in range(4):
+      fqf_agent._micro_batch = micro_batch
+      rows = slice(8 * micro_batch, 8 * (micro_batch + 1))
+      fqf_agent.update_params(optims[1], torch.nn.functional.mse_loss(
+        nets[1](states[rows]), targets[rows]), networks=[nets[1]])
+    for expected, parameter in zip(nets[0].parameters(), nets[1].parameters()):
+      self.assertTrue(torch.allclose(expected, parameter, atol=1e-6))
+
 
 if __name__ == '__main__':
   unittest.main()
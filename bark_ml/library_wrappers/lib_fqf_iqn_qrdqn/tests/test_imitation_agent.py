@@ -11,12 +11,15 @@ except:
     pass
 
 import unittest
+import tempfile
+import multiprocessing
 import numpy as np
 from gym import spaces
 
 # BARK imports
 from bark.runtime.commons.parameters import ParameterServer
-from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent import ImitationAgent
+from bark_ml.library_wrappers.lib_fqf_iqn_qrdqn.agent import ImitationAgent, \
+  DemonstrationDataset
 
 observation_length = 5 
 num_actions = 4
@@ -98,5 +101,40 @@ class EvaluationTests(unittest.TestCase):
                            params=params, checkpoint_load = False)
     agent.run()
 
+  def test_demonstration_dataset(self):
+    data = create_data(1000)
+    dataset = DemonstrationDataset.from_demonstrations(data)
+    self.assertEqual(dataset.states.dtype, np.float32)
+    self.assertTrue(dataset.states.flags["C_CONTIGUOUS"])
+    self.assertEqual(dataset.action_values.shape, (1000, 3*num_actions))
+    self.assertEqual(dataset.policies.shape, (1000, 0))
+    np.testing.assert_allclose(dataset.states[10], data[10][0], rtol=1e-6)
+
+    train, test = dataset.split(0.8)
+    self.assertEqual((len(train), len(test)), (800, 200))
+    all_states = np.concatenate([train.states, test.states])
+    np.testing.assert_array_equal(np.sort(all_states, axis=0),
+                                  np.sort(dataset.states, axis=0))
+    batch = train.sample(32)
+    self.assertEqual(batch["states"].shape, (32, observation_length))
+
+  def test_data_loader_workers(self):
+    params = ParameterServer()
+    params["ML"]["BaseAgent"]["NumSteps"] = 10
+    params["ML"]["BaseAgent"]["EvalInterval"] = 5
+    params["ML"]["BaseAgent"]["DataLoaderWorkers"] = 2
+    with tempfile.TemporaryDirectory() as agent_save_dir:
+      agent = ImitationAgent(agent_save_dir=agent_save_dir,
+                             demonstration_collector=TestDemonstrationCollector(),
+                             params=params, checkpoint_load = False)
+      states, action_values = agent.sample_training_batch()
+      self.assertEqual(states.shape, (agent.batch_size, observation_length))
+      self.assertEqual(action_values.shape, (agent.batch_size, 3*num_actions))
+      self.assertEqual(len(multiprocessing.active_children()), 2)
+      agent.run()
+      # the loader workers are shut down after training
+      self.assertIsNone(agent._training_batches)
+      self.assertEqual(multiprocessing.active_children(), [])
+
 if __name__ == '__main__':
   unittest.main()
@@ -1,4 +1,7 @@
+import math
+import os
 from collections import deque
+from typing import Optional
 import numpy as np
 import torch
 
@@ -23,62 +26,133 @@ def disable_gradients(network):
     param.requires_grad = False
 
 
-def calculate_huber_loss(td_errors, kappa=1.0):
-  return torch.where(td_errors.abs() <= kappa, 0.5 * td_errors.pow(2),
-                     kappa * (td_errors.abs() - 0.5 * kappa))
+# Enables the shape checks of the loss computations, which cost time in
+# every update (e.g. BARK_ML_DEBUG_CHECKS=1).
+_debug_checks = os.environ.get("BARK_ML_DEBUG_CHECKS", "0") == "1"
 
 
-def calculate_quantile_huber_loss(td_errors, taus, weights=None, kappa=1.0):
-  assert not taus.requires_grad
-  batch_size, N, N_dash = td_errors.shape
+def set_debug_checks(enabled):
+  global _debug_checks
+  _debug_checks = enabled
 
-  # Calculate huber loss element-wisely.
-  element_wise_huber_loss = calculate_huber_loss(td_errors, kappa)
-  assert element_wise_huber_loss.shape == (batch_size, N, N_dash)
 
-  # Calculate quantile huber loss element-wisely.
-  element_wise_quantile_huber_loss = torch.abs(taus[..., None] - (
-      td_errors.detach() < 0).float()) * element_wise_huber_loss / kappa
-  assert element_wise_quantile_huber_loss.shape == (batch_size, N, N_dash)
+def debug_checks():
+  return _debug_checks
+
+
+# NOTE: The loss kernels are scripted to run as one TorchScript graph
+# instead of many small eager ops, which dominate with small networks.
+@torch.jit.script
+def _huber_loss(td_errors: torch.Tensor, kappa: float):
+  abs_errors = td_errors.abs()
+  return torch.where(abs_errors <= kappa, 0.5 * td_errors.pow(2),
+                     kappa * (abs_errors - 0.5 * kappa))
 
-  # Quantile huber loss.
+
+@torch.jit.script
+def _quantile_huber_loss(td_errors: torch.Tensor, taus: torch.Tensor,
+                         weights: Optional[torch.Tensor], kappa: float):
+  element_wise_quantile_huber_loss = torch.abs(taus[..., None] - (
+      td_errors.detach() < 0).float()) * _huber_loss(td_errors, kappa) / kappa
   batch_quantile_huber_loss = element_wise_quantile_huber_loss.sum(dim=1).mean(
       dim=1, keepdim=True)
-  assert batch_quantile_huber_loss.shape == (batch_size, 1)
+  if weights is not None:
+    return (batch_quantile_huber_loss * weights).mean()
+  return batch_quantile_huber_loss.mean()
+
 
+@torch.jit.script
+def _evaluate_quantile_at_action(s_quantiles: torch.Tensor,
+                                 actions: torch.Tensor):
+  # Expand actions into (batch_size, N, 1).
+  action_index = actions[..., None].expand(
+      s_quantiles.shape[0], s_quantiles.shape[1], 1)
+  return s_quantiles.gather(dim=2, index=action_index)
+
+
+@torch.jit.script
+def _fraction_loss(sa_quantiles: torch.Tensor, sa_quantile_hats: torch.Tensor,
+                   taus: torch.Tensor, weights: Optional[torch.Tensor]):
+  values_1 = sa_quantiles - sa_quantile_hats[:, :-1]
+  signs_1 = sa_quantiles > torch.cat(
+      [sa_quantile_hats[:, :1], sa_quantiles[:, :-1]], dim=1)
+  values_2 = sa_quantiles - sa_quantile_hats[:, 1:]
+  signs_2 = sa_quantiles < torch.cat(
+      [sa_quantiles[:, 1:], sa_quantile_hats[:, -1:]], dim=1)
+  gradient_of_taus = (torch.where(signs_1, values_1, -values_1) +
+                      torch.where(signs_2, values_2, -values_2)).view(
+                          sa_quantiles.shape[0], -1)
   if weights is not None:
-    quantile_huber_loss = (batch_quantile_huber_loss * weights).mean()
-  else:
-    quantile_huber_loss = batch_quantile_huber_loss.mean()
+    return ((gradient_of_taus * taus[:, 1:-1]).sum(dim=1, keepdim=True) *
+            weights).mean()
+  return (gradient_of_taus * taus[:, 1:-1]).sum(dim=1).mean()
+
+
+def calculate_huber_loss(td_errors, kappa=1.0):
+  return _huber_loss(td_errors, float(kappa))
 
-  return quantile_huber_loss
+
+def calculate_quantile_huber_loss(td_errors, taus, weights=None, kappa=1.0):
+  if _debug_checks:
+    assert not taus.requires_grad
+    assert td_errors.dim() == 3 and taus.shape[-1] == td_errors.shape[1]
+    assert weights is None or weights.shape == (td_errors.shape[0], 1)
+  return _quantile_huber_loss(td_errors, taus, weights, float(kappa))
 
 
-# note: resume here**
 def evaluate_quantile_at_action(s_quantiles, actions):
-  assert s_quantiles.shape[0] == actions.shape[0]
+  if _debug_checks:
+    assert s_quantiles.shape[0] == actions.shape[0]
+  return _evaluate_quantile_at_action(s_quantiles, actions)
 
-  batch_size = s_quantiles.shape[0]
-  N = s_quantiles.shape[1]
-  # Expand actions into (batch_size, N, 1).
-  action_index = actions[..., None].expand(batch_size, N, 1)
 
-  # Calculate quantile values at specified actions.
-  sa_quantiles = s_quantiles.gather(dim=2, index=action_index)
+def calculate_fraction_loss(sa_quantiles, sa_quantile_hats, taus,
+                            weights=None):
+  """Loss of the fraction proposal network of FQF.
 
-  return sa_quantiles
+  Its gradient w.r.t. the inner fractions `taus[:, 1:-1]` is the
+  gradient of the 1-Wasserstein distance (Proposition 1 of the paper),
+  given the quantile values at the fractions (batch_size, N - 1, 1) and
+  at their midpoints (batch_size, N, 1).
+  """
+  if _debug_checks:
+    assert not sa_quantiles.requires_grad
+    assert not sa_quantile_hats.requires_grad
+    assert sa_quantile_hats.shape[1] == sa_quantiles.shape[1] + 1
+    assert taus.shape[1] == sa_quantiles.shape[1] + 2
+  return _fraction_loss(sa_quantiles, sa_quantile_hats, taus, weights)
 
 
 class RunningMeanStats:
+  """Mean of the last n values.
+
+  The values can be detached tensors, whose sum stays on their device
+  until `get`, so appending does not synchronize with the device.
+  """
   def __init__(self, n=10):
     self.n = n
     self.stats = deque(maxlen=n)
+    self._sum = 0.
+    self._appends = 0
 
   def append(self, x):
+    if len(self.stats) == self.n:
+      self._sum = self._sum - self.stats[0]
     self.stats.append(x)
+    self._sum = self._sum + x
+    self._appends += 1
+    # removes the accumulated rounding errors
+    if self._appends % self.n == 0:
+      if torch.is_tensor(x):
+        self._sum = torch.stack(list(self.stats)).sum(dim=0)
+      else:
+        self._sum = math.fsum(self.stats)
 
   def get(self):
-    return np.mean(self.stats)
+    if not self.stats:
+      return np.nan
+    mean = self._sum / len(self.stats)
+    return mean.item() if torch.is_tensor(mean) else mean
 
 
 class LinearAnneaer:
@@ -14,7 +14,6 @@ from bark.core.models.behavior import BehaviorModel
 
 # tfa
 from tf_agents.environments import tf_py_environment
-from tf_agents.utils.common import Checkpointer
 from tf_agents.trajectories import time_step as ts
 
 # BARK-ML imports
@@ -45,6 +44,7 @@ class BehaviorTFAAgent(BehaviorModel):
     self._ckpt_manager = self.GetCheckpointer(ckpt_path,self._params["ML"]["BehaviorTFAAgents"][
         "NumCheckpointsToKeep", "", 3])
     self._best_ckpt_manager = self.GetCheckpointer(ckpt_path+"best_checkpoint/",1)
+    self._checkpoint_options = self.GetCheckpointOptions()
     self._logger = logging.getLogger()
     # NOTE: by default we do not want the action to be set externally
     #       as this enables the agents to be plug and played in BARK.
@@ -65,29 +65,51 @@ class BehaviorTFAAgent(BehaviorModel):
     self._set_action_externally = externally
 
   def GetCheckpointer(self,path_,max_to_keep_):
-    checkpointer = Checkpointer(
-        path_,
-      global_step=self._ckpt.step,
-      tf_agent=self._agent,
-      max_to_keep=max_to_keep_)
-    checkpointer.initialize_or_restore()
-    return checkpointer
+    # Checkpoints the same objects as the tf_agents Checkpointer, so that
+    # its checkpoints can still be restored.
+    checkpoint = tf.train.Checkpoint(global_step=self._ckpt.step,
+                                     tf_agent=self._agent)
+    checkpoint_manager = tf.train.CheckpointManager(
+      checkpoint, directory=path_, max_to_keep=max_to_keep_)
+    checkpoint.restore(checkpoint_manager.latest_checkpoint)
+    return checkpoint_manager
+
+  def GetCheckpointOptions(self):
+    # Asynchronous checkpoints copy the variables to the host and write
+    # them in a background thread (TensorFlow 2.12 or newer).
+    if not self._params["ML"]["BehaviorTFAAgents"]["AsyncCheckpoints", "", False]:
+      return None
+    try:
+      return tf.train.CheckpointOptions(
+        experimental_enable_async_checkpoint=True)
+    except TypeError:
+      logging.warning("Asynchronous checkpoints need TensorFlow 2.12 or newer.")
+      return None
+
+  def SaveWith(self, checkpoint_manager):
+    checkpoint_manager.save(checkpoint_number=self._agent._train_step_counter,
+                            options=self._checkpoint_options)
+
+  def WaitForCheckpoints(self):
+    # Waits until the asynchronous checkpoints are written.
+    if self._checkpoint_options is not None:
+      for checkpoint_manager in [self._ckpt_manager, self._best_ckpt_manager]:
+        checkpoint_manager.checkpoint.sync()
 
   def Save(self):
-    self._ckpt_manager.save(
-      global_step=self._agent._train_step_counter)
+    self.SaveWith(self._ckpt_manager)
     self._logger.info("Saved checkpoint for step {}.".format(
       int(self._agent._train_step_counter.numpy())))
 
 
   def SaveCheckpoint(self):
-    self._best_ckpt_manager.save(
-      global_step=self._agent._train_step_counter)
+    self.SaveWith(self._best_ckpt_manager)
     self._logger.info(
       f"Saved best checkpoint for step "
-      f"{int(self._agent._train_step_counter.numpy())} at {self._best_ckpt_manager._manager._directory}.")
+      f"{int(self._agent._train_step_counter.numpy())} at {self._best_ckpt_manager.directory}.")
 
   def Load(self):
+    self.WaitForCheckpoints()
     try:
       self._ckpt.restore(self._ckpt_manager.latest_checkpoint)
     except:
@@ -33,13 +33,19 @@ class PPORunner(TFARunner):
       print(f"Collection {i}")
       global_iteration = self._agent._agent._train_step_counter.numpy()
       tf.summary.experimental.set_step(global_iteration)
-      self._collection_driver.run()
-      trajectories = self._agent._replay_buffer.gather_all()
-      self._agent._agent.train(experience=trajectories)
+      self.Collect()
+      with self._throughput.Time("sample"):
+        trajectories = self._agent._replay_buffer.gather_all()
+      with self._throughput.Time("update"):
+        self._agent._agent.train(experience=trajectories)
+      self._throughput.Count("updates")
       self._agent._replay_buffer.clear()
       if i % self._params["ML"]["PPORunner"]["EvaluateEveryNSteps", "", 100] == 0:
         self._tracer.Reset()
-        self.Run(
-          num_episodes=self._params["ML"]["TFARunner"]["EvaluationSteps", "", 20],
-          mode="training")
-        self._agent.Save()
\ No newline at end of file
+        with self._throughput.Time("eval"):
+          self.Run(
+            num_episodes=self._params["ML"]["TFARunner"]["EvaluationSteps", "", 20],
+            mode="training")
+        with self._throughput.Time("checkpoint"):
+          self._agent.Save()
+        self.LogThroughput(global_iteration)
\ No newline at end of file
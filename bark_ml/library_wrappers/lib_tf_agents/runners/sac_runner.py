@@ -41,13 +41,16 @@ class SACRunner(TFARunner):
       tf.summary.experimental.set_step(global_iteration)
 
       t0 = time.time()
-      self._collection_driver.run()
+      self.Collect()
       self._log_collection_duration(start_time=t0, iteration=global_iteration)
 
-      experience, _ = next(iterator)
+      with self._throughput.Time("sample"):
+        experience, _ = next(iterator)
 
       t0 = time.time()
-      self._agent._agent.train(experience)
+      with self._throughput.Time("update"):
+        self._agent._agent.train(experience)
+      self._throughput.Count("updates")
       self._log_training_duration(start_time=t0, iteration=global_iteration)
 
       if global_iteration % self._evaluation_interval == 0:
@@ -56,10 +59,13 @@ class SACRunner(TFARunner):
           iteration=global_iteration)
         iteration_start_time = time.time()
         self._tracer.Reset()
-        self.Run(
-          num_episodes=self._params["ML"]["TFARunner"]["EvaluationSteps", "", 20],
-          mode="training")
-        self._agent.Save()
+        with self._throughput.Time("eval"):
+          self.Run(
+            num_episodes=self._params["ML"]["TFARunner"]["EvaluationSteps", "", 20],
+            mode="training")
+        with self._throughput.Time("checkpoint"):
+          self._agent.Save()
+        self.LogThroughput(global_iteration)
 
   @staticmethod
   def _log_collection_duration(start_time, iteration):
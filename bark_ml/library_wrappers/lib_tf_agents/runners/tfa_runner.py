@@ -5,6 +5,7 @@
 # This work is licensed under the terms of the MIT license.
 # For a copy, see <https://opensource.org/licenses/MIT>.
 import logging
+import pickle
 import tensorflow as tf
 import numpy as np
 tf.compat.v1.enable_v2_behavior()
@@ -24,6 +25,8 @@ from tf_agents.trajectories import time_step as ts
 # BARK-ML imports
 from bark_ml.library_wrappers.lib_tf_agents.py_bark_environment import PyBARKEnvironment
 from bark_ml.commons.tracer import Tracer
+from bark_ml.commons.sequential_evaluation import SequentialEvaluation
+from bark_ml.commons.throughput import ThroughputMonitor
 
 def get_index(episode_log, key, idx):
   return episode_log[idx][key]
@@ -40,6 +43,52 @@ def check_if_any(episode_log, key, val):
       return True
   return False
 
+
+class EpisodeStatistics:
+  """Accumulates the evaluation metrics of an episode while it is running.
+
+  Yields the same values as evaluating the full episode log with
+  `get_index`, `calculate_mean` and `check_if_any`, but without
+  storing the observations, actions and infos of every step.
+  """
+
+  def __init__(self):
+    self.reward_sum = 0.
+    self.num_entries = 0
+    self.step_count = 0
+    self.collision = False
+    self.drivable_area = False
+    self.goal_reached = False
+    self.any_not_colliding = False
+    self.any_in_drivable_area = False
+
+  def Update(self, reward, info):
+    self.reward_sum += reward
+    self.num_entries += 1
+    self.step_count = info["step_count"]
+    self.collision = self.collision or info["collision"] == True
+    self.drivable_area = self.drivable_area or info["drivable_area"] == True
+    self.goal_reached = self.goal_reached or info["goal_reached"] == True
+    self.any_not_colliding = \
+      self.any_not_colliding or info["collision"] == False
+    self.any_in_drivable_area = \
+      self.any_in_drivable_area or info["drivable_area"] == False
+
+  @property
+  def mean_reward(self):
+    return self.reward_sum / self.num_entries
+
+  @property
+  def collided(self):
+    return self.collision or self.drivable_area
+
+  @property
+  def success(self):
+    # rethink success: goal_reached without collision and expiring drivable_area
+    return self.goal_reached and self.any_not_colliding and \
+      self.any_in_drivable_area
+
+
 class TFARunner:
   """Used to train, evaluate and visualize a BARK-ML agent."""
 
@@ -61,6 +110,8 @@ class TFARunner:
     self._environment = environment
     self._wrapped_env = tf_py_environment.TFPyEnvironment(
       PyBARKEnvironment(self._environment))
+    self._throughput = ThroughputMonitor()
+    self._environment_steps = tf_metrics.EnvironmentSteps()
     self.GetInitialCollectionDriver()
     self.GetCollectionDriver()
     self._logger = logging.getLogger()
@@ -91,12 +142,32 @@ class TFARunner:
     self._collection_driver = dynamic_episode_driver.DynamicEpisodeDriver(
       env=self._wrapped_env,
       policy=self._agent._agent.collect_policy,
-      observers=[self._agent._replay_buffer.add_batch],
+      observers=[self._agent._replay_buffer.add_batch,
+                 self._environment_steps],
       num_episodes=self._params["ML"]["TFARunner"]["CollectionEpisodesPerStep", "", 1])
 
   def CollectInitialEpisodes(self):
     self._initial_collection_driver.run()
 
+  @property
+  def throughput(self):
+    # e.g. throughput.Summary()["steps_per_sec"]
+    return self._throughput
+
+  def Collect(self):
+    # The driver steps the environment and the collect policy together.
+    steps_before = int(self._environment_steps.result())
+    with self._throughput.Time("collect"):
+      self._collection_driver.run()
+    self._throughput.Count(
+      "steps", int(self._environment_steps.result()) - steps_before)
+
+  def LogThroughput(self, iteration):
+    # Writes the throughput since the last call.
+    with tf.name_scope("Throughput"):
+      for name, value in self._throughput.Summary(reset=True).items():
+        tf.summary.scalar(name, value, iteration)
+
   def Train(self):
     self.CollectInitialEpisodes()
     if self._summary_writer is not None:
@@ -104,6 +175,7 @@ class TFARunner:
         self._train()
     else:
       self._train()
+    self._agent.WaitForCheckpoints()
 
   def _train(self):
     """Agent specific."""
@@ -117,8 +189,13 @@ class TFARunner:
       action = np.reshape(action, expected_shape)
     return action
 
-  def RunEpisode(self, render=True):
-    episode_log = []
+  def RunEpisode(self, render=True, episode_log=None):
+    """Runs an episode and returns its `EpisodeStatistics`.
+
+    If a list is passed as `episode_log`, the state, action, reward and
+    info of every step are appended to it.
+    """
+    statistics = EpisodeStatistics()
     state = self._environment.reset()
     is_terminal = False
     if render:
@@ -131,35 +208,96 @@ class TFARunner:
       action = self.ReshapeActionIfRequired(action_step)
 
       state, reward, is_terminal, info = self._environment.step(action)
-      episode_log.append({
-        "state": state, "action" : action, "reward": reward,
-        "is_terminal": is_terminal, **info})
+      statistics.Update(reward, info)
+      if episode_log is not None:
+        episode_log.append({
+          "state": state, "action" : action, "reward": reward,
+          "is_terminal": is_terminal, **info})
       if render:
         self._environment.render()
-    episode_log.append({
-        "state": state, "action" : None, "reward": reward,
-        "is_terminal": is_terminal, **info})
-    return episode_log
+    # NOTE: the terminal entry is counted twice to keep the mean reward
+    #       comparable to the one of previously recorded episode logs
+    statistics.Update(reward, info)
+    if episode_log is not None:
+      episode_log.append({
+          "state": state, "action" : None, "reward": reward,
+          "is_terminal": is_terminal, **info})
+    return statistics
+
+  def GetSequentialEvaluation(self, num_episodes):
+    """Returns a `SequentialEvaluation` if early stopping is configured.
+
+    The evaluation stops once the confidence intervals of the goal and
+    collision rates are narrower than `EvaluationIntervalWidth` or, when
+    training, the goal rate is significantly worse than the best one.
+    """
+    params = self._params["ML"]["TFARunner"]
+    interval_width = params["EvaluationIntervalWidth", "", 0.]
+    if not interval_width:
+      return None
+    return SequentialEvaluation(
+      num_episodes,
+      {"goal_rate": interval_width, "collision_rate": interval_width},
+      confidence=params["EvaluationConfidence", "", 0.95],
+      min_episodes=params["EvaluationMinEpisodes", "", 30],
+      check_interval=params["EvaluationCheckInterval", "", 10],
+      binary_metrics=["goal_rate", "collision_rate"])
+
+  @staticmethod
+  def LoadEpisodeLogs(filename):
+    """Yields the (episode index, episode log) pairs written by `Run`."""
+    with open(filename, "rb") as f:
+      while True:
+        try:
+          yield pickle.load(f)
+        except EOFError:
+          return
 
   def Run(
-    self, num_episodes=10, render=False, mode="not_training", **kwargs):
+    self, num_episodes=10, render=False, mode="not_training",
+    episode_log_file=None, **kwargs):
+    """Runs `num_episodes` episodes and returns the mean metrics.
+
+    Full episode logs are only recorded in the "evaluate" mode or if an
+    `episode_log_file` is given. In the latter case every episode log is
+    appended to the file once the episode has finished and can be read
+    back using `LoadEpisodeLogs`. In the "evaluate" mode without a file
+    the episode logs are returned instead of the metrics.
+    """
+    keep_episode_logs = mode == "evaluate" and episode_log_file is None
     episode_logs = {}
+    log_file = open(episode_log_file, "ab") if episode_log_file else None
     collision, success, steps, reward = 0, 0, 0., 0.
-    for i in range(0, num_episodes):
-      if render:
-        self._logger.info(f"Simulating episode {i}.")
-
-      episode_log = self.RunEpisode(render=render)
-      if mode == "evaluate":
-        episode_logs[i] = episode_log
-      steps += get_index(episode_log, "step_count", -1)
-      reward += calculate_mean(episode_log, "reward")
-      collision += check_if_any(episode_log, "collision", True) or \
-        check_if_any(episode_log, "drivable_area", True)
-      # rethink success: goal_reached without collision and expiring drivable_area
-      success += check_if_any(episode_log, "goal_reached", True) and \
-        check_if_any(episode_log, "collision", False) and \
-        check_if_any(episode_log, "drivable_area", False)
+    sequential = self.GetSequentialEvaluation(num_episodes)
+    best_values = {"goal_rate": self._max_success_rate} \
+      if mode == "training" and self._max_success_rate >= 0. else None
+    try:
+      for i in range(0, num_episodes):
+        if render:
+          self._logger.info(f"Simulating episode {i}.")
+
+        episode_log = [] if keep_episode_logs or log_file else None
+        statistics = self.RunEpisode(render=render, episode_log=episode_log)
+        if keep_episode_logs:
+          episode_logs[i] = episode_log
+        if log_file:
+          pickle.dump((i, episode_log), log_file,
+                      protocol=pickle.HIGHEST_PROTOCOL)
+          log_file.flush()
+        steps += statistics.step_count
+        reward += statistics.mean_reward
+        collision += statistics.collided
+        success += statistics.success
+        if sequential is not None:
+          sequential.Update({
+            "goal_rate": statistics.success,
+            "collision_rate": statistics.collided})
+          if sequential.ShouldStop(best_values):
+            num_episodes = i + 1
+            break
+    finally:
+      if log_file:
+        log_file.close()
 
     mean_steps = steps / num_episodes
     mean_reward = reward / num_episodes
@@ -171,12 +309,21 @@ class TFARunner:
       f" collision-rate of {col_rate:.5f}, took on average" +
       f" {mean_steps:.3f} steps, and reached a success-rate of " +
       f" {success_rate:.3f} (evaluated over {num_episodes} episodes).")
+    if sequential is not None:
+      intervals = sequential.Summary()
+      print(
+        f"Confidence intervals of the success-rate " +
+        f"[{intervals['goal_rate_ci_low']:.3f}, " +
+        f"{intervals['goal_rate_ci_high']:.3f}] and the collision-rate " +
+        f"[{intervals['collision_rate_ci_low']:.5f}, " +
+        f"{intervals['collision_rate_ci_high']:.5f}].")
 
     if mode == "training":
-      best_ckpt_folder=self._agent._best_ckpt_manager._manager._directory
+      best_ckpt_folder=self._agent._best_ckpt_manager.directory
       if success_rate > self._max_success_rate or \
         (success_rate == self._max_success_rate and mean_reward > self._max_reward):
-        self._agent.SaveCheckpoint()
+        with self._throughput.Time("checkpoint"):
+          self._agent.SaveCheckpoint()
         with open(best_ckpt_folder + 'info.txt', 'w') as f:
           f.write(f"Success-rate {success_rate:.3f}, collision-rate: {col_rate:.5f}"
                   f", reward {mean_reward:.3f}, steps: {mean_steps:.3f}.")
@@ -201,6 +348,11 @@ class TFARunner:
       #     if key not in ["state", "goal_reached", "step_count", "num_episode", "reward"]:
       #       tf.summary.scalar(f"auto_{key}", val, step=global_iteration)
 
-    if mode == "evaluate":
+    if keep_episode_logs:
       return episode_logs
+    results = {"mean_reward": mean_reward, "mean_steps": mean_steps,
+               "collision_rate": col_rate, "goal_rate": success_rate}
+    if sequential is not None:
+      results.update(sequential.Summary())
+    return results
 
@@ -25,6 +25,8 @@ from bark_ml.library_wrappers.lib_tf_agents.agents.ppo_agent import BehaviorPPOA
 from bark_ml.library_wrappers.lib_tf_agents.agents.sac_agent import BehaviorSACAgent
 from bark_ml.library_wrappers.lib_tf_agents.runners.ppo_runner import PPORunner
 from bark_ml.library_wrappers.lib_tf_agents.runners.sac_runner import SACRunner
+from bark_ml.library_wrappers.lib_tf_agents.runners.tfa_runner import \
+  EpisodeStatistics, calculate_mean, check_if_any
 
 
 class PyLibraryWrappersTFAgentTests(unittest.TestCase):
@@ -109,6 +111,29 @@ class PyLibraryWrappersTFAgentTests(unittest.TestCase):
     self.assertEqual(env.ml_behavior.set_action_externally, True)
 
 
+  def test_episode_statistics(self):
+    infos = [
+      {"step_count": 1, "collision": False, "drivable_area": False,
+       "goal_reached": False},
+      {"step_count": 2, "collision": False, "drivable_area": False,
+       "goal_reached": True}]
+    rewards = [0.1, 1.]
+    episode_log = []
+    statistics = EpisodeStatistics()
+    for reward, info in zip(rewards + rewards[-1:], infos + infos[-1:]):
+      statistics.Update(reward, info)
+      episode_log.append({"reward": reward, **info})
+
+    self.assertAlmostEqual(
+      statistics.mean_reward, calculate_mean(episode_log, "reward"))
+    self.assertEqual(statistics.step_count, 2)
+    self.assertEqual(statistics.collided, False)
+    self.assertEqual(
+      statistics.success,
+      check_if_any(episode_log, "goal_reached", True) and \
+      check_if_any(episode_log, "collision", False) and \
+      check_if_any(episode_log, "drivable_area", False))
+
 
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
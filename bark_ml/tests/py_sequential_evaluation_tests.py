@@ -0,0 +1,63 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Patrick Hart, Julian Bernhard, Klemens Esterle, and
+# Tobias Kessler
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+
+import unittest
+import numpy as np
+
+# Bark-ml imports
+from bark_ml.commons.sequential_evaluation import SequentialEvaluation
+
+
+class PySequentialEvaluationTests(unittest.TestCase):
+  """Sequential evaluation tests."""
+
+  def test_running_statistics(self):
+    values = np.random.RandomState(0).normal(3., 2., size=100)
+    sequential = SequentialEvaluation(100, {"mean_return": 1.})
+    for value in values:
+      sequential.Update({"mean_return": value})
+    self.assertEqual(sequential.num_episodes, 100)
+    self.assertAlmostEqual(sequential.Mean("mean_return"), np.mean(values))
+    low, high = sequential.ConfidenceInterval("mean_return")
+    self.assertLess(low, np.mean(values))
+    self.assertGreater(high, np.mean(values))
+
+  def test_stops_when_precise(self):
+    rng = np.random.RandomState(0)
+    sequential = SequentialEvaluation(
+      10000, {"goal_rate": 0.1}, binary_metrics=["goal_rate"])
+    while not sequential.ShouldStop():
+      sequential.Update({"goal_rate": rng.rand() < 0.9})
+    low, high = sequential.ConfidenceInterval("goal_rate")
+    self.assertLess(high - low, 0.1)
+    self.assertLess(sequential.num_episodes, 1000)
+    # Wilson intervals of binary metrics stay within [0, 1]
+    self.assertGreaterEqual(low, 0.)
+    self.assertLessEqual(high, 1.)
+
+  def test_stops_when_worse(self):
+    rng = np.random.RandomState(0)
+    sequential = SequentialEvaluation(
+      10000, {"goal_rate": 0.01}, binary_metrics=["goal_rate"])
+    while not sequential.ShouldStop({"goal_rate": 0.9}):
+      sequential.Update({"goal_rate": rng.rand() < 0.5})
+    self.assertTrue(sequential.IsWorse("goal_rate", 0.9))
+    self.assertLess(sequential.num_episodes, 100)
+
+  def test_checks_at_interval(self):
+    sequential = SequentialEvaluation(
+      100, {"goal_rate": 1.}, min_episodes=30, check_interval=10,
+      binary_metrics=["goal_rate"])
+    for episode in range(1, 31):
+      sequential.Update({"goal_rate": True})
+      self.assertEqual(sequential.ShouldStop(), episode == 30)
+
+
+if __name__ == '__main__':
+  unittest.main()
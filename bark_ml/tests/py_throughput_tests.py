@@ -0,0 +1,47 @@
+# Copyright (c) 2020 fortiss GmbH
+#
+# Authors: Patrick Hart, Julian Bernhard, Klemens Esterle, and
+# Tobias Kessler
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+
+import time
+import unittest
+
+# Bark-ml imports
+from bark_ml.commons.throughput import ThroughputMonitor
+
+
+class PyThroughputTests(unittest.TestCase):
+  """Throughput monitor tests."""
+
+  def test_nested_phases(self):
+    monitor = ThroughputMonitor()
+    with monitor.Time("update"):
+      time.sleep(0.02)
+      with monitor.Time("sample"):
+        time.sleep(0.05)
+    for _ in range(10):
+      monitor.Count("steps")
+    summary = monitor.Summary()
+    self.assertGreaterEqual(summary["time/sample"], 0.05)
+    # the sampling time is not accounted to the update
+    self.assertLess(summary["time/update"], 0.05)
+    self.assertAlmostEqual(summary["steps_per_sec"],
+                           10 / summary["elapsed_sec"], places=3)
+    self.assertLessEqual(summary["share/update"] + summary["share/sample"] +
+                         summary["share/other"], 1. + 1e-9)
+
+  def test_reset(self):
+    monitor = ThroughputMonitor()
+    monitor.Count("updates", 5)
+    with monitor.Time("env"):
+      pass
+    self.assertIn("updates_per_sec", monitor.Summary(reset=True))
+    self.assertEqual(set(monitor.Summary()), {"elapsed_sec", "share/other"})
+
+
+if __name__ == '__main__':
+  unittest.main()